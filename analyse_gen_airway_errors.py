@@ -3,7 +3,7 @@ from collections import OrderedDict
 import argparse
 
 from common.functionutil import *
-from common.filereader import CsvFileReader
+from common.filereader import CsvFileReader, DICT_FIELD_TYPES_RESULTS_PER_BRANCH
 from common.errorgenerator import get_norm_vector
 
 
@@ -46,9 +46,12 @@ def main(args):
         in_airway_measures_file = join_path_names(input_airway_measures_dir, in_airway_measures_file)
         print("With measures from: \'%s\'..." % (basename(in_airway_measures_file)))
 
-        in_airway_error_measures = CsvFileReader.get_data(in_airway_error_file)
+        in_airway_error_measures = CsvFileReader.get_data_columns(in_airway_error_file)
 
-        in_airway_measures_data = CsvFileReader.get_data(in_airway_measures_file)
+        in_airway_measures_data = CsvFileReader.get_data_columns(in_airway_measures_file,
+                                                                 DICT_FIELD_TYPES_RESULTS_PER_BRANCH,
+                                                                 is_cache=args.is_cache_tables,
+                                                                 cache_dir=args.cache_tables_dir)
 
         in_airway_ids_air_errors = in_airway_error_measures['airway_id']
         in_type_error_air_errors = in_airway_error_measures['type_error']
@@ -61,7 +64,7 @@ def main(args):
         in_voxelnorm_image = get_norm_vector(in_voxelsize_image)
 
         # normalize the airway length measures
-        in_airlength_branches = [elem / in_voxelnorm_image for elem in in_airlength_branches]
+        in_airlength_branches = in_airlength_branches / in_voxelnorm_image
 
         # ---------------
 
@@ -121,6 +124,8 @@ if __name__ == '__main__':
     parser.add_argument('input_dir', type=str, default='./AirwaysErrors/')
     parser.add_argument('output_file', type=str, default='./extent_airway_error.csv/')
     parser.add_argument('--inbasedir', type=str, default='.')
+    parser.add_argument('--is_cache_tables', type=bool, default=False)
+    parser.add_argument('--cache_tables_dir', type=str, default=None)
     args = parser.parse_args()
 
     main(args)
@@ -0,0 +1,327 @@
+
+from typing import List, Tuple, Dict, Callable, Any
+from collections import OrderedDict
+from functools import partial
+import argparse
+import json
+import time
+import tracemalloc
+import platform
+import scipy
+
+from common.functionutil import *
+from common.errorgenerator import get_vector_two_points, get_distance_two_points, get_point_inside_segment, \
+    generate_branch_cylinder, generate_branch_segment, generate_error_blank_branch_cylinder
+from common.metrics import MetricBase, MetricsCaseContext, LIST_AVAIL_METRICS, get_metric
+
+LIST_BENCHMARK_METRICS_DEFAULT = LIST_AVAIL_METRICS + ['AirwayVolumeLeakageDilatedGT']
+NAME_ALL_METRICS_SHARED_CONTEXT = 'AllMetricsSharedContext'
+
+# synthetic airway trees: each branch splits in two children, shorter and thinner than the parent
+RATIO_LENGTH_SIZE_TRUNK = 0.3
+RATIO_DIAM_SIZE_TRUNK = 0.06
+RATIO_LENGTH_CHILDREN = 0.75
+RATIO_DIAM_CHILDREN = 0.75
+ANGLE_CHILDREN_DEGS = 35.0
+MIN_DIAM_BRANCH = 1.0
+
+# perturbations to simulate a prediction: boundary errors, missing terminal branches, and leakage
+RANGE_SCALE_DIAM_PREDICT = (0.8, 1.2)
+PROB_BLANK_TERMINAL_BRANCH = 0.3
+PROB_LEAKAGE_BRANCH = 0.1
+DIAM_LEAKAGE = 3.0
+LENGTH_LEAKAGE = 8.0
+
+
+def get_tree_branches(image_size: Tuple[int, int, int], num_generations: int) -> List[Dict[str, Any]]:
+    # branches of a symmetric binary tree, with the trunk down from the top of the volume, and the children of each
+    # branch rotated around the parent axis by a random angle. Points in (x, y, z) voxel coordinates
+    size_min = min(image_size)
+    length_trunk = RATIO_LENGTH_SIZE_TRUNK * size_min
+    diam_trunk = max(RATIO_DIAM_SIZE_TRUNK * size_min, MIN_DIAM_BRANCH)
+    begin_point_trunk = np.array([image_size[0] / 2.0, image_size[1] / 2.0, image_size[2] - 2.0])
+    end_point_trunk = begin_point_trunk - np.array([0.0, 0.0, length_trunk])
+
+    out_branches = [{'begin_point': begin_point_trunk, 'end_point': end_point_trunk, 'diameter': diam_trunk,
+                     'generation': 0, 'is_terminal': num_generations == 1}]
+    list_parent_branches = list(out_branches)
+
+    angle_children = np.deg2rad(ANGLE_CHILDREN_DEGS)
+    for igen in range(1, num_generations):
+        list_new_branches = []
+        for parent_branch in list_parent_branches:
+            unit_axis_parent = np.array(get_vector_two_points(parent_branch['begin_point'],
+                                                              parent_branch['end_point']))
+            length_parent = np.linalg.norm(unit_axis_parent)
+            unit_axis_parent /= length_parent
+
+            # vector perpendicular to the parent axis, in a random direction, to rotate the children
+            unit_perpen_parent = np.cross(unit_axis_parent, np.random.normal(size=3))
+            unit_perpen_parent /= np.linalg.norm(unit_perpen_parent)
+
+            for sign_angle in [1.0, -1.0]:
+                unit_axis_child = np.cos(angle_children) * unit_axis_parent \
+                    + sign_angle * np.sin(angle_children) * unit_perpen_parent
+                length_child = RATIO_LENGTH_CHILDREN * length_parent
+                begin_point_child = parent_branch['end_point']
+                end_point_child = np.clip(begin_point_child + length_child * unit_axis_child,
+                                          0.0, np.array(image_size) - 1.0)
+                if get_distance_two_points(begin_point_child, end_point_child) < 1.0:
+                    continue
+                list_new_branches.append({'begin_point': begin_point_child, 'end_point': end_point_child,
+                                          'diameter': max(RATIO_DIAM_CHILDREN * parent_branch['diameter'],
+                                                          MIN_DIAM_BRANCH),
+                                          'generation': igen, 'is_terminal': igen == num_generations - 1})
+            # endfor
+        # endfor
+        out_branches += list_new_branches
+        list_parent_branches = list_new_branches
+    # endfor
+
+    return out_branches
+
+
+def generate_tree_mask_cenline(image_shape: Tuple[int, int, int], in_branches: List[Dict[str, Any]]
+                               ) -> Tuple[np.ndarray, np.ndarray]:
+    out_mask = np.zeros(image_shape, dtype=np.uint8)
+    out_cenline = np.zeros(image_shape, dtype=np.uint8)
+
+    for in_branch in in_branches:
+        (begin_point, end_point) = (in_branch['begin_point'], in_branch['end_point'])
+        point_center = get_point_inside_segment(begin_point, end_point, 0.5)
+        vector_axis = get_vector_two_points(begin_point, end_point)
+        # extend the cylinders by their radius, to join them smoothly with the parent and children
+        length_axis = get_distance_two_points(begin_point, end_point) + in_branch['diameter']
+        generate_branch_cylinder(out_mask, point_center, vector_axis, in_branch['diameter'], length_axis)
+        generate_branch_segment(out_cenline, begin_point, end_point)
+    # endfor
+
+    return (out_mask, out_cenline)
+
+
+def generate_perturbed_prediction(image_shape: Tuple[int, int, int], in_branches: List[Dict[str, Any]]
+                                  ) -> Tuple[np.ndarray, np.ndarray]:
+    # prediction similar to the output of a segmentation network: branches with a wrong diameter, missing
+    # (partially) terminal branches, and small leakages sprouting from random branches
+    out_branches = []
+    for in_branch in in_branches:
+        out_branch = dict(in_branch)
+        out_branch['diameter'] = max(in_branch['diameter'] * np.random.uniform(*RANGE_SCALE_DIAM_PREDICT),
+                                     MIN_DIAM_BRANCH)
+        out_branches.append(out_branch)
+
+        if np.random.uniform() < PROB_LEAKAGE_BRANCH:
+            begin_point_leakage = get_point_inside_segment(in_branch['begin_point'], in_branch['end_point'],
+                                                           np.random.uniform())
+            unit_axis_leakage = np.random.normal(size=3)
+            unit_axis_leakage /= np.linalg.norm(unit_axis_leakage)
+            end_point_leakage = np.clip(np.array(begin_point_leakage) + LENGTH_LEAKAGE * unit_axis_leakage,
+                                        0.0, np.array(image_shape[::-1]) - 1.0)
+            out_branches.append({'begin_point': np.array(begin_point_leakage), 'end_point': end_point_leakage,
+                                 'diameter': DIAM_LEAKAGE, 'generation': -1, 'is_terminal': True})
+    # endfor
+
+    (out_mask, out_cenline) = generate_tree_mask_cenline(image_shape, out_branches)
+
+    # blank the terminal branches from a random position along the branch until the end
+    for in_branch in in_branches:
+        if in_branch['is_terminal'] and np.random.uniform() < PROB_BLANK_TERMINAL_BRANCH:
+            rel_pos_begin_blank = np.random.uniform(0.0, 0.5)
+            begin_point_blank = get_point_inside_segment(in_branch['begin_point'], in_branch['end_point'],
+                                                         rel_pos_begin_blank)
+            point_center_blank = get_point_inside_segment(begin_point_blank, in_branch['end_point'], 0.5)
+            vector_axis_blank = get_vector_two_points(begin_point_blank, in_branch['end_point'])
+            length_blank = get_distance_two_points(begin_point_blank, in_branch['end_point']) \
+                + in_branch['diameter']
+            diam_blank = 2.0 * RANGE_SCALE_DIAM_PREDICT[1] * in_branch['diameter']
+            generate_error_blank_branch_cylinder(out_mask, point_center_blank, vector_axis_blank, diam_blank,
+                                                 length_blank)
+    # endfor
+
+    out_cenline = np.logical_and(out_cenline, out_mask).astype(np.uint8)
+
+    return (out_mask, out_cenline)
+
+
+def compute_metrics_shared_context(list_metrics: Dict[str, MetricBase], in_reference_mask: np.ndarray,
+                                   in_reference_cenline: np.ndarray, in_predicted_mask: np.ndarray,
+                                   in_predicted_cenline: np.ndarray, in_voxel_size: np.ndarray) -> None:
+    # evaluation of all metrics for one case, as in the evaluation scripts, sharing the intermediate data
+    case_context = MetricsCaseContext(in_reference_mask, in_predicted_mask, in_reference_cenline,
+                                      in_predicted_cenline, voxel_size=in_voxel_size)
+    for imetric in list_metrics.values():
+        imetric.compute_case(case_context)
+
+
+def benchmark_function(fun_compute: Callable[[], Any], num_repeats: int) -> Dict[str, float]:
+    # wall times of several runs, and the peak memory allocated (traced) in a separate run, as tracing slows down
+    list_times = []
+    for i in range(num_repeats):
+        start_time = time.perf_counter()
+        fun_compute()
+        list_times.append(time.perf_counter() - start_time)
+    # endfor
+
+    tracemalloc.start()
+    fun_compute()
+    (_, peak_memory) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return OrderedDict([('time_secs_median', float(np.median(list_times))),
+                        ('time_secs_min', float(np.min(list_times))),
+                        ('peak_memory_mbytes', peak_memory / 1024 ** 2)])
+
+
+def get_key_result(in_result: Dict[str, Any]) -> Tuple[Any, ...]:
+    return (in_result['metric'], tuple(in_result['volume_shape']), in_result['num_generations'])
+
+
+def compare_with_baseline(in_results: List[Dict[str, Any]], in_baseline_results: List[Dict[str, Any]],
+                          max_ratio_regression: float, is_compare_shared_context: bool = True
+                          ) -> List[Dict[str, Any]]:
+    dict_baseline_results = dict([(get_key_result(iresult), iresult) for iresult in in_baseline_results])
+
+    out_comparison = []
+    for iresult in in_results:
+        ibaseline = dict_baseline_results.get(get_key_result(iresult))
+        if ibaseline is None:
+            continue
+        if iresult['metric'] == NAME_ALL_METRICS_SHARED_CONTEXT and not is_compare_shared_context:
+            continue
+        ratio_time = iresult['time_secs_median'] / max(ibaseline['time_secs_median'], 1.0e-9)
+        ratio_memory = iresult['peak_memory_mbytes'] / max(ibaseline['peak_memory_mbytes'], 1.0e-9)
+        out_comparison.append(OrderedDict([('metric', iresult['metric']),
+                                           ('volume_shape', iresult['volume_shape']),
+                                           ('num_generations', iresult['num_generations']),
+                                           ('ratio_time', ratio_time),
+                                           ('ratio_memory', ratio_memory),
+                                           ('is_regression', bool(ratio_time > max_ratio_regression
+                                                                  or ratio_memory > max_ratio_regression))]))
+    # endfor
+
+    return out_comparison
+
+
+def main(args):
+
+    list_metrics = OrderedDict()
+    for itype_metric in args.list_type_metrics:
+        list_metrics[itype_metric] = get_metric(itype_metric)
+    # endfor
+
+    in_voxel_size = np.array(args.voxel_size)
+
+    out_results = []
+
+    for isize_volume in args.list_sizes_volume:
+        for inum_generations in args.list_num_generations:
+            # volumes with the shape of CTs: fewer slices than rows and columns
+            in_image_shape = (int(0.75 * isize_volume), isize_volume, isize_volume)
+            print("\nSynthetic airway tree in volume of shape \'%s\', with \'%s\' generations..."
+                  % (str(in_image_shape), inum_generations))
+
+            if args.random_seed is not None:
+                np.random.seed(args.random_seed)
+
+            in_branches = get_tree_branches(in_image_shape[::-1], inum_generations)
+            (in_reference_mask, in_reference_cenline) = generate_tree_mask_cenline(in_image_shape, in_branches)
+            (in_predicted_mask, in_predicted_cenline) = generate_perturbed_prediction(in_image_shape, in_branches)
+
+            info_case = OrderedDict([('volume_shape', list(in_image_shape)),
+                                     ('num_voxels', int(np.prod(in_image_shape))),
+                                     ('num_generations', inum_generations),
+                                     ('num_branches', len(in_branches)),
+                                     ('num_voxels_reference', int(np.count_nonzero(in_reference_mask))),
+                                     ('num_voxels_predicted', int(np.count_nonzero(in_predicted_mask))),
+                                     ('num_cenline_points_reference', int(np.count_nonzero(in_reference_cenline))),
+                                     ('num_cenline_points_predicted', int(np.count_nonzero(in_predicted_cenline)))])
+            print("Num branches: \'%s\', num centreline points (reference): \'%s\'..."
+                  % (info_case['num_branches'], info_case['num_cenline_points_reference']))
+
+            list_benchmarks = OrderedDict()
+            for (itype_metric, imetric) in list_metrics.items():
+                if imetric._is_use_voxelsize:
+                    imetric.set_voxel_size(in_voxel_size)
+                list_benchmarks[itype_metric] = partial(imetric.compute, in_reference_mask, in_predicted_mask,
+                                                        in_reference_cenline, in_predicted_cenline)
+            # endfor
+            list_benchmarks[NAME_ALL_METRICS_SHARED_CONTEXT] = \
+                partial(compute_metrics_shared_context, list_metrics, in_reference_mask, in_reference_cenline,
+                        in_predicted_mask, in_predicted_cenline, in_voxel_size)
+
+            for (iname_benchmark, fun_benchmark) in list_benchmarks.items():
+                out_benchmark = benchmark_function(fun_benchmark, args.num_repeats)
+                print("Metric \'%s\': time %0.4f secs, peak memory %0.2f MB..."
+                      % (iname_benchmark, out_benchmark['time_secs_median'], out_benchmark['peak_memory_mbytes']))
+
+                out_result = OrderedDict([('metric', iname_benchmark)])
+                out_result.update(info_case)
+                out_result.update(out_benchmark)
+                out_results.append(out_result)
+            # endfor
+        # endfor
+    # endfor
+
+    # ---------------
+
+    out_report = OrderedDict()
+    out_report['settings'] = OrderedDict([('list_type_metrics', args.list_type_metrics),
+                                          ('list_sizes_volume', args.list_sizes_volume),
+                                          ('list_num_generations', args.list_num_generations),
+                                          ('voxel_size', args.voxel_size),
+                                          ('num_repeats', args.num_repeats),
+                                          ('random_seed', args.random_seed)])
+    out_report['environment'] = OrderedDict([('python', platform.python_version()),
+                                             ('numpy', np.__version__),
+                                             ('scipy', scipy.__version__),
+                                             ('machine', platform.machine()),
+                                             ('num_cpus', os.cpu_count())])
+    out_report['results'] = out_results
+
+    is_found_regressions = False
+    if args.baseline_file:
+        print("\nCompare with the baseline results in: \'%s\'..." % (basename(args.baseline_file)))
+        with open(args.baseline_file, 'r') as fin:
+            in_baseline_report = json.load(fin)
+
+        # the evaluation of all metrics together is comparable only if the baseline has the same metrics
+        is_same_metrics = in_baseline_report['settings']['list_type_metrics'] == args.list_type_metrics
+        out_report['comparison'] = compare_with_baseline(out_results, in_baseline_report['results'],
+                                                         args.max_ratio_regression, is_same_metrics)
+        for icomparison in out_report['comparison']:
+            print("Metric \'%s\' (shape \'%s\', \'%s\' generations): time x%0.2f, memory x%0.2f%s"
+                  % (icomparison['metric'], str(tuple(icomparison['volume_shape'])),
+                     icomparison['num_generations'], icomparison['ratio_time'], icomparison['ratio_memory'],
+                     ' -> REGRESSION' if icomparison['is_regression'] else ''))
+        # endfor
+        is_found_regressions = any([icomparison['is_regression'] for icomparison in out_report['comparison']])
+
+    print("\nOutput report: \'%s\'..." % (basename(args.output_file)))
+    with open(args.output_file, 'w') as fout:
+        json.dump(out_report, fout, indent=2)
+
+    if is_found_regressions and args.is_fail_regression:
+        print("ERROR: Found performance regressions compared to the baseline (ratio > %s)"
+              % (args.max_ratio_regression))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output_file', type=str, default='./benchmark_metrics.json')
+    parser.add_argument('--baseline_file', type=str, default=None)
+    parser.add_argument('--list_type_metrics', type=str, nargs='*', default=LIST_BENCHMARK_METRICS_DEFAULT)
+    parser.add_argument('--list_sizes_volume', type=int, nargs='*', default=[128, 256])
+    parser.add_argument('--list_num_generations', type=int, nargs='*', default=[4, 7])
+    parser.add_argument('--voxel_size', type=float, nargs=3, default=[0.6, 0.6, 0.6])
+    parser.add_argument('--num_repeats', type=int, default=3)
+    parser.add_argument('--random_seed', type=int, default=2017)
+    parser.add_argument('--max_ratio_regression', type=float, default=1.2)
+    parser.add_argument('--is_fail_regression', type=bool, default=False)
+    args = parser.parse_args()
+
+    print("Print input arguments...")
+    for key, value in sorted(vars(args).items()):
+        print("\'%s\' = %s" % (key, value))
+
+    main(args)
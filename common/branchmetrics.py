@@ -0,0 +1,235 @@
+from typing import List, Tuple, Dict
+from collections import OrderedDict
+import numpy as np
+import hashlib
+import os
+from scipy.ndimage import distance_transform_edt
+
+from common.functionutil import compute_boundbox_mask, compute_boundbox_padded, compute_connected_components
+from common.filereader import CsvFileReader, DICT_FIELD_TYPES_RESULTS_PER_BRANCH, get_image_file_reader
+
+_SIZE_MARGIN_LABEL_MAP = 10         # num. voxels around the reference centrelines to assign to the nearest branch
+_SIZE_CHUNK_DISTS_SEGMENTS = 2 ** 22  # num. elements of the arrays with distances from points to branch segments
+_MAX_NUM_CACHED_LABEL_MAPS = 4      # num. label maps kept in memory (the least recently used are removed first)
+
+
+def compute_nearest_segments_points(in_points: np.ndarray, in_begpoints: np.ndarray, in_endpoints: np.ndarray
+                                    ) -> np.ndarray:
+    # index of the nearest segment (among those between 'in_begpoints' and 'in_endpoints') to each point.
+    # Computed for chunks of points, to bound the size of the arrays with the distances from all points to all segments
+    vector_segments = in_endpoints - in_begpoints
+    norm2_segments = np.sum(vector_segments ** 2, axis=1)
+    norm2_segments = np.where(norm2_segments > 0.0, norm2_segments, 1.0)   # segments of 1 point: rel. position 0
+
+    num_points = len(in_points)
+    num_points_chunk = max(_SIZE_CHUNK_DISTS_SEGMENTS // (3 * max(len(in_begpoints), 1)), 1)
+    out_indexes_nearest = np.empty(num_points, dtype=np.int64)
+
+    for ibeg in range(0, num_points, num_points_chunk):
+        iend = min(ibeg + num_points_chunk, num_points)
+        # relative position of the points to the beginning of the segments, with dims [num_points, num_segments, 3]
+        points_rel2begin = in_points[ibeg:iend, None, :] - in_begpoints[None, :, :]
+
+        # projection of the points on the segments, clipped to the segment ends
+        rel_pos_projection = np.sum(points_rel2begin * vector_segments[None, :, :], axis=2) / norm2_segments
+        rel_pos_projection = np.clip(rel_pos_projection, 0.0, 1.0)
+
+        points_rel2projection = points_rel2begin - rel_pos_projection[:, :, None] * vector_segments[None, :, :]
+        dist2_segments = np.sum(points_rel2projection ** 2, axis=2)
+        out_indexes_nearest[ibeg:iend] = np.argmin(dist2_segments, axis=1)
+    # endfor
+
+    return out_indexes_nearest
+
+
+def compute_branch_label_map(in_reference_cenline: np.ndarray, in_begpoints: np.ndarray, in_endpoints: np.ndarray,
+                             voxel_size: np.ndarray, size_margin: int = _SIZE_MARGIN_LABEL_MAP
+                             ) -> Tuple[np.ndarray, Tuple[Tuple[int, int], ...]]:
+    # label map (label 'i+1' for the branch 'i', 0 for unassigned) in the bounding-box of the reference centrelines,
+    # padded with 'size_margin'. The centreline voxels get the label of the nearest branch segment, and the other
+    # voxels the label of the nearest centreline voxel. Points and voxel size in the axes of the images (z, y, x)
+    in_boundbox = compute_boundbox_mask(in_reference_cenline)
+    if in_boundbox is None:
+        return (np.zeros((0, 0, 0), dtype=np.uint16), ((0, 0), (0, 0), (0, 0)))
+
+    in_boundbox = compute_boundbox_padded(in_boundbox, size_margin, in_reference_cenline.shape)
+    in_cenline_boundbox = in_reference_cenline[tuple([slice(beg, end) for (beg, end) in in_boundbox])] > 0
+
+    offset_boundbox = np.array([beg for (beg, _) in in_boundbox])
+    indexes_cenline = np.argwhere(in_cenline_boundbox)
+    points_cenline = (indexes_cenline + offset_boundbox) * voxel_size
+
+    indexes_nearest_branch = compute_nearest_segments_points(points_cenline, in_begpoints * voxel_size,
+                                                             in_endpoints * voxel_size)
+
+    out_label_map = np.zeros(in_cenline_boundbox.shape, dtype=np.uint16)
+    out_label_map[tuple(indexes_cenline.T)] = indexes_nearest_branch + 1
+
+    # propagate the labels to all voxels from the nearest centreline voxel
+    indexes_nearest_cenline = distance_transform_edt(np.logical_not(in_cenline_boundbox), sampling=voxel_size,
+                                                     return_distances=False, return_indices=True)
+    out_label_map = out_label_map[tuple(indexes_nearest_cenline)]
+
+    return (out_label_map, in_boundbox)
+
+
+class BranchLabelMapCache(object):
+    # label maps of the reference cases, computed once per reference centrelines and branch table, and kept in
+    # memory for the run (the last ones used), and as '.npz' files in 'cache_dir' if set. The cache is invalid if
+    # the input files change
+    _cache_label_maps = OrderedDict()
+    _cache_dir = None
+
+    @classmethod
+    def set_cache_dir(cls, cache_dir: str) -> None:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        cls._cache_dir = cache_dir
+
+    @staticmethod
+    def _get_key_files(list_files: List[str]) -> str:
+        list_keys_files = []
+        for ifile in list_files:
+            file_stat = os.stat(ifile)
+            list_keys_files.append('%s_%d_%d' % (os.path.abspath(ifile), file_stat.st_mtime_ns, file_stat.st_size))
+        return hashlib.sha1('|'.join(list_keys_files).encode()).hexdigest()
+
+    @classmethod
+    def get_label_map(cls, in_reference_cenline_file: str, in_branches_table_file: str
+                      ) -> Tuple[np.ndarray, Tuple[Tuple[int, int], ...]]:
+        file_key = cls._get_key_files([in_reference_cenline_file, in_branches_table_file])
+
+        if file_key in cls._cache_label_maps:
+            cls._cache_label_maps.move_to_end(file_key)
+            return cls._cache_label_maps[file_key]
+
+        cached_label_map_file = os.path.join(cls._cache_dir, file_key + '.npz') if cls._cache_dir else None
+
+        if cached_label_map_file and os.path.exists(cached_label_map_file):
+            with np.load(cached_label_map_file) as in_data:
+                out_label_map = in_data['label_map']
+                out_boundbox = tuple([tuple(elem) for elem in in_data['boundbox'].tolist()])
+        else:
+            in_reference_cenline = get_image_file_reader(in_reference_cenline_file).get_image(
+                in_reference_cenline_file, dtype=np.uint8)
+            # voxel size of the header in (x, y, z) -> same axes as the images (z, y, x)
+            in_voxel_size = np.array(get_image_file_reader(in_reference_cenline_file).get_image_voxelsize(
+                in_reference_cenline_file))[::-1]
+            (in_begpoints, in_endpoints) = get_branches_segments(in_branches_table_file)
+
+            (out_label_map, out_boundbox) = compute_branch_label_map(in_reference_cenline, in_begpoints, in_endpoints,
+                                                                     in_voxel_size)
+            if cached_label_map_file:
+                # write to temporary file and rename, so that a partially written file is never used
+                temp_label_map_file = cached_label_map_file.replace('.npz', '_%d.tmp.npz' % (os.getpid()))
+                np.savez_compressed(temp_label_map_file, label_map=out_label_map, boundbox=np.array(out_boundbox))
+                os.replace(temp_label_map_file, cached_label_map_file)
+
+        cls._cache_label_maps[file_key] = (out_label_map, out_boundbox)
+        if len(cls._cache_label_maps) > _MAX_NUM_CACHED_LABEL_MAPS:
+            cls._cache_label_maps.popitem(last=False)
+
+        return (out_label_map, out_boundbox)
+
+
+def get_branches_segments(in_branches_table_file: str) -> Tuple[np.ndarray, np.ndarray]:
+    # begin / end points of the branches, in the axes of the images (z, y, x)
+    in_branches_data = CsvFileReader.get_data_columns(in_branches_table_file, DICT_FIELD_TYPES_RESULTS_PER_BRANCH)
+    in_begpoints = np.stack([in_branches_data['begPoint_z'], in_branches_data['begPoint_y'],
+                             in_branches_data['begPoint_x']], axis=1).astype(np.float64)
+    in_endpoints = np.stack([in_branches_data['endPoint_z'], in_branches_data['endPoint_y'],
+                             in_branches_data['endPoint_x']], axis=1).astype(np.float64)
+    return (in_begpoints, in_endpoints)
+
+
+def _get_ratio_counts(in_counts_num: np.ndarray, in_counts_den: np.ndarray) -> np.ndarray:
+    # NaN for the branches with empty denominator
+    return np.divide(in_counts_num, in_counts_den, out=np.full(len(in_counts_num), np.nan),
+                     where=(in_counts_den > 0))
+
+
+def compute_counts_per_branch(in_label_map: np.ndarray, in_boundbox_label_map: Tuple[Tuple[int, int], ...],
+                              num_branches: int, target: np.ndarray, target_cenline: np.ndarray, input: np.ndarray,
+                              in_boundbox_images: Tuple[Tuple[int, int], ...] = None) -> Dict[str, np.ndarray]:
+    # voxel counts per branch, each with one 'bincount' of the labels of the voxels in the counted region.
+    # 'in_boundbox_images': bounding-box of the input volumes in the full image, if these are cropped.
+    # Voxels outside the label map are not assigned to any branch (label 0)
+    if in_boundbox_images is None:
+        in_boundbox_images = tuple([(0, size) for size in target.shape])
+
+    in_boundbox_common = tuple([(max(beg_1, beg_2), min(end_1, end_2)) for ((beg_1, end_1), (beg_2, end_2))
+                                in zip(in_boundbox_label_map, in_boundbox_images)])
+    in_boundbox_common = tuple([(beg, max(beg, end)) for (beg, end) in in_boundbox_common])
+
+    slices_label_map = tuple([slice(beg - offset, end - offset) for ((beg, end), (offset, _))
+                              in zip(in_boundbox_common, in_boundbox_label_map)])
+    slices_images = tuple([slice(beg - offset, end - offset) for ((beg, end), (offset, _))
+                           in zip(in_boundbox_common, in_boundbox_images)])
+
+    labels = in_label_map[slices_label_map]
+    is_target = target[slices_images] > 0
+    is_target_cenline = target_cenline[slices_images] > 0
+    is_input = input[slices_images] > 0
+
+    def get_counts_labels(in_region: np.ndarray) -> np.ndarray:
+        return np.bincount(labels[in_region], minlength=num_branches + 1)[1:num_branches + 1]
+
+    is_falseneg_target_cenline = is_target_cenline & ~is_input
+
+    out_counts = OrderedDict()
+    out_counts['num_cenline_voxels'] = get_counts_labels(is_target_cenline)
+    out_counts['num_tp_cenline_voxels'] = get_counts_labels(is_target_cenline & is_input)
+    out_counts['num_fn_cenline_voxels'] = get_counts_labels(is_falseneg_target_cenline)
+    out_counts['num_target_voxels'] = get_counts_labels(is_target)
+    out_counts['num_leakage_voxels'] = get_counts_labels(is_input & ~is_target)
+
+    # FN errors: connected regions of FN centreline voxels, counted in each branch they go through
+    (falseneg_regions, _) = compute_connected_components(is_falseneg_target_cenline.astype(np.int32),
+                                                         connectivity_dim=3)
+    pairs_region_label = np.unique(falseneg_regions[is_falseneg_target_cenline].astype(np.int64) * (num_branches + 1)
+                                   + labels[is_falseneg_target_cenline])
+    out_counts['num_fn_err'] = np.bincount(pairs_region_label % (num_branches + 1),
+                                           minlength=num_branches + 1)[1:num_branches + 1]
+    return out_counts
+
+
+def compute_metrics_from_counts(in_counts: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    out_metrics = OrderedDict()
+    out_metrics['completeness'] = _get_ratio_counts(in_counts['num_tp_cenline_voxels'], in_counts['num_cenline_voxels'])
+    out_metrics['volume_leakage'] = _get_ratio_counts(in_counts['num_leakage_voxels'], in_counts['num_target_voxels'])
+    out_metrics['num_fn_cenline_voxels'] = in_counts['num_fn_cenline_voxels']
+    out_metrics['num_fn_err'] = in_counts['num_fn_err']
+    return out_metrics
+
+
+def compute_counts_per_generation(in_counts_branches: Dict[str, np.ndarray], in_generation_branches: np.ndarray
+                                  ) -> Tuple[np.ndarray, np.ndarray, Dict[str, np.ndarray]]:
+    # sum of the counts of the branches in each generation
+    in_generation_branches = np.asarray(in_generation_branches, dtype=np.int64)
+    out_generations = np.unique(in_generation_branches)
+    indexes_generation = np.searchsorted(out_generations, in_generation_branches)
+    out_num_branches = np.bincount(indexes_generation, minlength=len(out_generations))
+
+    out_counts = OrderedDict()
+    for (icount_name, icounts) in in_counts_branches.items():
+        out_counts[icount_name] = np.bincount(indexes_generation, weights=icounts,
+                                              minlength=len(out_generations)).astype(np.int64)
+    return (out_generations, out_num_branches, out_counts)
+
+
+def write_metrics_per_branch(output_file: str, in_airway_id_branches: np.ndarray,
+                             in_generation_branches: np.ndarray, in_metrics_branches: Dict[str, np.ndarray]) -> None:
+    out_dict_data = OrderedDict()
+    out_dict_data['airway_ID'] = in_airway_id_branches
+    out_dict_data['generation'] = in_generation_branches
+    out_dict_data.update(in_metrics_branches)
+    CsvFileReader.write_data(output_file, out_dict_data, ['%d', '%d', '%0.6f', '%0.6f', '%d', '%d'])
+
+
+def write_metrics_per_generation(output_file: str, in_generations: np.ndarray, in_num_branches: np.ndarray,
+                                 in_metrics_generations: Dict[str, np.ndarray]) -> None:
+    out_dict_data = OrderedDict()
+    out_dict_data['generation'] = in_generations
+    out_dict_data['num_branches'] = in_num_branches
+    out_dict_data.update(in_metrics_generations)
+    CsvFileReader.write_data(output_file, out_dict_data, ['%d', '%d', '%0.6f', '%0.6f', '%d', '%d'])
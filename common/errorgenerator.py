@@ -85,25 +85,24 @@ def generate_error_blank_branch_sphere(inout_mask: np.ndarray,
     return inout_mask
 
 
-def generate_error_blank_branch_cylinder(inout_mask: np.ndarray,
-                                         point_center: Tuple[float, float, float],
-                                         vector_axis: Tuple[float, float, float],
-                                         diam_base: float,
-                                         length_axis: float
-                                         ) -> np.ndarray:
+def _get_indexes_inside_cylinder(point_center: Tuple[float, float, float],
+                                 vector_axis: Tuple[float, float, float],
+                                 diam_base: float,
+                                 length_axis: float,
+                                 image_size: Tuple[float, float, float]
+                                 ) -> np.ndarray:
     norm_vector_axis = np.sqrt(np.dot(vector_axis, vector_axis))
     unit_vector_axis = np.array(vector_axis) / norm_vector_axis
     radius_base = diam_base / 2.0
     half_length_axis = length_axis / 2.0
-    image_size = inout_mask.shape[::-1] # get correct format (dx, dy, dz)
 
-    # candidates: subset of all possible indexes where to check condition for blank shape -> to save time
+    # candidates: subset of all possible indexes where to check condition for cylinder shape -> to save time
     dist_corner_2center = np.sqrt(radius_base ** 2 + half_length_axis ** 2)
-    indexes_candits_inside_blank = _get_indexes_canditate_inside_blank(point_center, dist_corner_2center, image_size)
+    indexes_candits_inside = _get_indexes_canditate_inside_blank(point_center, dist_corner_2center, image_size)
     # array of indexes, with dims [num_indexes_x, num_indexes_y, num_indexes_z, 3]
 
     # relative position of candidate indexes to center
-    points_rel2center_candits_inside = indexes_candits_inside_blank - point_center
+    points_rel2center_candits_inside = indexes_candits_inside - point_center
 
     # distance to center, parallel to axis -> dot product of distance vectors with 'vector_axis'
     dist_rel2center_parall_axis_candits = np.dot(points_rel2center_candits_inside, unit_vector_axis)
@@ -114,16 +113,65 @@ def generate_error_blank_branch_cylinder(inout_mask: np.ndarray,
 
     # conditions for cylinder: 1) distance to center, parallel to axis, is less than 'half_length_axis'
     #                          2) distance to center, perpendicular to axis, is less than 'radius_base'
-    is_indexes_inside_blank_cond1 = np.abs(dist_rel2center_parall_axis_candits) <= half_length_axis
-    is_indexes_inside_blank_cond2 = np.abs(dist_rel2center_perpen_axis_candits) <= radius_base
+    is_indexes_inside_cond1 = np.abs(dist_rel2center_parall_axis_candits) <= half_length_axis
+    is_indexes_inside_cond2 = np.abs(dist_rel2center_perpen_axis_candits) <= radius_base
 
-    is_indexes_inside_blank = np.logical_and(is_indexes_inside_blank_cond1, is_indexes_inside_blank_cond2)
-    # array of ['True', 'False'], with 'True' for indexes that are inside the blank
+    is_indexes_inside = np.logical_and(is_indexes_inside_cond1, is_indexes_inside_cond2)
+    # array of ['True', 'False'], with 'True' for indexes that are inside the cylinder
+
+    return indexes_candits_inside[is_indexes_inside]
 
-    indexes_inside_blank = indexes_candits_inside_blank[is_indexes_inside_blank]
+
+def generate_error_blank_branch_cylinder(inout_mask: np.ndarray,
+                                         point_center: Tuple[float, float, float],
+                                         vector_axis: Tuple[float, float, float],
+                                         diam_base: float,
+                                         length_axis: float
+                                         ) -> np.ndarray:
+    image_size = inout_mask.shape[::-1] # get correct format (dx, dy, dz)
+
+    indexes_inside_blank = _get_indexes_inside_cylinder(point_center, vector_axis, diam_base, length_axis, image_size)
 
     # blank error: set '0' to voxels for indexes inside the blank
     (indexes_x_in, indexes_y_in, indexes_z_in) = np.transpose(indexes_inside_blank)
     inout_mask[indexes_z_in, indexes_y_in, indexes_x_in] = 0
 
     return inout_mask
+
+
+def generate_branch_cylinder(inout_mask: np.ndarray,
+                             point_center: Tuple[float, float, float],
+                             vector_axis: Tuple[float, float, float],
+                             diam_base: float,
+                             length_axis: float
+                             ) -> np.ndarray:
+    # rasterize a cylindrical branch: set '1' to voxels inside the cylinder (the opposite of the blank errors)
+    image_size = inout_mask.shape[::-1]  # get correct format (dx, dy, dz)
+
+    indexes_inside_branch = _get_indexes_inside_cylinder(point_center, vector_axis, diam_base, length_axis, image_size)
+
+    (indexes_x_in, indexes_y_in, indexes_z_in) = np.transpose(indexes_inside_branch)
+    inout_mask[indexes_z_in, indexes_y_in, indexes_x_in] = 1
+
+    return inout_mask
+
+
+def generate_branch_segment(inout_mask: np.ndarray,
+                            begin_point: Tuple[float, float, float],
+                            end_point: Tuple[float, float, float]
+                            ) -> np.ndarray:
+    # rasterize the axis of a branch (centreline): set '1' to voxels along the segment, sampled every half voxel
+    image_size = inout_mask.shape[::-1]  # get correct format (dx, dy, dz)
+
+    num_points_segm = int(np.ceil(2.0 * get_distance_two_points(begin_point, end_point))) + 1
+    rel_dists_segm = np.linspace(0.0, 1.0, num_points_segm)
+    points_segment = np.array(begin_point) + np.outer(rel_dists_segm, get_vector_two_points(begin_point, end_point))
+
+    indexes_segment = np.round(points_segment).astype(int)
+    is_indexes_inside = np.all((indexes_segment >= 0) & (indexes_segment < np.array(image_size)), axis=1)
+    indexes_segment = indexes_segment[is_indexes_inside]
+
+    (indexes_x_in, indexes_y_in, indexes_z_in) = np.transpose(indexes_segment)
+    inout_mask[indexes_z_in, indexes_y_in, indexes_x_in] = 1
+
+    return inout_mask
@@ -1,37 +1,536 @@
 
-from typing import List, Tuple, Dict, Any
+from typing import List, Tuple, Dict, Union, Any, Iterator
 from collections import OrderedDict
 import numpy as np
 import nibabel as nib
+import contextlib
 import csv
+import glob
+import hashlib
+import io
+import itertools
+import os
+import queue
+import shutil
+import sys
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from common.functionutil import handle_error_message
+
+_COMPRESS_LEVEL_DEFAULT = 1     # same as default in nibabel
+_SIZE_BLOCK_GZIP = 4 * 1024 ** 2
+_SIZE_CHUNK_ROWS_CSV = 10000
+_VERSION_CACHED_TABLES = 2      # increase when the format of the cached tables changes, to discard the old ones
 
 
 class NiftiFileReader(object):
+    _cache_header_info = {}
+    _cache_images_dir = None
+    _cache_images_max_bytes = None
 
-    @staticmethod
-    def get_image_voxelsize(filename: str) -> Tuple[float, float, float]:
-        affine = nib.load(filename).affine
-        return tuple(np.abs(np.diag(affine)[:3]))
+    @classmethod
+    def set_cache_images(cls, cache_dir: str, max_bytes: int = None) -> None:
+        # local cache of uncompressed copies of the volumes, to be loaded with memory-mapping
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        cls._cache_images_dir = cache_dir
+        cls._cache_images_max_bytes = max_bytes
 
     @classmethod
-    def get_image_size(cls, filename: str) -> Tuple[float, float, float]:
-        return cls.get_image(filename).shape
+    def _get_image_header_info(cls, filename: str) -> Dict[str, Any]:
+        # parse the header only once per run, and refresh it only if the file has changed on disk
+        file_stat = os.stat(filename)
+        file_key = os.path.abspath(filename)
+        file_stamp = (file_stat.st_mtime_ns, file_stat.st_size)
 
-    @staticmethod
-    def get_image_metadata_info(filename: str) -> Any:
-        return nib.load(filename).affine
+        header_info = cls._cache_header_info.get(file_key)
+        if header_info is None or header_info['stamp'] != file_stamp:
+            # 'nib.load' is lazy: it reads the header, but not the voxel data
+            nib_image = nib.load(filename)
+            image_shape = list(nib_image.shape)
+            image_shape[0], image_shape[2] = image_shape[2], image_shape[0]  # same axes as output of 'get_image'
+
+            header_info = {'stamp': file_stamp,
+                           'shape': tuple(image_shape),
+                           'voxel_size': tuple(np.abs(np.diag(nib_image.affine)[:3])),
+                           'affine': nib_image.affine,
+                           'dtype': nib_image.get_data_dtype()}
+            cls._cache_header_info[file_key] = header_info
+
+        return header_info
+
+    @classmethod
+    def get_image_voxelsize(cls, filename: str) -> Tuple[float, float, float]:
+        return cls._get_image_header_info(filename)['voxel_size']
+
+    @classmethod
+    def get_image_size(cls, filename: str) -> Tuple[int, int, int]:
+        return cls._get_image_header_info(filename)['shape']
+
+    @classmethod
+    def get_image_dtype(cls, filename: str) -> np.dtype:
+        return cls._get_image_header_info(filename)['dtype']
+
+    @classmethod
+    def get_image_metadata_info(cls, filename: str) -> Any:
+        return cls._get_image_header_info(filename)['affine'].copy()
+
+    @classmethod
+    def get_image_memory_size(cls, filename: str, dtype: Union[str, np.dtype] = None) -> int:
+        # memory (in bytes) of the image when loaded, with the data type stored in file or the input 'dtype'
+        header_info = cls._get_image_header_info(filename)
+        itemsize = np.dtype(dtype).itemsize if dtype is not None else header_info['dtype'].itemsize
+        return int(np.prod(header_info['shape'])) * itemsize
+
+    @classmethod
+    def _get_cached_image_file(cls, filename: str) -> str:
+        # key of cached file: source path, mtime and size -> the cached copy is invalid if the source changes
+        file_stat = os.stat(filename)
+        file_key = '%s_%d_%d' % (os.path.abspath(filename), file_stat.st_mtime_ns, file_stat.st_size)
+        cached_image_file = os.path.join(cls._cache_images_dir, hashlib.sha1(file_key.encode()).hexdigest() + '.nii')
+
+        try:
+            # update the modification time, used as last access time for the LRU eviction
+            os.utime(cached_image_file)
+        except FileNotFoundError:
+            # not cached yet, or removed meanwhile by the eviction in another thread or process. Write to temporary
+            # file and rename, so that a partially written file is never used
+            temp_image_file = cached_image_file.replace('.nii', '_%d_%d.tmp.nii' % (os.getpid(), threading.get_ident()))
+            nib.save(nib.load(filename), temp_image_file)
+            os.replace(temp_image_file, cached_image_file)
+            cls._evict_cached_images(keep_file=cached_image_file)
+
+        return cached_image_file
+
+    @classmethod
+    def _evict_cached_images(cls, keep_file: str) -> None:
+        if cls._cache_images_max_bytes is None:
+            return
+
+        # the cache dir is shared by the threads and processes loading the cases, that can evict files concurrently:
+        # the files removed meanwhile are skipped
+        list_cached_files = []
+        for ifile in glob.glob(os.path.join(cls._cache_images_dir, '*.nii')):
+            if ifile.endswith('.tmp.nii'):
+                continue
+            try:
+                list_cached_files.append((os.stat(ifile), ifile))
+            except FileNotFoundError:
+                pass
+        # endfor
+        list_cached_files = sorted(list_cached_files, key=lambda elem: elem[0].st_mtime)  # least recently used first
+
+        total_bytes = sum([istat.st_size for (istat, _) in list_cached_files])
+        for (istat, ifile) in list_cached_files:
+            if total_bytes <= cls._cache_images_max_bytes:
+                break
+            if ifile == keep_file:
+                continue
+            try:
+                os.remove(ifile)    # files already memory-mapped remain valid until closed
+            except FileNotFoundError:
+                pass
+            total_bytes -= istat.st_size
+
+    @classmethod
+    @contextlib.contextmanager
+    def _open_nib_image(cls, filename: str, is_cache: bool = False) -> Iterator[nib.Nifti1Image]:
+        # the image data should be read (or memory-mapped) inside the 'with' block: the cached file is closed at exit
+        if is_cache and cls._cache_images_dir is not None:
+            # memory-map the uncompressed copy (copy-on-write: changes to the array do not modify the cached file)
+            cached_image_file = cls._get_cached_image_file(filename)
+            try:
+                # open the file now: once open, it remains valid if removed by the eviction in another thread
+                # or process (the image data is read lazily, from this file object). The memory-mapped arrays
+                # remain valid after the file is closed
+                cached_image_fileobj = open(cached_image_file, 'rb')
+            except FileNotFoundError:
+                # removed before it is opened: load the source file
+                yield nib.load(filename)
+                return
+            with cached_image_fileobj:
+                file_holder = nib.FileHolder(filename=cached_image_file, fileobj=cached_image_fileobj)
+                yield nib.Nifti1Image.from_file_map({'header': file_holder, 'image': file_holder}, mmap='c')
+        else:
+            yield nib.load(filename)
 
     @staticmethod
-    def get_image(filename: str) -> np.ndarray:
-        out_image = nib.load(filename).get_data()
+    def _get_slices_boundbox(boundbox: Tuple[Tuple[int, int], Tuple[int, int], Tuple[int, int]]
+                             ) -> Tuple[slice, slice, slice]:
+        # input bounding-box in the axes convention of this project: ((z_beg, z_end), (y_beg, y_end), (x_beg, x_end))
+        # output slices in the axes stored in file: (x, y, z)
+        ((z_beg, z_end), (y_beg, y_end), (x_beg, x_end)) = boundbox
+        return (slice(x_beg, x_end), slice(y_beg, y_end), slice(z_beg, z_end))
+
+    @classmethod
+    def get_image(cls, filename: str, dtype: Union[str, np.dtype] = None, axis_order: str = 'zyx',
+                  is_cache: bool = False) -> np.ndarray:
+        # 'dtype': None to keep the data type stored in file, or the output data type (e.g. 'uint8' for binary masks)
+        # 'axis_order': 'zyx' for the axes convention used in this project, 'xyz' for the axes stored in file
+        if axis_order not in ('zyx', 'xyz'):
+            message = 'Axis order not valid: \'%s\'. Options available: \'zyx\', \'xyz\'' % (axis_order)
+            handle_error_message(message)
+
+        with cls._open_nib_image(filename, is_cache) as nib_image:
+            if dtype is not None and np.dtype(dtype).kind == 'f':
+                # apply the scaling in the header (if any) directly in the requested float type, no float64 temporary
+                out_image = nib_image.get_fdata(dtype=dtype)
+            else:
+                # data type stored in file (or float, if the header has scaling), with no promotion to float64
+                out_image = np.asanyarray(nib_image.dataobj)
+                if dtype is not None:
+                    out_image = out_image.astype(dtype, copy=False)
+
+        if axis_order == 'zyx':
+            # reversing the axes of the data stored in file (fortran order) gives an array in C order, with no copy
+            out_image = np.swapaxes(out_image, 0, 2)
+        return out_image
+
+    @classmethod
+    def get_image_region(cls, filename: str, boundbox: Tuple[Tuple[int, int], Tuple[int, int], Tuple[int, int]],
+                         dtype: Union[str, np.dtype] = None, is_cache: bool = False) -> np.ndarray:
+        # read only the sub-volume inside the bounding-box: for uncompressed (or cached) files, the array proxy reads
+        # only the bytes for the region. For compressed files, the file is decompressed up to the end of the region,
+        # but the memory used still scales with the region size
+        with cls._open_nib_image(filename, is_cache) as nib_image:
+            out_image = np.asanyarray(nib_image.dataobj[cls._get_slices_boundbox(boundbox)])
+        if dtype is not None:
+            out_image = out_image.astype(dtype, copy=False)
         return np.swapaxes(out_image, 0, 2)
 
+    @classmethod
+    def write_image_region(cls, filename: str, in_image: np.ndarray,
+                           boundbox: Tuple[Tuple[int, int], Tuple[int, int], Tuple[int, int]], **kwargs) -> None:
+        # write the input image inside the bounding-box of the (larger) volume in an existing file
+        slices_boundbox = cls._get_slices_boundbox(boundbox)
+        in_image = np.swapaxes(in_image, 0, 2)
+
+        nib_image = nib.load(filename)
+        # the scaling of the data in file is in the data proxy (when loading, nibabel resets it in the header)
+        (slope, inter) = (nib_image.dataobj.slope, nib_image.dataobj.inter)
+        is_no_scaling = slope == 1.0 and inter == 0.0
+
+        if not filename.endswith('.gz') and is_no_scaling:
+            # uncompressed file: write the region in place, through the memory-mapped data
+            inout_image = np.memmap(filename, dtype=nib_image.get_data_dtype(), mode='r+',
+                                    offset=nib_image.dataobj.offset, shape=nib_image.shape, order='F')
+            inout_image[slices_boundbox] = in_image
+            inout_image.flush()
+            del inout_image
+            os.utime(filename)  # make sure the mtime changes, so that the cached copies of this file are invalid
+        else:
+            # compressed or scaled file: rewrite the whole file with the same header (data type, scaling, qform /
+            # sform codes and extensions), and the data with the region replaced, stored with the same scaling
+            compress_level = kwargs['compress_level'] if 'compress_level' in kwargs.keys() else None
+            num_threads = kwargs['num_threads'] if 'num_threads' in kwargs.keys() else 1
+
+            inout_image = np.asanyarray(nib_image.dataobj).copy()
+            inout_image[slices_boundbox] = in_image
+
+            out_header = nib_image.header.copy()
+            if not is_no_scaling:
+                out_header.set_slope_inter(slope, inter)
+            out_fileobj = io.BytesIO()
+            out_header.write_to(out_fileobj)
+            nib.volumeutils.array_to_file(inout_image, out_fileobj, out_header.get_data_dtype(),
+                                          offset=out_header.get_data_offset(), intercept=inter, divslope=slope,
+                                          order='F', nan2zero=False)
+            del inout_image
+
+            if filename.endswith('.gz'):
+                if compress_level is None:
+                    compress_level = _COMPRESS_LEVEL_DEFAULT
+                list_compressed_blocks = cls._compress_gzip_blocks(out_fileobj.getbuffer(), compress_level,
+                                                                   num_threads)
+                with open(filename, 'wb') as fout:
+                    for iblock in list_compressed_blocks:
+                        fout.write(iblock)
+            else:
+                with open(filename, 'wb') as fout:
+                    fout.write(out_fileobj.getbuffer())
+
     @staticmethod
-    def write_image(filename: str, in_image: np.ndarray, **kwargs) -> None:
+    def _compress_gzip_blocks(in_data: bytes, compress_level: int, num_threads: int) -> List[bytes]:
+        # compress independent blocks in parallel (zlib releases the GIL): the concatenation of gzip members
+        # is a valid gzip file. Compression level 0 stores the data uncompressed
+        def compress_block(in_block: memoryview) -> bytes:
+            compressor = zlib.compressobj(compress_level, zlib.DEFLATED, 31)    # 'wbits=31': gzip header / trailer
+            return compressor.compress(in_block) + compressor.flush()
+
+        in_data = memoryview(in_data)
+        list_blocks = [in_data[i:i + _SIZE_BLOCK_GZIP] for i in range(0, len(in_data), _SIZE_BLOCK_GZIP)]
+
+        if num_threads > 1:
+            with ThreadPoolExecutor(max_workers=num_threads) as executor:
+                return list(executor.map(compress_block, list_blocks))
+        else:
+            return [compress_block(iblock) for iblock in list_blocks]
+
+    @classmethod
+    def write_image(cls, filename: str, in_image: np.ndarray, **kwargs) -> None:
         affine = kwargs['metadata'] if 'metadata' in kwargs.keys() else None
+        compress_level = kwargs['compress_level'] if 'compress_level' in kwargs.keys() else None
+        num_threads = kwargs['num_threads'] if 'num_threads' in kwargs.keys() else 1
+
         in_image = np.swapaxes(in_image, 0, 2)
         nib_image = nib.Nifti1Image(in_image, affine)
-        nib.save(nib_image, filename)
+
+        if filename.endswith('.gz') and (compress_level is not None or num_threads > 1):
+            if compress_level is None:
+                compress_level = _COMPRESS_LEVEL_DEFAULT
+            list_compressed_blocks = cls._compress_gzip_blocks(nib_image.to_bytes(), compress_level, num_threads)
+            with open(filename, 'wb') as fout:
+                for iblock in list_compressed_blocks:
+                    fout.write(iblock)
+        else:
+            nib.save(nib_image, filename)
+
+
+class NiftiFileWriter(object):
+    # writes the images in a background thread, so that the caller can continue while the outputs are compressed
+    # and flushed. The queue of pending images is bounded, to limit the memory used. Use it as a context manager
+    # ('with NiftiFileWriter(...) as nifti_writer:'), so that the pending images are written even if the caller
+    # raises an error. Failures are reported in 'close', with a non-zero exit status
+
+    def __init__(self, compress_level: int = None, num_threads: int = 1,
+                 is_background: bool = True, max_queue_size: int = 2) -> None:
+        self._kwargs_write = {'compress_level': compress_level, 'num_threads': num_threads}
+        self._is_background = is_background
+        self._list_write_errors = []
+
+        if self._is_background:
+            self._queue_write = queue.Queue(maxsize=max_queue_size)
+            self._thread_write = threading.Thread(target=self._run_write_queue, daemon=True)
+            self._thread_write.start()
+
+    def __enter__(self) -> 'NiftiFileWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            # error in the caller: write the images queued so far, but let the error propagate
+            self._wait_pending_writes()
+            if self._list_write_errors:
+                print("ERROR: Failed to write the output files: \'%s\'..." % ('\', \''.join(self._list_write_errors)))
+                self._list_write_errors = []
+
+    def _write_image(self, filename: str, in_image: np.ndarray, **kwargs) -> None:
+        try:
+            NiftiFileReader.write_image(filename, in_image, **dict(self._kwargs_write, **kwargs))
+        except Exception as excp:
+            print("ERROR: failed to write \'%s\': %s..." % (filename, excp))
+            self._list_write_errors.append(filename)
+
+    def _run_write_queue(self) -> None:
+        while True:
+            in_write_args = self._queue_write.get()
+            if in_write_args is None:
+                break
+            (filename, in_image, kwargs) = in_write_args
+            self._write_image(filename, in_image, **kwargs)
+
+    def write_image(self, filename: str, in_image: np.ndarray, **kwargs) -> None:
+        # IMPORTANT: with background write, the input image should not be modified after calling this
+        if self._is_background:
+            self._queue_write.put((filename, in_image, kwargs))    # wait here if the queue is full
+        else:
+            self._write_image(filename, in_image, **kwargs)
+
+    def _wait_pending_writes(self) -> None:
+        if self._is_background and self._thread_write.is_alive():
+            self._queue_write.put(None)
+            self._thread_write.join()
+
+    def close(self) -> None:
+        self._wait_pending_writes()
+
+        if self._list_write_errors:
+            message = 'Failed to write the output files: \'%s\'' % ('\', \''.join(self._list_write_errors))
+            self._list_write_errors = []
+            # exit with error status (unlike 'handle_error_message'), so that the lost outputs can be detected
+            print("ERROR: %s... EXIT" % (message))
+            sys.exit(1)
+
+
+class SparseMaskFileReader(object):
+    # compact storage for binary masks and centrelines, in numpy '.npz' files, with the formats:
+    # 'coords': list of coordinates (z, y, x) of the foreground voxels (for centrelines, mostly empty)
+    # 'packbits': voxels packed into bits
+    # 'rle': run-length encoding (start, length) of the foreground voxels, in the flattened volume
+    _list_avail_formats = ['coords', 'packbits', 'rle']
+
+    @staticmethod
+    def _get_data_file(filename: str) -> Dict[str, np.ndarray]:
+        with np.load(filename) as in_data_file:
+            return dict(in_data_file.items())
+
+    @classmethod
+    def get_image_voxelsize(cls, filename: str) -> Tuple[float, float, float]:
+        affine = cls._get_data_file(filename)['affine']
+        return tuple(np.abs(np.diag(affine)[:3]))
+
+    @classmethod
+    def get_image_size(cls, filename: str) -> Tuple[int, int, int]:
+        return tuple(cls._get_data_file(filename)['shape'])
+
+    @classmethod
+    def get_image_metadata_info(cls, filename: str) -> Any:
+        return cls._get_data_file(filename)['affine']
+
+    @classmethod
+    def get_image_coords(cls, filename: str) -> np.ndarray:
+        # coordinates (z, y, x) of the foreground voxels, without building the dense volume (for 'coords' format)
+        in_data_file = cls._get_data_file(filename)
+        if str(in_data_file['format']) == 'coords':
+            return in_data_file['coords'].astype(np.int64)
+        else:
+            return np.argwhere(cls._get_dense_image(in_data_file))
+
+    @staticmethod
+    def _get_dense_image(in_data_file: Dict[str, np.ndarray]) -> np.ndarray:
+        image_shape = tuple(in_data_file['shape'])
+        format_file = str(in_data_file['format'])
+
+        out_image = np.zeros(image_shape, dtype=np.dtype(str(in_data_file['dtype'])))
+        out_image_flat = out_image.reshape(-1)
+
+        if format_file == 'coords':
+            out_image[tuple(np.transpose(in_data_file['coords']))] = in_data_file['values']
+        elif format_file == 'packbits':
+            is_voxels_fg = np.unpackbits(in_data_file['packbits'], count=out_image.size).astype(bool)
+            out_image_flat[is_voxels_fg] = in_data_file['values']
+        elif format_file == 'rle':
+            # set the values of the runs by the cumulative sum of +1 / -1 at the start / end of the runs
+            in_starts_runs = in_data_file['starts']
+            in_ends_runs = in_starts_runs + in_data_file['lengths']
+            marks_runs = np.zeros(out_image.size + 1, dtype=np.int8)
+            marks_runs[in_starts_runs] = 1
+            marks_runs[in_ends_runs] -= 1
+            is_voxels_fg = np.cumsum(marks_runs[:-1], dtype=np.int8).astype(bool)
+            out_image_flat[is_voxels_fg] = in_data_file['values']
+        return out_image
+
+    @classmethod
+    def get_image(cls, filename: str, dtype: Union[str, np.dtype] = None, axis_order: str = 'zyx',
+                  is_cache: bool = False) -> np.ndarray:
+        # same interface as 'NiftiFileReader.get_image' ('is_cache' not used: the sparse files are small)
+        out_image = cls._get_dense_image(cls._get_data_file(filename))
+        if dtype is not None:
+            out_image = out_image.astype(dtype, copy=False)
+        if axis_order == 'xyz':
+            out_image = np.swapaxes(out_image, 0, 2)
+        return out_image
+
+    @classmethod
+    def write_image(cls, filename: str, in_image: np.ndarray, **kwargs) -> None:
+        affine = kwargs['metadata'] if 'metadata' in kwargs.keys() else np.eye(4)
+        format_file = kwargs['format'] if 'format' in kwargs.keys() else 'coords'
+
+        out_data_file = {'format': format_file,
+                         'shape': np.array(in_image.shape),
+                         'dtype': in_image.dtype.str,
+                         'affine': affine}
+
+        if format_file == 'coords':
+            out_coords = np.argwhere(in_image)
+            out_data_file['coords'] = out_coords.astype(np.uint16 if np.max(in_image.shape) <= 2 ** 16 else np.int64)
+            out_values = in_image[tuple(np.transpose(out_coords))]
+        else:
+            in_image_flat = in_image.reshape(-1)
+            is_voxels_fg = in_image_flat != 0
+            out_values = in_image_flat[is_voxels_fg]
+
+            if format_file == 'packbits':
+                out_data_file['packbits'] = np.packbits(is_voxels_fg)
+            elif format_file == 'rle':
+                # starts and ends of runs: where the foreground mask changes value
+                diff_voxels_fg = np.diff(np.concatenate([[0], is_voxels_fg.astype(np.int8), [0]]))
+                in_starts_runs = np.flatnonzero(diff_voxels_fg == 1)
+                in_ends_runs = np.flatnonzero(diff_voxels_fg == -1)
+                out_data_file['starts'] = in_starts_runs
+                out_data_file['lengths'] = in_ends_runs - in_starts_runs
+            else:
+                message = 'Format for sparse file not valid: \'%s\'. Formats available: \'%s\'' \
+                          % (format_file, ', '.join(cls._list_avail_formats))
+                handle_error_message(message)
+
+        # for binary masks store a single value (the foreground label), otherwise all the foreground values
+        if out_values.size > 0 and np.all(out_values == out_values[0]):
+            out_values = out_values[:1]
+        out_data_file['values'] = out_values
+
+        np.savez_compressed(filename, **out_data_file)
+
+
+def get_image_file_reader(filename: str) -> Union[NiftiFileReader, SparseMaskFileReader]:
+    if filename.endswith('.npz'):
+        return SparseMaskFileReader
+    else:
+        return NiftiFileReader
+
+
+# data types of the fields in the tables of airway measurements '*_ResultsPerBranch.csv'
+DICT_FIELD_TYPES_RESULTS_PER_BRANCH = OrderedDict([('Patient_ID', 'string'),
+                                                   ('airway_ID', 'integer'),
+                                                   ('midPoint_x', 'float'),
+                                                   ('midPoint_y', 'float'),
+                                                   ('midPoint_z', 'float'),
+                                                   ('d_inner_global', 'float'),
+                                                   ('d_outer_global', 'float'),
+                                                   ('airway_length', 'float'),
+                                                   ('generation', 'integer'),
+                                                   ('parent_ID', 'integer'),
+                                                   ('childrenID', 'group_integer'),
+                                                   ('begPoint_x', 'float'),
+                                                   ('begPoint_y', 'float'),
+                                                   ('begPoint_z', 'float'),
+                                                   ('endPoint_x', 'float'),
+                                                   ('endPoint_y', 'float'),
+                                                   ('endPoint_z', 'float')])
+
+
+class RaggedIntegerArray(object):
+    # groups of integers of variable length (e.g. the children IDs of each branch), stored as the flat array
+    # of all values and the offsets of each group: group 'i' is 'values[offsets[i]:offsets[i + 1]]'. The groups
+    # with missing values ('NaN' in the input files) have no elements, and are marked in 'is_missing', to tell
+    # them apart from the empty groups
+
+    def __init__(self, values: np.ndarray, offsets: np.ndarray, is_missing: np.ndarray = None) -> None:
+        self.values = values
+        self.offsets = offsets
+        self.is_missing = is_missing if is_missing is not None else np.zeros(len(offsets) - 1, dtype=bool)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: Union[int, np.ndarray]) -> Union[np.ndarray, 'RaggedIntegerArray']:
+        if np.ndim(index) == 0:
+            return self.values[self.offsets[index]:self.offsets[index + 1]]
+        else:
+            # subset of groups, for an array of indexes or boolean mask
+            index = np.arange(len(self))[index]
+            in_lengths = self.get_lengths()[index]
+            out_offsets = np.concatenate([[0], np.cumsum(in_lengths)]).astype(np.int64)
+            if len(in_lengths) > 0:
+                # indexes of values of the selected groups: start of each group plus position within group
+                indexes_values = np.repeat(self.offsets[index] - out_offsets[:-1], in_lengths) \
+                    + np.arange(out_offsets[-1])
+            else:
+                indexes_values = np.array([], dtype=np.int64)
+            return RaggedIntegerArray(self.values[indexes_values], out_offsets, self.is_missing[index])
+
+    def get_lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def get_strings(self) -> np.ndarray:
+        # same format as in the input files: integers separated by spaces, empty for groups with no elements, and
+        # 'nan' for groups with missing values
+        return np.array(['nan' if self.is_missing[i] else ' '.join([str(elem) for elem in self[i]])
+                         for i in range(len(self))])
 
 
 class CsvFileReader(object):
@@ -91,6 +590,189 @@ class CsvFileReader(object):
 
         return out_dict_data
 
+    @staticmethod
+    def _get_data_type_column(in_column_str: np.ndarray) -> str:
+        # infer the data type from the whole column: try the stricter types first
+        for (in_data_type, in_dtype) in [('integer', np.int64), ('float', np.float64)]:
+            try:
+                in_column_str.astype(in_dtype)
+                return in_data_type
+            except ValueError:
+                pass
+        # columns with empty values only could be integers or groups of integers
+        in_column_str = in_column_str[(in_column_str != '') & (in_column_str != 'NaN') & (in_column_str != 'nan')]
+        if np.all(np.char.isdigit(np.char.replace(in_column_str, ' ', ''))):
+            return 'group_integer'
+        else:
+            return 'string'
+
+    @staticmethod
+    def _get_column_data(in_column_str: np.ndarray, in_data_type: str) -> Union[np.ndarray, RaggedIntegerArray]:
+        if in_data_type == 'integer':
+            try:
+                return in_column_str.astype(np.int64)
+            except ValueError:
+                # integers with missing values: python ints, NaN (for 'NaN') and empty strings in an object array,
+                # so that all are written back as in the input (with a float type, e.g. '1' would be written '1.0')
+                is_empty = in_column_str == ''
+                is_missing = (in_column_str == 'NaN') | (in_column_str == 'nan')
+                is_integer = ~is_empty & ~is_missing
+                out_column_data = np.full(len(in_column_str), np.NaN, dtype=object)
+                out_column_data[is_empty] = ''
+                out_column_data[is_integer] = in_column_str[is_integer].astype(np.int64).tolist()
+                return out_column_data
+        elif in_data_type == 'float':
+            return np.where(in_column_str == '', 'NaN', in_column_str).astype(np.float64)
+        elif in_data_type == 'group_integer':
+            # missing values 'NaN' are groups with no elements, marked as missing (unlike empty values)
+            in_column_str = np.char.strip(in_column_str)
+            is_missing = (in_column_str == 'NaN') | (in_column_str == 'nan')
+            in_column_str = np.where(is_missing, '', in_column_str)
+            out_values = np.array(' '.join(in_column_str).split(), dtype=np.int64)
+            in_lengths = np.where(in_column_str == '', 0, np.char.count(in_column_str, ' ') + 1)
+            if np.sum(in_lengths) != len(out_values):
+                # values separated by several spaces
+                in_lengths = np.array([len(elem.split()) for elem in in_column_str])
+            out_offsets = np.concatenate([[0], np.cumsum(in_lengths)]).astype(np.int64)
+            return RaggedIntegerArray(out_values, out_offsets, is_missing)
+        else:
+            return in_column_str
+
+    @classmethod
+    def _parse_data_columns(cls, input_file: str, dict_field_types: Dict[str, str] = None
+                            ) -> Dict[str, Union[np.ndarray, RaggedIntegerArray]]:
+        with open(input_file, 'r') as fin:
+            csv_reader = csv.reader(fin, delimiter=',', skipinitialspace=True)  # remove empty leading spaces ' '
+
+            list_fields = next(csv_reader)  # read header
+            list_rows_data = list(csv_reader)
+
+        num_fields = len(list_fields)
+        if len(list_rows_data) > 0:
+            list_columns_data = list(zip(*list_rows_data))
+        else:
+            list_columns_data = [()] * num_fields
+
+        out_dict_data = OrderedDict()
+        for (field_name, in_column_data) in zip(list_fields, list_columns_data):
+            in_column_str = np.array(in_column_data, dtype=str)
+
+            if dict_field_types is not None and field_name in dict_field_types.keys():
+                in_data_type = dict_field_types[field_name]
+            else:
+                in_data_type = cls._get_data_type_column(in_column_str)
+
+            out_dict_data[field_name] = cls._get_column_data(in_column_str, in_data_type)
+
+        return out_dict_data
+
+    @staticmethod
+    def _get_cached_table_dir(input_file: str, cache_dir: str = None) -> str:
+        if cache_dir is None:
+            # cache next to the csv file
+            return os.path.splitext(input_file)[0] + '_cache'
+        else:
+            # add a hash of the full path, to avoid clashes between tables with the same name in different dirs
+            path_hash = hashlib.sha1(os.path.abspath(input_file).encode()).hexdigest()[:8]
+            return os.path.join(cache_dir, os.path.splitext(os.path.basename(input_file))[0] + '_' + path_hash)
+
+    @staticmethod
+    def _read_cached_table(cached_table_dir: str, cached_table_info: Dict[str, Any], mmap_mode: str = None
+                           ) -> Dict[str, Union[np.ndarray, RaggedIntegerArray]]:
+        out_dict_data = OrderedDict()
+        for ifield, (field_name, is_ragged, is_object) in enumerate(zip(cached_table_info['fields'],
+                                                                        cached_table_info['is_ragged'],
+                                                                        cached_table_info['is_object'])):
+            column_file = os.path.join(cached_table_dir, 'column_%03d' % (ifield))
+            if is_ragged:
+                in_values = np.load(column_file + '_values.npy', mmap_mode=mmap_mode)
+                in_offsets = np.load(column_file + '_offsets.npy', mmap_mode=mmap_mode)
+                in_is_missing = np.load(column_file + '_missing.npy', mmap_mode=mmap_mode)
+                out_dict_data[field_name] = RaggedIntegerArray(in_values, in_offsets, in_is_missing)
+            elif is_object:
+                # object arrays cannot be memory-mapped
+                out_dict_data[field_name] = np.load(column_file + '.npy', allow_pickle=True)
+            else:
+                out_dict_data[field_name] = np.load(column_file + '.npy', mmap_mode=mmap_mode)
+        return out_dict_data
+
+    @staticmethod
+    def _write_cached_table(cached_table_dir: str, cached_table_info: Dict[str, Any],
+                            in_dict_data: Dict[str, Union[np.ndarray, RaggedIntegerArray]]) -> None:
+        # write to a temporary dir and rename, so that a partially written cache is never used
+        temp_table_dir = cached_table_dir + '_%d.tmp' % (os.getpid())
+        os.makedirs(temp_table_dir)
+
+        for ifield, idata in enumerate(in_dict_data.values()):
+            column_file = os.path.join(temp_table_dir, 'column_%03d' % (ifield))
+            if isinstance(idata, RaggedIntegerArray):
+                np.save(column_file + '_values.npy', idata.values)
+                np.save(column_file + '_offsets.npy', idata.offsets)
+                np.save(column_file + '_missing.npy', idata.is_missing)
+            else:
+                np.save(column_file + '.npy', idata)
+
+        np.save(os.path.join(temp_table_dir, 'table_info.npy'), cached_table_info)
+
+        if os.path.exists(cached_table_dir):
+            shutil.rmtree(cached_table_dir)
+        os.replace(temp_table_dir, cached_table_dir)
+
+    @classmethod
+    def get_data_columns(cls, input_file: str, dict_field_types: Dict[str, str] = None, is_cache: bool = False,
+                         cache_dir: str = None, mmap_mode: str = None
+                         ) -> Dict[str, Union[np.ndarray, RaggedIntegerArray]]:
+        # output data as dictionary (key: field name, value: numpy array with the field data column)
+        # data type of the fields: from 'dict_field_types' if given, otherwise inferred from the whole column
+        # 'is_cache': store the parsed table as binary files (one '.npy' per column), next to the csv file or in
+        # 'cache_dir', and load it from there in next calls (in memory-mapped mode if 'mmap_mode' is given).
+        # The cache is invalid if the csv file changes (mtime or size), if the input data types are different, or if it
+        # was written with another version of the format
+        if not is_cache:
+            return cls._parse_data_columns(input_file, dict_field_types)
+
+        file_stat = os.stat(input_file)
+        file_stamp = (file_stat.st_mtime_ns, file_stat.st_size)
+        in_field_types = dict(dict_field_types) if dict_field_types is not None else None
+
+        cached_table_dir = cls._get_cached_table_dir(input_file, cache_dir)
+        cached_table_info_file = os.path.join(cached_table_dir, 'table_info.npy')
+
+        if os.path.exists(cached_table_info_file):
+            cached_table_info = dict(np.load(cached_table_info_file, allow_pickle=True).item())
+            if cached_table_info.get('version') == _VERSION_CACHED_TABLES and cached_table_info['stamp'] == file_stamp \
+                    and cached_table_info['field_types'] == in_field_types:
+                return cls._read_cached_table(cached_table_dir, cached_table_info, mmap_mode)
+
+        out_dict_data = cls._parse_data_columns(input_file, dict_field_types)
+
+        cached_table_info = {'version': _VERSION_CACHED_TABLES,
+                             'stamp': file_stamp,
+                             'field_types': in_field_types,
+                             'fields': list(out_dict_data.keys()),
+                             'is_ragged': [isinstance(idata, RaggedIntegerArray) for idata in out_dict_data.values()],
+                             'is_object': [isinstance(idata, np.ndarray) and idata.dtype == object
+                                           for idata in out_dict_data.values()]}
+        if cache_dir is not None and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        cls._write_cached_table(cached_table_dir, cached_table_info, out_dict_data)
+
+        return out_dict_data
+
+    @staticmethod
+    def _get_column_elements(in_column_data: Union[List[Any], np.ndarray, RaggedIntegerArray]) -> List[Any]:
+        if isinstance(in_column_data, RaggedIntegerArray):
+            return in_column_data.get_strings().tolist()
+        elif isinstance(in_column_data, np.ndarray):
+            if in_column_data.dtype.kind == 'f' and in_column_data.dtype != np.float64:
+                # keep numpy scalars, so that '%s' gives the same output as for the elements of the array
+                return list(in_column_data)
+            else:
+                # python scalars, same output with '%' formats, and much faster to get
+                return in_column_data.tolist()
+        else:
+            return in_column_data
+
     @classmethod
     def write_data(cls, output_file: str, out_dict_data: Dict[str, Any], format_out_data: List[str] = None) -> None:
         with open(output_file, 'w') as fout:
@@ -99,17 +781,24 @@ class CsvFileReader(object):
             str_header = ', '.join(list_fields) + '\n'
             fout.write(str_header)
 
-            list_out_list_data = list(out_dict_data.values())
+            list_out_list_data = [cls._get_column_elements(idata) for idata in out_dict_data.values()]
             num_cols = len(list_fields)
             num_rows = len(list_out_list_data[0])
 
             if format_out_data is None:
                 format_out_data = ['%0.3f'] * num_cols
 
-            for irow in range(num_rows):
-                list_data_row = [list_out_list_data[icol][irow] for icol in range(num_cols)]
-                str_data_row = ', '.join([format_out_data[i] % (elem) for i, elem in enumerate(list_data_row)]) + '\n'
-                fout.write(str_data_row)
+            # format all the rows in a chunk with one single string formatting, with the row format repeated
+            # (same output as formatting each element separately), and write the chunks one after another
+            format_row = ', '.join(format_out_data) + '\n'
+
+            for irow_begin in range(0, num_rows, _SIZE_CHUNK_ROWS_CSV):
+                irow_end = min(irow_begin + _SIZE_CHUNK_ROWS_CSV, num_rows)
+                list_data_chunk = [icol_data[irow_begin:irow_end] for icol_data in list_out_list_data]
+                # elements of the chunk, ordered row after row
+                list_data_chunk = tuple(itertools.chain.from_iterable(zip(*list_data_chunk)))
+                str_data_chunk = (format_row * (irow_end - irow_begin)) % list_data_chunk
+                fout.write(str_data_chunk)
 
     @classmethod
     def write_data_other(cls, output_file: str, out_dict_data: Dict[str, Any]) -> None:
@@ -6,10 +6,14 @@ import os
 import re
 import shutil
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from scipy.ndimage.morphology import binary_fill_holes, binary_erosion, binary_dilation
-from skimage.morphology import cube, skeletonize_3d
+from scipy.ndimage import distance_transform_cdt, maximum_filter1d, minimum_filter1d, find_objects
+from skimage.morphology import skeletonize_3d
 from skimage.measure import label
 
+_MIN_SIZE_COMPONENT_CENLINES_PARALLEL = 10000  # smaller conn. components are skeletonized in the main process
+
 
 def makedir(dirname: str) -> bool:
     dirname = dirname.strip().rstrip("\\")
@@ -20,6 +24,10 @@ def makedir(dirname: str) -> bool:
         return False
 
 
+def is_exist_file(filename: str) -> bool:
+    return os.path.isfile(filename)
+
+
 def makelink(src_file: str, dest_link: str) -> None:
     os.symlink(src_file, dest_link)
 
@@ -74,17 +82,68 @@ def compute_thresholded_image(in_image: np.ndarray, value_threshold: float) -> n
 
 
 def compute_eroded_mask(in_image: np.ndarray, in_struct: str = None, num_iters: int = 1) -> np.ndarray:
-    if in_struct == 'cube':
-        in_struct = cube(3)
+    if (in_struct is None or in_struct == 'cube') and num_iters >= 1:
+        return _compute_eroded_mask_distance(in_image, in_struct == 'cube', num_iters)
     return binary_erosion(in_image, structure=in_struct, iterations=num_iters).astype(in_image.dtype)
 
 
 def compute_dilated_mask(in_image: np.ndarray, in_struct: str = None, num_iters: int = 1) -> np.ndarray:
-    if in_struct == 'cube':
-        in_struct = cube(3)
+    if (in_struct is None or in_struct == 'cube') and num_iters >= 1:
+        return _compute_dilated_mask_distance(in_image, in_struct == 'cube', num_iters)
     return binary_dilation(in_image, structure=in_struct, iterations=num_iters).astype(in_image.dtype)
 
 
+def _compute_dilated_mask_distance(in_image: np.ndarray, is_struct_cube: bool, num_iters: int) -> np.ndarray:
+    # the same as iterating 'binary_dilation' with the 6-neighbour cross (or the 3x3x3 cube): the voxels at
+    # taxicab (or chessboard) distance up to 'num_iters' from the mask. Computed only in the bounding-box of the
+    # mask padded by 'num_iters', with a distance transform (or separable max. filters for the cube)
+    out_image = np.zeros_like(in_image)
+    boundbox = compute_boundbox_mask(in_image)
+    if boundbox is None:
+        return out_image
+    boundbox = compute_boundbox_padded(boundbox, num_iters, in_image.shape)
+    in_mask = crop_image_boundbox(in_image, boundbox) != 0
+
+    if is_struct_cube:
+        out_mask = in_mask.view(np.uint8)
+        for i_axis in range(out_mask.ndim):
+            out_mask = maximum_filter1d(out_mask, size=2 * num_iters + 1, axis=i_axis, mode='constant', cval=0)
+    elif num_iters == 1:
+        # one pass of the dilation is faster than the distance transform
+        out_mask = binary_dilation(in_mask)
+    else:
+        out_mask = distance_transform_cdt(np.logical_not(in_mask), metric='taxicab') <= num_iters
+
+    crop_image_boundbox(out_image, boundbox)[...] = out_mask
+    return out_image
+
+
+def _compute_eroded_mask_distance(in_image: np.ndarray, is_struct_cube: bool, num_iters: int) -> np.ndarray:
+    # the same as iterating 'binary_erosion' with the 6-neighbour cross (or the 3x3x3 cube), with the voxels out of
+    # the volume as background: the voxels at taxicab (or chessboard) distance larger than 'num_iters' from the
+    # background. Computed only in the bounding-box of the mask, with a distance transform (or separable min.
+    # filters for the cube)
+    out_image = np.zeros_like(in_image)
+    boundbox = compute_boundbox_mask(in_image)
+    if boundbox is None:
+        return out_image
+    in_mask = crop_image_boundbox(in_image, boundbox) != 0
+
+    if is_struct_cube:
+        out_mask = in_mask.view(np.uint8)
+        for i_axis in range(out_mask.ndim):
+            out_mask = minimum_filter1d(out_mask, size=2 * num_iters + 1, axis=i_axis, mode='constant', cval=0)
+    elif num_iters == 1:
+        out_mask = binary_erosion(in_mask)
+    else:
+        # pad with background, to have the distances to the voxels out of the bounding-box
+        out_mask = distance_transform_cdt(np.pad(in_mask, 1), metric='taxicab') > num_iters
+        out_mask = out_mask[(slice(1, -1),) * out_mask.ndim]
+
+    crop_image_boundbox(out_image, boundbox)[...] = out_mask
+    return out_image
+
+
 def compute_merged_two_masks(in_image_1: np.ndarray, in_image_2: np.ndarray) -> np.ndarray:
     out_image = in_image_1 + in_image_2
     return np.clip(out_image, 0, 1)
@@ -100,10 +159,62 @@ def compute_multiplied_two_masks(in_image_1: np.ndarray, in_image_2: np.ndarray)
     return np.clip(out_image, 0, 1)
 
 
-def compute_centrelines_mask(in_image: np.ndarray) -> np.ndarray:
+def _compute_centrelines_component(in_image: np.ndarray) -> np.ndarray:
     return skeletonize_3d(in_image.astype(np.uint8))
 
 
+def compute_centrelines_mask(in_image: np.ndarray, num_processes: int = 1) -> np.ndarray:
+    # thinning only in the bounding-box of the mask padded by one voxel: the thinning of each voxel depends only on
+    # its 26-neighbours, so the result is the same as in the full volume. With several processes, the conn.
+    # components of the mask (26-connectivity), which do not interact in the thinning, are skeletonized concurrently
+    out_image = np.zeros(in_image.shape, dtype=np.uint8)
+    boundbox = compute_boundbox_mask(in_image)
+    if boundbox is None:
+        return out_image
+    boundbox = compute_boundbox_padded(boundbox, 1, in_image.shape)
+    in_mask = crop_image_boundbox(in_image, boundbox).astype(np.uint8)
+    out_mask = crop_image_boundbox(out_image, boundbox)
+
+    if num_processes <= 1:
+        out_mask[...] = _compute_centrelines_component(in_mask)
+        return out_image
+
+    (all_regions, num_regs) = label(in_mask > 0, connectivity=3, background=0, return_num=True)
+    vol_regions = np.bincount(all_regions.ravel(), minlength=num_regs + 1)
+
+    # crop each conn. component in its bounding-box padded by one voxel
+    list_components = []
+    for (ilabel, islices_region) in enumerate(find_objects(all_regions), start=1):
+        boundbox_region = compute_boundbox_padded([(islice.start, islice.stop) for islice in islices_region], 1,
+                                                  in_mask.shape)
+        in_mask_region = crop_image_boundbox(all_regions, boundbox_region) == ilabel
+        list_components.append((vol_regions[ilabel], boundbox_region, in_mask_region))
+    # endfor
+
+    # launch the largest components first, and skeletonize the small ones meanwhile in this process
+    list_components.sort(key=lambda elem: elem[0], reverse=True)
+    list_large_components = [elem for elem in list_components if elem[0] >= _MIN_SIZE_COMPONENT_CENLINES_PARALLEL]
+    list_small_components = [elem for elem in list_components if elem[0] < _MIN_SIZE_COMPONENT_CENLINES_PARALLEL]
+
+    def stitch_centrelines_component(in_boundbox_region: Tuple[Tuple[int, int], ...],
+                                     in_cenline_region: np.ndarray) -> None:
+        out_mask_region = crop_image_boundbox(out_mask, in_boundbox_region)
+        np.maximum(out_mask_region, in_cenline_region, out=out_mask_region)
+
+    with ProcessPoolExecutor(max_workers=num_processes) as executor:
+        list_futures = [(boundbox_region, executor.submit(_compute_centrelines_component, in_mask_region))
+                        for (_, boundbox_region, in_mask_region) in list_large_components]
+
+        for (_, boundbox_region, in_mask_region) in list_small_components:
+            stitch_centrelines_component(boundbox_region, _compute_centrelines_component(in_mask_region))
+
+        for (boundbox_region, future_region) in list_futures:
+            stitch_centrelines_component(boundbox_region, future_region.result())
+    # endwith
+
+    return out_image
+
+
 def compute_fillholes_mask(in_image: np.ndarray) -> np.ndarray:
     return binary_fill_holes(in_image).astype(in_image.dtype)
 
@@ -113,18 +224,65 @@ def compute_connected_components(in_image: np.ndarray, connectivity_dim: int) ->
     return (out_all_regions.astype(in_image.dtype), out_num_regs)
 
 
-def compute_largest_connected_tree(in_image: np.ndarray, connectivity_dim: int) -> np.ndarray:
+def compute_largest_connected_components(in_image: np.ndarray, connectivity_dim: int, num_keep_regions: int = None,
+                                         min_size_regions: int = None) -> np.ndarray:
+    # keep the 'num_keep_regions' conn. regions with the largest volume (all if None or 0), and among them only those
+    # with at least 'min_size_regions' voxels (if set)
     (all_regions, num_regs) = label(in_image, connectivity=connectivity_dim, background=0, return_num=True)
 
+    # volume of all conn. regions in one pass: count voxels for each label (label '0' is the background)
+    vol_regions = np.bincount(all_regions.ravel(), minlength=num_regs + 1)
+    vol_regions[0] = 0
+
+    is_keep_regions = vol_regions > 0
+    if num_keep_regions:
+        # labels sorted by decreasing volume, and by increasing label for the same volume
+        labels_sorted_volume = np.argsort(-vol_regions, kind='stable')
+        is_keep_regions[labels_sorted_volume[num_keep_regions:]] = False
+    if min_size_regions:
+        is_keep_regions &= vol_regions >= min_size_regions
+
+    labels_keep = np.flatnonzero(is_keep_regions)
+    if len(labels_keep) == 1:
+        # extract the conn. region with a single comparison
+        return (all_regions == labels_keep[0]).astype(in_image.dtype)
+    else:
+        # extract the conn. regions with a lookup table of the labels to keep
+        return is_keep_regions[all_regions].astype(in_image.dtype)
+
+
+def compute_largest_connected_tree(in_image: np.ndarray, connectivity_dim: int) -> np.ndarray:
     # retrieve the conn. region with the largest volume
-    max_vol_regs = 0.0
-    out_image = None
-    for ireg in range(num_regs):
-        # volume = count voxels for the the conn. region with label "i+1"
-        iconreg_vol = np.count_nonzero(all_regions == ireg + 1)
-        if iconreg_vol > max_vol_regs:
-            # extract the conn. region with label "i+1"
-            out_image = np.where(all_regions == ireg + 1, 1, 0).astype(in_image.dtype)
-            max_vol_regs = iconreg_vol
+    return compute_largest_connected_components(in_image, connectivity_dim, num_keep_regions=1)
+
+
+def compute_boundbox_mask(in_image: np.ndarray) -> Union[Tuple[Tuple[int, int], ...], None]:
+    # bounding-box of the nonzero voxels, as ((z_beg, z_end), (y_beg, y_end), (x_beg, x_end)). None if the mask is empty
+    out_boundbox = []
+    for i_axis in range(in_image.ndim):
+        other_axes = tuple([j_axis for j_axis in range(in_image.ndim) if j_axis != i_axis])
+        indexes_nonzero = np.flatnonzero(np.any(in_image, axis=other_axes))
+        if len(indexes_nonzero) == 0:
+            return None
+        out_boundbox.append((int(indexes_nonzero[0]), int(indexes_nonzero[-1]) + 1))
+    # endfor
+    return tuple(out_boundbox)
+
+
+def compute_boundbox_union(list_boundboxes: List[Tuple[Tuple[int, int], ...]]
+                           ) -> Union[Tuple[Tuple[int, int], ...], None]:
+    list_boundboxes = [boundbox for boundbox in list_boundboxes if boundbox is not None]
+    if len(list_boundboxes) == 0:
+        return None
+    return tuple([(min([boundbox[i][0] for boundbox in list_boundboxes]),
+                   max([boundbox[i][1] for boundbox in list_boundboxes])) for i in range(len(list_boundboxes[0]))])
 
-    return out_image
+
+def compute_boundbox_padded(in_boundbox: Tuple[Tuple[int, int], ...], size_pad: int, image_shape: Tuple[int, ...]
+                            ) -> Tuple[Tuple[int, int], ...]:
+    return tuple([(max(beg - size_pad, 0), min(end + size_pad, size)) for ((beg, end), size)
+                  in zip(in_boundbox, image_shape)])
+
+
+def crop_image_boundbox(in_image: np.ndarray, in_boundbox: Tuple[Tuple[int, int], ...]) -> np.ndarray:
+    return in_image[tuple([slice(beg, end) for (beg, end) in in_boundbox])]
@@ -1,11 +1,15 @@
-
+from typing import List, Tuple, Dict, Callable, Any
+from collections import OrderedDict
 import numpy as np
-from scipy.spatial import distance
+from scipy.spatial import cKDTree
+from scipy.ndimage import distance_transform_edt, binary_erosion
 
-from common.functionutil import handle_error_message, compute_dilated_mask, compute_connected_components
+from common.functionutil import handle_error_message, compute_dilated_mask, compute_connected_components, \
+    compute_boundbox_mask, compute_boundbox_union, compute_boundbox_padded, crop_image_boundbox
 
 _EPS = 1.0e-7
 _SMOOTH = 1.0
+_SIZE_CHUNK_COUNTS = 2 ** 18    # num. voxels of the chunks of the volumes processed together when counting overlaps
 
 LIST_AVAIL_METRICS = ['DiceCoefficient',
                       'AirwayCompleteness',
@@ -16,8 +20,292 @@ LIST_AVAIL_METRICS = ['DiceCoefficient',
                       'AirwayCentrelineDistanceFalseNegativeError',
                       'AirwayNumberFNErrors',
                       'AirwayNumberFNGAPErrors',
+                      'HausdorffDistance',
+                      'HausdorffDistance95',
+                      'AverageSymmetricSurfaceDistance',
                       ]
 
+# metrics computed only from voxel counts, that can be evaluated for many thresholds of the posteriors at once
+LIST_AVAIL_METRICS_THRESHOLDS = ['DiceCoefficient',
+                                 'AirwayCompleteness',
+                                 'AirwayVolumeLeakage',
+                                 'AirwayTreeLength',
+                                 ]
+
+
+def compute_overlap_counts(in_images: Dict[str, np.ndarray], list_overlaps: List[Tuple[str, str]]
+                           ) -> Dict[Any, int]:
+    # number of nonzero voxels in each image, and in the intersection of each pair of images in 'list_overlaps'.
+    # All counts are done in one pass over chunks of the volumes (slices along the first axis), while each chunk
+    # is in cache, and with only a boolean buffer of the chunk size as temporary (no float temporaries)
+    out_counts = OrderedDict([(iname, 0) for iname in in_images.keys()] + [(ipair, 0) for ipair in list_overlaps])
+
+    in_shape = next(iter(in_images.values())).shape
+    num_slices_chunk = max(_SIZE_CHUNK_COUNTS // int(np.prod(in_shape[1:])), 1)
+    buffer_overlap = np.empty((num_slices_chunk,) + in_shape[1:], dtype=bool)
+
+    for ibeg in range(0, in_shape[0], num_slices_chunk):
+        iend = min(ibeg + num_slices_chunk, in_shape[0])
+        in_chunks = dict([(iname, in_image[ibeg:iend]) for (iname, in_image) in in_images.items()])
+
+        for (iname, in_chunk) in in_chunks.items():
+            out_counts[iname] += np.count_nonzero(in_chunk)
+
+        for (iname_1, iname_2) in list_overlaps:
+            out_overlap = np.logical_and(in_chunks[iname_1], in_chunks[iname_2], out=buffer_overlap[:iend - ibeg])
+            out_counts[(iname_1, iname_2)] += np.count_nonzero(out_overlap)
+    # endfor
+
+    return out_counts
+
+
+def compute_overlap_counts_thresholds(in_posterior: np.ndarray, in_thresholds: np.ndarray,
+                                      in_images: Dict[str, np.ndarray]) -> Dict[Any, Any]:
+    # number of voxels with the posterior above each threshold ('input'), as when thresholding with '>', and of those
+    # inside each image ((iname, 'input')), as arrays with the counts for each threshold. Also the number of nonzero
+    # voxels in each image. All counts are done in one pass over chunks of the volumes: the posterior values are
+    # binned by the sorted thresholds, and the counts above each threshold are the cumulative sums of the bins above
+    num_thresholds = len(in_thresholds)
+    indexes_sort_thresholds = np.argsort(in_thresholds)
+    # thresholds in the same precision as the posteriors, as when comparing the posteriors with a scalar threshold
+    sorted_thresholds = np.asarray(in_thresholds, dtype=in_posterior.dtype)[indexes_sort_thresholds]
+
+    counts_bins = OrderedDict([('input', np.zeros(num_thresholds + 1, dtype=np.int64))]
+                              + [((iname, 'input'), np.zeros(num_thresholds + 1, dtype=np.int64))
+                                 for iname in in_images.keys()])
+    out_counts = OrderedDict([(iname, 0) for iname in in_images.keys()])
+
+    in_shape = in_posterior.shape
+    num_slices_chunk = max(_SIZE_CHUNK_COUNTS // int(np.prod(in_shape[1:])), 1)
+
+    for ibeg in range(0, in_shape[0], num_slices_chunk):
+        iend = min(ibeg + num_slices_chunk, in_shape[0])
+        # index of the bin: the number of thresholds below the posterior value
+        indexes_bins_chunk = np.searchsorted(sorted_thresholds, in_posterior[ibeg:iend].ravel(), side='left')
+        counts_bins['input'] += np.bincount(indexes_bins_chunk, minlength=num_thresholds + 1)
+
+        for (iname, in_image) in in_images.items():
+            is_inside_chunk = in_image[ibeg:iend].ravel() > 0
+            out_counts[iname] += np.count_nonzero(is_inside_chunk)
+            counts_bins[(iname, 'input')] += np.bincount(indexes_bins_chunk[is_inside_chunk],
+                                                         minlength=num_thresholds + 1)
+        # endfor
+    # endfor
+
+    for (ikey, icounts_bins) in counts_bins.items():
+        # voxels above the threshold 'i' are those in the bins 'i+1' and higher
+        counts_above_sorted = np.cumsum(icounts_bins[::-1])[::-1][1:]
+        out_counts_above = np.empty(num_thresholds, dtype=np.int64)
+        out_counts_above[indexes_sort_thresholds] = counts_above_sorted
+        out_counts[ikey] = out_counts_above
+    # endfor
+
+    return out_counts
+
+
+class MetricsCaseContext(object):
+    # data for the evaluation of one case: the intermediate arrays (centreline coordinates, dilated masks,
+    # connected components, ...) are computed the first time a metric needs them, and reused by the other metrics.
+    # The voxel size is in the same axes as the arrays, i.e. (z, y, x) for the images (reversed from the header)
+
+    # keys of the intermediate data that depend only on the target: kept apart, and shared with the contexts for
+    # other inputs with the same target (see 'get_context_new_input')
+    _keys_cached_data_target = ('target_cenline_coords', 'target_cenline_kdtree', 'dilated_target',
+                                'num_components_target_cenline')
+
+    def __init__(self, target: np.ndarray, input: np.ndarray,
+                 target_cenline: np.ndarray = None, input_cenline: np.ndarray = None,
+                 voxel_size: np.ndarray = None) -> None:
+        self._target = target
+        self._input = input
+        self._target_cenline = target_cenline
+        self._input_cenline = input_cenline
+        self._voxel_size = np.array(voxel_size) if voxel_size is not None else None
+        self._cache_data = {}
+        self._cache_data_target = {}
+
+    def _get_cached_data(self, key: Tuple[Any, ...], fun_compute: Callable[[], Any]) -> Any:
+        cache_data = self._cache_data_target if key[0] in self._keys_cached_data_target else self._cache_data
+        if key not in cache_data:
+            cache_data[key] = fun_compute()
+        return cache_data[key]
+
+    def get_context_new_input(self, input: np.ndarray, input_cenline: np.ndarray = None) -> 'MetricsCaseContext':
+        # context for another input with the same target (e.g. several post-processings of the same case), which
+        # reuses the intermediate data of the target computed in this context, or in any other shared with it
+        out_context = MetricsCaseContext(self._target, input, self._target_cenline, input_cenline, self._voxel_size)
+        out_context._cache_data_target = self._cache_data_target
+        return out_context
+
+    def get_target(self) -> np.ndarray:
+        return self._target
+
+    def get_input(self) -> np.ndarray:
+        return self._input
+
+    def get_target_cenline(self) -> np.ndarray:
+        return self._target_cenline
+
+    def get_input_cenline(self) -> np.ndarray:
+        return self._input_cenline
+
+    def get_voxel_size(self) -> np.ndarray:
+        if self._voxel_size is None:
+            message = 'Voxel size not set in the context of the case, needed for the metrics with physical units'
+            handle_error_message(message)
+        return self._voxel_size
+
+    def get_target_cenline_coords(self) -> np.ndarray:
+        return self._get_cached_data(('target_cenline_coords',),
+                                     lambda: np.argwhere(self._target_cenline > 0) * self.get_voxel_size())
+
+    def get_input_cenline_coords(self) -> np.ndarray:
+        return self._get_cached_data(('input_cenline_coords',),
+                                     lambda: np.argwhere(self._input_cenline > 0) * self.get_voxel_size())
+
+    def get_target_cenline_kdtree(self) -> cKDTree:
+        return self._get_cached_data(('target_cenline_kdtree',),
+                                     lambda: cKDTree(self.get_target_cenline_coords()))
+
+    def get_cenline_nearest_dists(self) -> Tuple[np.ndarray, np.ndarray]:
+        # distances from each input centreline point to the nearest target centreline point, and the reverse.
+        # Empty arrays if any of the centrelines is empty
+        def fun_compute() -> Tuple[np.ndarray, np.ndarray]:
+            target_coords = self.get_target_cenline_coords()
+            input_coords = self.get_input_cenline_coords()
+            if len(target_coords) == 0 or len(input_coords) == 0:
+                return (np.array([]), np.array([]))
+            # nearest-neighbour queries with KD-trees, instead of computing the full matrix of pairwise distances
+            (dists_input_to_target, _) = self.get_target_cenline_kdtree().query(input_coords)
+            (dists_target_to_input, _) = cKDTree(input_coords).query(target_coords)
+            return (dists_input_to_target, dists_target_to_input)
+
+        return self._get_cached_data(('cenline_nearest_dists',), fun_compute)
+
+    @staticmethod
+    def _get_mask_surface(in_image: np.ndarray) -> np.ndarray:
+        # voxels of the mask with any neighbour (6-connectivity) in the background
+        in_mask = in_image > 0
+        return np.logical_and(in_mask, np.logical_not(binary_erosion(in_mask)))
+
+    def get_surface_nearest_dists(self) -> Tuple[np.ndarray, np.ndarray]:
+        # distances from each input surface voxel to the nearest target surface voxel, and the reverse. Computed with
+        # distance transforms (with the voxel size as sampling) only in the bounding-box of both masks, padded to
+        # keep their surfaces inside, and one at a time, so that the memory is bounded by the size of the masks and
+        # not of the full volumes. Empty arrays if any of the masks is empty
+        def fun_compute() -> Tuple[np.ndarray, np.ndarray]:
+            boundbox = compute_boundbox_union([compute_boundbox_mask(self._target), compute_boundbox_mask(self._input)])
+            if boundbox is None:
+                return (np.array([]), np.array([]))
+            boundbox = compute_boundbox_padded(boundbox, 1, self._target.shape)
+
+            target_surface = self._get_mask_surface(crop_image_boundbox(self._target, boundbox))
+            input_surface = self._get_mask_surface(crop_image_boundbox(self._input, boundbox))
+            if not np.any(target_surface) or not np.any(input_surface):
+                return (np.array([]), np.array([]))
+
+            voxel_size = self.get_voxel_size()    # in the axes of the arrays (z, y, x)
+            dists_to_target = distance_transform_edt(np.logical_not(target_surface), sampling=voxel_size)
+            dists_input_to_target = dists_to_target[input_surface]
+            del dists_to_target
+            dists_to_input = distance_transform_edt(np.logical_not(input_surface), sampling=voxel_size)
+            dists_target_to_input = dists_to_input[target_surface]
+            return (dists_input_to_target, dists_target_to_input)
+
+        return self._get_cached_data(('surface_nearest_dists',), fun_compute)
+
+    def get_overlap_counts(self) -> Dict[Any, int]:
+        # voxel counts of the masks, centrelines, and their overlaps, needed for all the ratio metrics
+        def fun_compute() -> Dict[Any, int]:
+            in_images = OrderedDict([('target', self._target), ('input', self._input)])
+            list_overlaps = [('target', 'input')]
+            if self._target_cenline is not None:
+                in_images['target_cenline'] = self._target_cenline
+                list_overlaps.append(('target_cenline', 'input'))
+            if self._input_cenline is not None:
+                in_images['input_cenline'] = self._input_cenline
+                list_overlaps.append(('input_cenline', 'target'))
+            return compute_overlap_counts(in_images, list_overlaps)
+
+        return self._get_cached_data(('overlap_counts',), fun_compute)
+
+    def get_num_input_inside_dilated_target(self, in_struct: str = None, num_iters: int = 1) -> int:
+        def fun_compute() -> int:
+            in_images = OrderedDict([('input', self._input),
+                                     ('dilated_target', self.get_dilated_target(in_struct, num_iters))])
+            return compute_overlap_counts(in_images, [('input', 'dilated_target')])[('input', 'dilated_target')]
+
+        return self._get_cached_data(('num_input_inside_dilated_target', in_struct, num_iters), fun_compute)
+
+    def get_dilated_target(self, in_struct: str = None, num_iters: int = 1) -> np.ndarray:
+        return self._get_cached_data(('dilated_target', in_struct, num_iters),
+                                     lambda: compute_dilated_mask(self._target, in_struct, num_iters))
+
+    def get_dilated_input(self, in_struct: str = None, num_iters: int = 1) -> np.ndarray:
+        return self._get_cached_data(('dilated_input', in_struct, num_iters),
+                                     lambda: compute_dilated_mask(self._input, in_struct, num_iters))
+
+    def get_truepos_target_cenline(self) -> np.ndarray:
+        # logical operations in the mask data type, with no full-volume float temporaries
+        return self._get_cached_data(('truepos_target_cenline',),
+                                     lambda: np.logical_and(self._target_cenline, self._input).astype(
+                                         self._target_cenline.dtype))
+
+    def get_falseneg_target_cenline(self, is_dilate_input: bool = False) -> np.ndarray:
+        def fun_compute() -> np.ndarray:
+            input = self.get_dilated_input() if is_dilate_input else self._input
+            return np.logical_and(self._target_cenline, np.logical_not(input)).astype(self._target_cenline.dtype)
+
+        return self._get_cached_data(('falseneg_target_cenline', is_dilate_input), fun_compute)
+
+    def _get_num_connected_components(self, in_image: np.ndarray) -> int:
+        (_, num_regions) = compute_connected_components(in_image, connectivity_dim=3)
+        return num_regions
+
+    def get_num_components_target_cenline(self, is_dilate: bool = False) -> int:
+        def fun_compute() -> int:
+            target_cenline = compute_dilated_mask(self._target_cenline) if is_dilate else self._target_cenline
+            return self._get_num_connected_components(target_cenline)
+
+        return self._get_cached_data(('num_components_target_cenline', is_dilate), fun_compute)
+
+    def get_num_components_truepos_target_cenline(self, is_dilate: bool = False) -> int:
+        def fun_compute() -> int:
+            truepos_target_cenline = self.get_truepos_target_cenline()
+            if is_dilate:
+                truepos_target_cenline = compute_dilated_mask(truepos_target_cenline)
+            return self._get_num_connected_components(truepos_target_cenline)
+
+        return self._get_cached_data(('num_components_truepos_target_cenline', is_dilate), fun_compute)
+
+    def get_num_components_falseneg_target_cenline(self, is_dilate_input: bool = False) -> int:
+        return self._get_cached_data(('num_components_falseneg_target_cenline', is_dilate_input),
+                                     lambda: self._get_num_connected_components(
+                                         self.get_falseneg_target_cenline(is_dilate_input)))
+
+
+class MetricsThresholdsCaseContext(MetricsCaseContext):
+    # data for the evaluation of one case for a list of thresholds of the posteriors, with the voxel counts for all
+    # the thresholds computed in one pass. Only for the metrics computed from the counts (in the list
+    # 'LIST_AVAIL_METRICS_THRESHOLDS'), which return arrays with the value for each threshold
+
+    def __init__(self, target: np.ndarray, posterior: np.ndarray, thresholds: np.ndarray,
+                 target_cenline: np.ndarray = None, voxel_size: np.ndarray = None) -> None:
+        super(MetricsThresholdsCaseContext, self).__init__(target, posterior, target_cenline, None, voxel_size)
+        self._thresholds = np.array(thresholds)
+
+    def get_thresholds(self) -> np.ndarray:
+        return self._thresholds
+
+    def get_overlap_counts(self) -> Dict[Any, Any]:
+        def fun_compute() -> Dict[Any, Any]:
+            in_images = OrderedDict([('target', self._target)])
+            if self._target_cenline is not None:
+                in_images['target_cenline'] = self._target_cenline
+            return compute_overlap_counts_thresholds(self._input, self._thresholds, in_images)
+
+        return self._get_cached_data(('overlap_counts',), fun_compute)
+
 
 class MetricBase(object):
     _is_airway_metric = False
@@ -25,6 +313,7 @@ class MetricBase(object):
 
     def __init__(self) -> None:
         self._name_fun_out = None
+        self._voxel_size = None
 
     def compute(self, target: np.ndarray, input: np.ndarray, *args) -> np.ndarray:
         if self._is_airway_metric:
@@ -34,6 +323,20 @@ class MetricBase(object):
         else:
             return self._compute(target, input)
 
+    def compute_case(self, case_context: MetricsCaseContext) -> np.ndarray:
+        # compute the metric reusing the intermediate data shared with the other metrics evaluated for the case
+        if self._is_use_voxelsize:
+            self.set_voxel_size(case_context.get_voxel_size())
+        return self._compute_case(case_context)
+
+    def _compute_case(self, case_context: MetricsCaseContext) -> np.ndarray:
+        return self.compute(case_context.get_target(), case_context.get_input(),
+                            case_context.get_target_cenline(), case_context.get_input_cenline())
+
+    def _get_case_context(self, target: np.ndarray, target_cenline: np.ndarray,
+                          input: np.ndarray, input_cenline: np.ndarray) -> MetricsCaseContext:
+        return MetricsCaseContext(target, input, target_cenline, input_cenline, voxel_size=self._voxel_size)
+
     def _compute(self, target: np.ndarray, input: np.ndarray) -> np.ndarray:
         raise NotImplementedError
 
@@ -52,7 +355,11 @@ class DiceCoefficient(MetricBase):
         self._name_fun_out = 'dice'
 
     def _compute(self, target: np.ndarray, input: np.ndarray) -> np.ndarray:
-        return (2.0 * np.sum(target * input)) / (np.sum(target) + np.sum(input) + _SMOOTH)
+        return self._compute_case(MetricsCaseContext(target, input))
+
+    def _compute_case(self, case_context: MetricsCaseContext) -> np.ndarray:
+        counts = case_context.get_overlap_counts()
+        return (2.0 * counts[('target', 'input')]) / (counts['target'] + counts['input'] + _SMOOTH)
 
 
 class DiceCoefficientMaskedTraining(MetricBase):
@@ -79,7 +386,11 @@ class AirwayCompleteness(MetricBase):
 
     def _compute_airs(self, target: np.ndarray, target_cenline: np.ndarray,
                       input: np.ndarray, input_cenline: np.ndarray) -> np.ndarray:
-        return np.sum(target_cenline * input) / (np.sum(target_cenline) + _SMOOTH)
+        return self._compute_case(self._get_case_context(target, target_cenline, input, input_cenline))
+
+    def _compute_case(self, case_context: MetricsCaseContext) -> np.ndarray:
+        counts = case_context.get_overlap_counts()
+        return counts[('target_cenline', 'input')] / (counts['target_cenline'] + _SMOOTH)
 
 
 class AirwayVolumeLeakage(MetricBase):
@@ -91,7 +402,11 @@ class AirwayVolumeLeakage(MetricBase):
 
     def _compute_airs(self, target: np.ndarray, target_cenline: np.ndarray,
                       input: np.ndarray, input_cenline: np.ndarray) -> np.ndarray:
-        return np.sum((1.0 - target) * input) / (np.sum(target) + _SMOOTH)
+        return self._compute_case(self._get_case_context(target, target_cenline, input, input_cenline))
+
+    def _compute_case(self, case_context: MetricsCaseContext) -> np.ndarray:
+        counts = case_context.get_overlap_counts()
+        return (counts['input'] - counts[('target', 'input')]) / (counts['target'] + _SMOOTH)
 
 
 class AirwayVolumeLeakageDilatedGT(MetricBase):
@@ -103,8 +418,12 @@ class AirwayVolumeLeakageDilatedGT(MetricBase):
 
     def _compute_airs(self, target: np.ndarray, target_cenline: np.ndarray,
                       input: np.ndarray, input_cenline: np.ndarray) -> np.ndarray:
-        target_eval = compute_dilated_mask(target, in_struct='cube')
-        return np.sum((1.0 - target_eval) * input) / (np.sum(target) + _SMOOTH)
+        return self._compute_case(self._get_case_context(target, target_cenline, input, input_cenline))
+
+    def _compute_case(self, case_context: MetricsCaseContext) -> np.ndarray:
+        counts = case_context.get_overlap_counts()
+        num_input_inside_target_eval = case_context.get_num_input_inside_dilated_target(in_struct='cube')
+        return (counts['input'] - num_input_inside_target_eval) / (counts['target'] + _SMOOTH)
 
 
 class AirwayCentrelineLeakage(MetricBase):
@@ -116,7 +435,11 @@ class AirwayCentrelineLeakage(MetricBase):
 
     def _compute_airs(self, target: np.ndarray, target_cenline: np.ndarray,
                       input: np.ndarray, input_cenline: np.ndarray) -> np.ndarray:
-        return np.sum((1.0 - target) * input_cenline) / (np.sum(target_cenline) + _SMOOTH)
+        return self._compute_case(self._get_case_context(target, target_cenline, input, input_cenline))
+
+    def _compute_case(self, case_context: MetricsCaseContext) -> np.ndarray:
+        counts = case_context.get_overlap_counts()
+        return (counts['input_cenline'] - counts[('input_cenline', 'target')]) / (counts['target_cenline'] + _SMOOTH)
 
 
 class AirwayTreeLength(MetricBase):
@@ -132,7 +455,11 @@ class AirwayTreeLength(MetricBase):
 
     def _compute_airs(self, target: np.ndarray, target_cenline: np.ndarray,
                       input: np.ndarray, input_cenline: np.ndarray) -> np.ndarray:
-        return np.sum(target_cenline * input) * self._get_voxel_length_unit()
+        return self._compute_case(self._get_case_context(target, target_cenline, input, input_cenline))
+
+    def _compute_case(self, case_context: MetricsCaseContext) -> np.ndarray:
+        counts = case_context.get_overlap_counts()
+        return counts[('target_cenline', 'input')] * self._get_voxel_length_unit()
 
 
 class AirwayCentrelineDistanceFalsePositiveError(MetricBase):
@@ -143,15 +470,15 @@ class AirwayCentrelineDistanceFalsePositiveError(MetricBase):
         super(AirwayCentrelineDistanceFalsePositiveError, self).__init__()
         self._name_fun_out = 'cenline_dist_fp_err'
 
-    def _get_cenline_coords(self, input_cenline: np.ndarray) -> np.ndarray:
-        return np.asarray(np.argwhere(input_cenline > 0)) * self._voxel_size
-
     def _compute_airs(self, target: np.ndarray, target_cenline: np.ndarray,
                       input: np.ndarray, input_cenline: np.ndarray) -> np.ndarray:
-        target_coords = self._get_cenline_coords(target_cenline)
-        input_coords = self._get_cenline_coords(input_cenline)
-        dists = distance.cdist(input_coords, target_coords)
-        return np.mean(np.min(dists, axis=1))
+        return self._compute_case(self._get_case_context(target, target_cenline, input, input_cenline))
+
+    def _compute_case(self, case_context: MetricsCaseContext) -> np.ndarray:
+        (dists_input_to_target, _) = case_context.get_cenline_nearest_dists()
+        if dists_input_to_target.size == 0:
+            return np.array(np.nan)
+        return np.mean(dists_input_to_target)
 
 
 class AirwayCentrelineDistanceFalseNegativeError(MetricBase):
@@ -162,15 +489,15 @@ class AirwayCentrelineDistanceFalseNegativeError(MetricBase):
         super(AirwayCentrelineDistanceFalseNegativeError, self).__init__()
         self._name_fun_out = 'cenline_dist_fn_err'
 
-    def _get_cenline_coords(self, input_cenline: np.ndarray) -> np.ndarray:
-        return np.asarray(np.argwhere(input_cenline > 0)) * self._voxel_size
-
     def _compute_airs(self, target: np.ndarray, target_cenline: np.ndarray,
                       input: np.ndarray, input_cenline: np.ndarray) -> np.ndarray:
-        target_coords = self._get_cenline_coords(target_cenline)
-        input_coords = self._get_cenline_coords(input_cenline)
-        dists = distance.cdist(input_coords, target_coords)
-        return np.mean(np.min(dists, axis=0))
+        return self._compute_case(self._get_case_context(target, target_cenline, input, input_cenline))
+
+    def _compute_case(self, case_context: MetricsCaseContext) -> np.ndarray:
+        (_, dists_target_to_input) = case_context.get_cenline_nearest_dists()
+        if dists_target_to_input.size == 0:
+            return np.array(np.nan)
+        return np.mean(dists_target_to_input)
 
 
 class AirwayNumberFNErrors(MetricBase):
@@ -183,10 +510,10 @@ class AirwayNumberFNErrors(MetricBase):
 
     def _compute_airs(self, target: np.ndarray, target_cenline: np.ndarray,
                       input: np.ndarray, input_cenline: np.ndarray) -> np.ndarray:
-        if self._is_dilate_rm_noise:
-            input = compute_dilated_mask(input)
-        falseneg_target_cenline = target_cenline * (1.0 - input)
-        (_, num_errors) = compute_connected_components(falseneg_target_cenline, connectivity_dim=3)
+        return self._compute_case(self._get_case_context(target, target_cenline, input, input_cenline))
+
+    def _compute_case(self, case_context: MetricsCaseContext) -> np.ndarray:
+        num_errors = case_context.get_num_components_falseneg_target_cenline(is_dilate_input=self._is_dilate_rm_noise)
         return np.array(num_errors)
 
 
@@ -200,16 +527,68 @@ class AirwayNumberFNGAPErrors(MetricBase):
 
     def _compute_airs(self, target: np.ndarray, target_cenline: np.ndarray,
                       input: np.ndarray, input_cenline: np.ndarray) -> np.ndarray:
-        truepos_target_cenline = target_cenline * input
-        if self._is_dilate_rm_noise:
-            target_cenline = compute_dilated_mask(target_cenline)
-            truepos_target_cenline = compute_dilated_mask(truepos_target_cenline)
-        (_, num_regions_init) = compute_connected_components(target_cenline, connectivity_dim=3)
-        (_, num_regions_truepos) = compute_connected_components(truepos_target_cenline, connectivity_dim=3)
+        return self._compute_case(self._get_case_context(target, target_cenline, input, input_cenline))
+
+    def _compute_case(self, case_context: MetricsCaseContext) -> np.ndarray:
+        num_regions_init = case_context.get_num_components_target_cenline(is_dilate=self._is_dilate_rm_noise)
+        num_regions_truepos = \
+            case_context.get_num_components_truepos_target_cenline(is_dilate=self._is_dilate_rm_noise)
         num_gaps = num_regions_truepos - num_regions_init
         return np.array(num_gaps)
 
 
+class HausdorffDistance(MetricBase):
+    _is_use_voxelsize = True
+
+    def __init__(self) -> None:
+        super(HausdorffDistance, self).__init__()
+        self._name_fun_out = 'hausdorff_dist'
+
+    def _compute(self, target: np.ndarray, input: np.ndarray) -> np.ndarray:
+        return self._compute_case(MetricsCaseContext(target, input, voxel_size=self._voxel_size))
+
+    def _compute_case(self, case_context: MetricsCaseContext) -> np.ndarray:
+        (dists_input_to_target, dists_target_to_input) = case_context.get_surface_nearest_dists()
+        if dists_input_to_target.size == 0:
+            return np.array(np.nan)
+        return np.maximum(np.max(dists_input_to_target), np.max(dists_target_to_input))
+
+
+class HausdorffDistance95(MetricBase):
+    _is_use_voxelsize = True
+
+    def __init__(self) -> None:
+        super(HausdorffDistance95, self).__init__()
+        self._name_fun_out = 'hausdorff95_dist'
+
+    def _compute(self, target: np.ndarray, input: np.ndarray) -> np.ndarray:
+        return self._compute_case(MetricsCaseContext(target, input, voxel_size=self._voxel_size))
+
+    def _compute_case(self, case_context: MetricsCaseContext) -> np.ndarray:
+        (dists_input_to_target, dists_target_to_input) = case_context.get_surface_nearest_dists()
+        if dists_input_to_target.size == 0:
+            return np.array(np.nan)
+        return np.maximum(np.percentile(dists_input_to_target, 95), np.percentile(dists_target_to_input, 95))
+
+
+class AverageSymmetricSurfaceDistance(MetricBase):
+    _is_use_voxelsize = True
+
+    def __init__(self) -> None:
+        super(AverageSymmetricSurfaceDistance, self).__init__()
+        self._name_fun_out = 'assd'
+
+    def _compute(self, target: np.ndarray, input: np.ndarray) -> np.ndarray:
+        return self._compute_case(MetricsCaseContext(target, input, voxel_size=self._voxel_size))
+
+    def _compute_case(self, case_context: MetricsCaseContext) -> np.ndarray:
+        (dists_input_to_target, dists_target_to_input) = case_context.get_surface_nearest_dists()
+        if dists_input_to_target.size == 0:
+            return np.array(np.nan)
+        return (np.sum(dists_input_to_target) + np.sum(dists_target_to_input)) \
+            / (dists_input_to_target.size + dists_target_to_input.size)
+
+
 def get_metric(type_metric: str, **kwargs) -> MetricBase:
     if type_metric == 'DiceCoefficient':
         return DiceCoefficient()
@@ -231,6 +610,12 @@ def get_metric(type_metric: str, **kwargs) -> MetricBase:
         return AirwayNumberFNErrors()
     elif type_metric == 'AirwayNumberFNGAPErrors':
         return AirwayNumberFNGAPErrors()
+    elif type_metric == 'HausdorffDistance':
+        return HausdorffDistance()
+    elif type_metric == 'HausdorffDistance95':
+        return HausdorffDistance95()
+    elif type_metric == 'AverageSymmetricSurfaceDistance':
+        return AverageSymmetricSurfaceDistance()
     else:
         message = 'Choice Metric not found: \'%s\'. Metrics available: \'%s\'' \
                   % (type_metric, ', '.join(LIST_AVAIL_METRICS))
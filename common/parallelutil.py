@@ -0,0 +1,116 @@
+
+from typing import List, Tuple, Callable, Iterator, Any
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+
+class PrefetchCaseLoader(object):
+    # iterate over the cases, loading the data for the next cases in background threads while the current case
+    # is processed. The number of cases loaded in advance is bounded by 'num_prefetch', and their total (estimated)
+    # memory by 'max_memory', in bytes (the current case is always loaded, whatever its size)
+
+    def __init__(self, list_cases: List[Any], fun_load_case: Callable[[Any], Any], num_prefetch: int = 1,
+                 num_threads: int = 2, max_memory: int = None, fun_estim_memory_case: Callable[[Any], int] = None
+                 ) -> None:
+        self._list_cases = list_cases
+        self._fun_load_case = fun_load_case
+        self._num_prefetch = num_prefetch
+        self._num_threads = num_threads
+        self._max_memory = max_memory
+        self._fun_estim_memory_case = fun_estim_memory_case
+
+    def __len__(self) -> int:
+        return len(self._list_cases)
+
+    def __iter__(self) -> Iterator[Tuple[Any, Any]]:
+        num_cases = len(self._list_cases)
+        index_next_case = 0
+        queue_loading_cases = deque()
+        memory_loaded_cases = 0     # memory of the cases loading, loaded or being processed
+
+        with ThreadPoolExecutor(max_workers=self._num_threads) as executor:
+            while True:
+                # launch the loading of the next cases, while the limits allow it
+                while index_next_case < num_cases and len(queue_loading_cases) <= self._num_prefetch:
+                    in_case = self._list_cases[index_next_case]
+                    memory_case = self._fun_estim_memory_case(in_case) \
+                        if self._max_memory and self._fun_estim_memory_case else 0
+
+                    if queue_loading_cases and self._max_memory \
+                            and (memory_loaded_cases + memory_case > self._max_memory):
+                        break
+
+                    future_case = executor.submit(self._fun_load_case, in_case)
+                    queue_loading_cases.append((in_case, future_case, memory_case))
+                    memory_loaded_cases += memory_case
+                    index_next_case += 1
+                # endwhile
+
+                if not queue_loading_cases:
+                    break
+
+                (in_case, future_case, memory_case) = queue_loading_cases.popleft()
+                yield (in_case, future_case.result())   # errors when loading are raised here
+
+                memory_loaded_cases -= memory_case
+            # endwhile
+
+
+class ParallelCaseProcessor(object):
+    # process the cases in a pool of worker processes, and iterate over the results in the same order as the cases.
+    # The number of cases processed at the same time is bounded by 'num_workers', and their total (estimated) memory
+    # by 'max_memory', in bytes (one case is always processed, whatever its size). The function to process the cases
+    # (and 'fun_init_worker', run once in each worker) must be picklable, i.e. defined at module level
+
+    def __init__(self, list_cases: List[Any], fun_process_case: Callable[[Any], Any], num_workers: int = 1,
+                 max_memory: int = None, fun_estim_memory_case: Callable[[Any], int] = None,
+                 fun_init_worker: Callable[[], None] = None) -> None:
+        self._list_cases = list_cases
+        self._fun_process_case = fun_process_case
+        self._num_workers = num_workers
+        self._max_memory = max_memory
+        self._fun_estim_memory_case = fun_estim_memory_case
+        self._fun_init_worker = fun_init_worker
+
+    def __len__(self) -> int:
+        return len(self._list_cases)
+
+    def __iter__(self) -> Iterator[Tuple[Any, Any]]:
+        num_cases = len(self._list_cases)
+        index_next_case = 0
+        index_next_output = 0
+        dict_running_cases = {}     # future -> (index case, memory case)
+        dict_finished_cases = {}    # index case -> result, for the cases finished before the previous ones
+        memory_running_cases = 0
+
+        with ProcessPoolExecutor(max_workers=self._num_workers, initializer=self._fun_init_worker) as executor:
+            while index_next_output < num_cases:
+                # launch the processing of the next cases, while the limits allow it
+                while index_next_case < num_cases and len(dict_running_cases) < self._num_workers:
+                    in_case = self._list_cases[index_next_case]
+                    memory_case = self._fun_estim_memory_case(in_case) \
+                        if self._max_memory and self._fun_estim_memory_case else 0
+
+                    if dict_running_cases and self._max_memory \
+                            and (memory_running_cases + memory_case > self._max_memory):
+                        break
+
+                    future_case = executor.submit(self._fun_process_case, in_case)
+                    dict_running_cases[future_case] = (index_next_case, memory_case)
+                    memory_running_cases += memory_case
+                    index_next_case += 1
+                # endwhile
+
+                if index_next_output in dict_finished_cases:
+                    out_result = dict_finished_cases.pop(index_next_output)
+                    yield (self._list_cases[index_next_output], out_result)
+                    index_next_output += 1
+                    continue
+
+                (finished_futures, _) = wait(list(dict_running_cases.keys()), return_when=FIRST_COMPLETED)
+                for future_case in finished_futures:
+                    (index_case, memory_case) = dict_running_cases.pop(future_case)
+                    memory_running_cases -= memory_case
+                    dict_finished_cases[index_case] = future_case.result()  # errors in the workers are raised here
+                # endfor
+            # endwhile
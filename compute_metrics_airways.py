@@ -1,10 +1,15 @@
 
 from collections import OrderedDict
+from functools import partial
 import argparse
 
 from common.functionutil import *
-from common.filereader import NiftiFileReader
-from common.metrics import get_metric
+from common.filereader import NiftiFileReader, CsvFileReader, DICT_FIELD_TYPES_RESULTS_PER_BRANCH, \
+    get_image_file_reader
+from common.parallelutil import PrefetchCaseLoader, ParallelCaseProcessor
+from common.metrics import MetricBase, MetricsCaseContext, get_metric
+from common.branchmetrics import BranchLabelMapCache, compute_counts_per_branch, compute_counts_per_generation, \
+    compute_metrics_from_counts, write_metrics_per_branch, write_metrics_per_generation
 
 LIST_CALC_METRICS_DEFAULT = ['DiceCoefficient',
                              'AirwayCompleteness',
@@ -17,6 +22,205 @@ LIST_CALC_METRICS_DEFAULT = ['DiceCoefficient',
                              'AirwayNumberFNErrors',
                              'AirwayNumberFNGAPErrors',
                              ]
+FACTOR_MEMORY_COMPUTE_CASE = 4  # peak memory to compute the metrics of a case, relative to the size of its volumes
+
+
+def get_list_metrics(list_type_metrics: List[str]) -> Dict[str, MetricBase]:
+    list_metrics = OrderedDict()
+    for itype_metric in list_type_metrics:
+        new_metric = get_metric(itype_metric)
+        list_metrics[new_metric._name_fun_out] = new_metric
+    # endfor
+    return list_metrics
+
+
+def set_caches(args: argparse.Namespace) -> None:
+    if args.cache_images_dir:
+        cache_images_max_bytes = int(args.cache_images_max_gbytes * 1024 ** 3) \
+            if args.cache_images_max_gbytes else None
+        NiftiFileReader.set_cache_images(args.cache_images_dir, cache_images_max_bytes)
+    if args.cache_label_maps_dir:
+        BranchLabelMapCache.set_cache_dir(args.cache_label_maps_dir)
+
+
+def load_images_case(in_case_files: Tuple[str, ...]) -> Tuple[np.ndarray, ...]:
+    (_, in_predicted_mask_file, in_predicted_cenline_file,
+     in_reference_mask_file, in_reference_cenline_file, in_coarse_airways_file) = in_case_files
+
+    in_predicted_mask = NiftiFileReader.get_image(in_predicted_mask_file, dtype=np.uint8)
+    in_predicted_cenline = get_image_file_reader(in_predicted_cenline_file).get_image(in_predicted_cenline_file,
+                                                                                      dtype=np.uint8)
+    in_reference_mask = NiftiFileReader.get_image(in_reference_mask_file, dtype=np.uint8, is_cache=True)
+    in_reference_cenline = get_image_file_reader(in_reference_cenline_file).get_image(in_reference_cenline_file,
+                                                                                      dtype=np.uint8, is_cache=True)
+    if in_coarse_airways_file:
+        in_coarse_airways = NiftiFileReader.get_image(in_coarse_airways_file, dtype=np.uint8, is_cache=True)
+    else:
+        in_coarse_airways = None
+
+    return (in_predicted_mask, in_predicted_cenline, in_reference_mask, in_reference_cenline, in_coarse_airways)
+
+
+def estim_memory_load_case(in_case_files: Tuple[str, ...]) -> int:
+    # all volumes of the case have the same size
+    num_volumes_case = len([ifile for ifile in in_case_files[1:] if ifile])
+    return num_volumes_case * NiftiFileReader.get_image_memory_size(in_case_files[1], dtype=np.uint8)
+
+
+def estim_memory_compute_case(in_case_files: Tuple[str, ...]) -> int:
+    return FACTOR_MEMORY_COMPUTE_CASE * estim_memory_load_case(in_case_files)
+
+
+def get_boundbox_foreground_case(in_masks: List[np.ndarray], args: argparse.Namespace
+                                 ) -> Union[Tuple[Tuple[int, int], ...], None]:
+    # bounding-box of the masks and centrelines, to compute the metrics with the same results as in the full
+    # volumes: padded with the voxels reached by the dilation of the coarse airways, and the dilations in the
+    # metrics (1 iteration, with a margin). None if all the masks are empty
+    size_pad_boundbox = (4 if args.is_remove_trachea else 0) + 2
+
+    out_boundbox = compute_boundbox_union([compute_boundbox_mask(in_mask) for in_mask in in_masks])
+    if out_boundbox is not None:
+        out_boundbox = compute_boundbox_padded(out_boundbox, size_pad_boundbox, in_masks[0].shape)
+    return out_boundbox
+
+
+def prepare_reference_case(in_case_files: Tuple[str, ...], in_reference_mask: np.ndarray,
+                           in_reference_cenline: np.ndarray, in_coarse_airways: np.ndarray,
+                           in_boundbox_images: Union[Tuple[Tuple[int, int], ...], None], args: argparse.Namespace
+                           ) -> Tuple[MetricsCaseContext, np.ndarray, Union[Tuple[Tuple[int, int], ...], None]]:
+    # the part of the evaluation that depends only on the reference: crop to the bounding-box (if given), and remove
+    # the trachea and main bronchi. Returns the context of the metrics with the reference (to get the contexts for
+    # the predictions), the dilated coarse airways to remove from the predictions, and the bounding-box
+    (_, _, _, in_reference_mask_file, _, in_coarse_airways_file) = in_case_files
+
+    if in_boundbox_images is not None:
+        print("Crop the volumes to the bounding-box of the foreground: %s..." % (str(in_boundbox_images)))
+
+        in_reference_mask = crop_image_boundbox(in_reference_mask, in_boundbox_images)
+        in_reference_cenline = crop_image_boundbox(in_reference_cenline, in_boundbox_images)
+        if in_coarse_airways is not None:
+            in_coarse_airways = crop_image_boundbox(in_coarse_airways, in_boundbox_images)
+
+    # ---------------
+
+    if args.is_remove_trachea:
+        print("Remove trachea and main bronchi masks in computed metrics...")
+        print("Coarse Airways mask file: \'%s\'..." % (basename(in_coarse_airways_file)))
+
+        print("Dilate coarse airways masks 4 levels to remove completely the trachea and main bronchi from "
+              "the predictions and the ground-truth...")
+        in_coarse_airways = compute_dilated_mask(in_coarse_airways, num_iters=4)
+
+        in_reference_mask = compute_substracted_two_masks(in_reference_mask, in_coarse_airways)
+        in_reference_cenline = compute_substracted_two_masks(in_reference_cenline, in_coarse_airways)
+
+    # ---------------
+
+    # voxel size of the header in (x, y, z) -> same axes as the images (z, y, x)
+    in_mask_voxel_size = np.array(NiftiFileReader.get_image_voxelsize(in_reference_mask_file))[::-1]
+
+    # intermediate data of the reference (centreline coordinates, dilated masks, ...) computed once, and shared by
+    # the contexts of all the predictions of the case
+    reference_context = MetricsCaseContext(in_reference_mask, None, in_reference_cenline, None,
+                                           voxel_size=in_mask_voxel_size)
+
+    return (reference_context, in_coarse_airways, in_boundbox_images)
+
+
+def compute_metrics_case(in_case_files: Tuple[str, ...], in_images_case: Tuple[np.ndarray, ...],
+                         list_metrics: Dict[str, MetricBase], args: argparse.Namespace,
+                         in_reference_case: Tuple[Any, ...] = None) -> List[float]:
+    # 'in_reference_case': output of 'prepare_reference_case' for this case, when evaluating several predictions of
+    # the same case (computed here if not given). In that case, 'in_images_case' needs only the predicted volumes
+    (in_casename, in_predicted_mask_file, in_predicted_cenline_file,
+     in_reference_mask_file, in_reference_cenline_file, in_coarse_airways_file) = in_case_files
+    print("\nInput: \'%s\'..." % (basename(in_predicted_mask_file)))
+    print("And: \'%s\'..." % (basename(in_predicted_cenline_file)))
+    print("Reference mask file: \'%s\'..." % (basename(in_reference_mask_file)))
+    print("Reference centrelines file: \'%s\'..." % (basename(in_reference_cenline_file)))
+
+    (in_predicted_mask, in_predicted_cenline) = in_images_case[:2]
+
+    # ---------------
+
+    if in_reference_case is None:
+        (in_reference_mask, in_reference_cenline, in_coarse_airways) = in_images_case[2:]
+
+        if args.is_crop_foreground:
+            in_boundbox_images = get_boundbox_foreground_case([in_predicted_mask, in_predicted_cenline,
+                                                               in_reference_mask, in_reference_cenline], args)
+        else:
+            in_boundbox_images = None
+
+        in_reference_case = prepare_reference_case(in_case_files, in_reference_mask, in_reference_cenline,
+                                                   in_coarse_airways, in_boundbox_images, args)
+
+    (reference_context, in_coarse_airways, in_boundbox_images) = in_reference_case
+
+    if in_boundbox_images is not None:
+        in_predicted_mask = crop_image_boundbox(in_predicted_mask, in_boundbox_images)
+        in_predicted_cenline = crop_image_boundbox(in_predicted_cenline, in_boundbox_images)
+
+    if args.is_remove_trachea:
+        in_predicted_mask = compute_substracted_two_masks(in_predicted_mask, in_coarse_airways)
+        in_predicted_cenline = compute_substracted_two_masks(in_predicted_cenline, in_coarse_airways)
+
+    # ---------------
+
+    print("\nCompute the Metrics:")
+    outlist_calc_metrics = []
+
+    # intermediate data (centreline coordinates, dilated masks, ...) computed once and shared by all metrics
+    case_context = reference_context.get_context_new_input(in_predicted_mask, in_predicted_cenline)
+
+    for (imetric_name, imetric) in list_metrics.items():
+        outval_metric = imetric.compute_case(case_context)
+
+        print("\'%s\': %s..." % (imetric_name, outval_metric))
+        outlist_calc_metrics.append(outval_metric)
+    # endfor
+
+    # ---------------
+
+    if args.is_calc_per_branch:
+        print("\nCompute the Metrics per branch and per generation:")
+        in_branches_table_file = in_casename + '_ResultsPerBranch.csv'
+        in_branches_table_file = join_path_names(join_path_names(args.refer_datadir, './AirwayMeasurements'),
+                                                 in_branches_table_file)
+        print("Branches measures file: \'%s\'..." % (basename(in_branches_table_file)))
+
+        # map of voxels to the nearest branch: computed only the first time for each reference case
+        (in_label_map, in_boundbox_label_map) = BranchLabelMapCache.get_label_map(in_reference_cenline_file,
+                                                                                  in_branches_table_file)
+        in_branches_data = CsvFileReader.get_data_columns(in_branches_table_file, DICT_FIELD_TYPES_RESULTS_PER_BRANCH)
+        num_branches = len(in_branches_data['airway_ID'])
+
+        in_counts_branches = compute_counts_per_branch(in_label_map, in_boundbox_label_map, num_branches,
+                                                       case_context.get_target(), case_context.get_target_cenline(),
+                                                       in_predicted_mask, in_boundbox_images)
+        (in_generations, in_num_branches_generations, in_counts_generations) = \
+            compute_counts_per_generation(in_counts_branches, in_branches_data['generation'])
+
+        out_metrics_per_branch_file = in_casename + '_metrics_per_branch.csv'
+        out_metrics_per_branch_file = join_path_names(args.output_per_branch_dir, out_metrics_per_branch_file)
+        out_metrics_per_generation_file = in_casename + '_metrics_per_generation.csv'
+        out_metrics_per_generation_file = join_path_names(args.output_per_branch_dir, out_metrics_per_generation_file)
+        print("Output: \'%s\'..." % (basename(out_metrics_per_branch_file)))
+        print("And: \'%s\'..." % (basename(out_metrics_per_generation_file)))
+
+        write_metrics_per_branch(out_metrics_per_branch_file, in_branches_data['airway_ID'],
+                                 in_branches_data['generation'], compute_metrics_from_counts(in_counts_branches))
+        write_metrics_per_generation(out_metrics_per_generation_file, in_generations, in_num_branches_generations,
+                                     compute_metrics_from_counts(in_counts_generations))
+
+    return outlist_calc_metrics
+
+
+def process_case(in_case_files: Tuple[str, ...], args: argparse.Namespace) -> List[float]:
+    # run in the worker processes: load the volumes and compute the metrics of one case
+    list_metrics = get_list_metrics(args.list_type_metrics)
+    in_images_case = load_images_case(in_case_files)
+    return compute_metrics_case(in_case_files, in_images_case, list_metrics, args)
 
 
 def main(args):
@@ -43,82 +247,90 @@ def main(args):
         message = 'Input dirs for predicted masks and centrelines have different number of files...'
         handle_error_message(message)
 
-    list_metrics = OrderedDict()
-    for itype_metric in args.list_type_metrics:
-        new_metric = get_metric(itype_metric)
-        list_metrics[new_metric._name_fun_out] = new_metric
-    # endfor
+    if args.cache_images_dir:
+        print("Cache uncompressed copies of the reference volumes in: \'%s\'..." % (args.cache_images_dir))
+    if args.cache_label_maps_dir:
+        print("Cache the maps of voxels to airway branches in: \'%s\'..." % (args.cache_label_maps_dir))
+    set_caches(args)
 
-    # **********************
+    if args.is_calc_per_branch:
+        makedir(args.output_per_branch_dir)
 
-    outdict_calc_metrics = OrderedDict()
+    list_metrics = get_list_metrics(args.list_type_metrics)
 
-    for i, (in_predicted_mask_file, in_predicted_cenline_file) in \
-            enumerate(zip(list_input_predicted_masks_files, list_input_predicted_cenlines_files)):
-        print("\nInput: \'%s\'..." % (basename(in_predicted_mask_file)))
-        print("And: \'%s\'..." % (basename(in_predicted_cenline_file)))
+    # **********************
+
+    list_input_cases_files = []
+    for (in_predicted_mask_file, in_predicted_cenline_file) in \
+            zip(list_input_predicted_masks_files, list_input_predicted_cenlines_files):
         in_casename = get_casename_filename(in_predicted_mask_file)
 
         in_reference_mask_file = in_casename + '_manual-airways.nii.gz'
         in_reference_mask_file = join_path_names(input_reference_masks_dir, in_reference_mask_file)
-        print("Reference mask file: \'%s\'..." % (basename(in_reference_mask_file)))
 
         in_reference_cenline_file = in_casename + '_manual-airways_cenlines.nii.gz'
         in_reference_cenline_file = join_path_names(input_reference_cenlines_dir, in_reference_cenline_file)
-        print("Reference centrelines file: \'%s\'..." % (basename(in_reference_cenline_file)))
-
-        in_predicted_mask = NiftiFileReader.get_image(in_predicted_mask_file)
-        in_predicted_cenline = NiftiFileReader.get_image(in_predicted_cenline_file)
-        in_reference_mask = NiftiFileReader.get_image(in_reference_mask_file)
-        in_reference_cenline = NiftiFileReader.get_image(in_reference_cenline_file)
-
-        # ---------------
 
         if args.is_remove_trachea:
-            print("Remove trachea and main bronchi masks in computed metrics...")
-
             in_coarse_airways_file = in_casename + '-airways.nii.gz'
             in_coarse_airways_file = join_path_names(input_coarse_airways_dir, in_coarse_airways_file)
-            print("Coarse Airways mask file: \'%s\'..." % (basename(in_coarse_airways_file)))
+        else:
+            in_coarse_airways_file = None
 
-            in_coarse_airways = NiftiFileReader.get_image(in_coarse_airways_file)
-
-            print("Dilate coarse airways masks 4 levels to remove completely the trachea and main bronchi from "
-                  "the predictions and the ground-truth...")
-            in_coarse_airways = compute_dilated_mask(in_coarse_airways, num_iters=4)
-
-            in_predicted_mask = compute_substracted_two_masks(in_predicted_mask, in_coarse_airways)
-            in_predicted_cenline = compute_substracted_two_masks(in_predicted_cenline, in_coarse_airways)
-            in_reference_mask = compute_substracted_two_masks(in_reference_mask, in_coarse_airways)
-            in_reference_cenline = compute_substracted_two_masks(in_reference_cenline, in_coarse_airways)
-
-        # ---------------
-
-        print("\nCompute the Metrics:")
-        outdict_calc_metrics[in_casename] = []
-
-        for (imetric_name, imetric) in list_metrics.items():
-            if imetric._is_use_voxelsize:
-                in_mask_voxel_size = NiftiFileReader.get_image_voxelsize(in_predicted_mask_file)
-                imetric.set_voxel_size(in_mask_voxel_size)
-
-            outval_metric = imetric.compute(in_reference_mask, in_predicted_mask,
-                                            in_reference_cenline, in_predicted_cenline)
-
-            print("\'%s\': %s..." % (imetric_name, outval_metric))
-            outdict_calc_metrics[in_casename].append(outval_metric)
-        # endfor
+        list_input_cases_files.append((in_casename, in_predicted_mask_file, in_predicted_cenline_file,
+                                       in_reference_mask_file, in_reference_cenline_file, in_coarse_airways_file))
     # endfor
 
-    # write out computed metrics in file
-    fout = open(args.output_result_file, 'w')
+    # **********************
+
+    # write out computed metrics in file, the row for each case as soon as it is computed
     strheader = ', '.join(['/case/'] + ['/%s/' % (key) for key in list_metrics.keys()]) + '\n'
-    fout.write(strheader)
 
-    for (in_casename, outlist_calc_metrics) in outdict_calc_metrics.items():
+    if args.is_resume and is_exist_file(args.output_result_file):
+        with open(args.output_result_file, 'r') as fin:
+            # discard the last row if it was not completely written
+            list_lines_done = [line for line in fin.readlines() if line.endswith('\n')]
+
+        if not list_lines_done or list_lines_done[0] != strheader:
+            message = 'Cannot resume from the output file \'%s\', with different metrics in the header' \
+                      % (args.output_result_file)
+            handle_error_message(message)
+
+        list_casenames_done = [line.split(',')[0].strip() for line in list_lines_done[1:]]
+        list_input_cases_files = [in_case_files for in_case_files in list_input_cases_files
+                                  if in_case_files[0] not in list_casenames_done]
+        print("\nResume: skip %s cases already in the output file..." % (len(list_casenames_done)))
+
+        fout = open(args.output_result_file, 'w')
+        fout.write(''.join(list_lines_done))
+    else:
+        fout = open(args.output_result_file, 'w')
+        fout.write(strheader)
+    fout.flush()
+
+    if args.num_workers > 1:
+        # compute the metrics for several cases in parallel, and output the rows in the same order as the cases
+        workers_max_bytes = int(args.workers_max_gbytes * 1024 ** 3) if args.workers_max_gbytes else None
+        iterator_cases_metrics = ParallelCaseProcessor(list_input_cases_files, partial(process_case, args=args),
+                                                       num_workers=args.num_workers, max_memory=workers_max_bytes,
+                                                       fun_estim_memory_case=estim_memory_compute_case,
+                                                       fun_init_worker=partial(set_caches, args))
+    else:
+        # load the volumes for the next cases in background, while computing the metrics for the current case
+        prefetch_max_bytes = int(args.prefetch_max_gbytes * 1024 ** 3) if args.prefetch_max_gbytes else None
+        case_loader = PrefetchCaseLoader(list_input_cases_files, load_images_case,
+                                         num_prefetch=args.num_prefetch_cases, max_memory=prefetch_max_bytes,
+                                         fun_estim_memory_case=estim_memory_load_case)
+        iterator_cases_metrics = ((in_case_files, compute_metrics_case(in_case_files, in_images_case,
+                                                                       list_metrics, args))
+                                  for (in_case_files, in_images_case) in case_loader)
+
+    for (in_case_files, outlist_calc_metrics) in iterator_cases_metrics:
+        in_casename = in_case_files[0]
         list_write_data = [in_casename] + ['%0.6f' % (elem) for elem in outlist_calc_metrics]
         strdata = ', '.join(list_write_data) + '\n'
         fout.write(strdata)
+        fout.flush()
     # endfor
     fout.close()
 
@@ -131,6 +343,17 @@ if __name__ == '__main__':
     parser.add_argument('--input_cenlines_dir', type=str, default='./Centrelines/')
     parser.add_argument('--list_type_metrics', type=str, nargs='*', default=LIST_CALC_METRICS_DEFAULT)
     parser.add_argument('--output_result_file', type=str, default='./result_metrics.csv')
+    parser.add_argument('--cache_images_dir', type=str, default=None)
+    parser.add_argument('--cache_images_max_gbytes', type=float, default=None)
+    parser.add_argument('--num_prefetch_cases', type=int, default=1)
+    parser.add_argument('--prefetch_max_gbytes', type=float, default=None)
+    parser.add_argument('--num_workers', type=int, default=1)
+    parser.add_argument('--workers_max_gbytes', type=float, default=None)
+    parser.add_argument('--is_resume', type=bool, default=False)
+    parser.add_argument('--is_crop_foreground', type=bool, default=False)
+    parser.add_argument('--is_calc_per_branch', type=bool, default=False)
+    parser.add_argument('--output_per_branch_dir', type=str, default='./MetricsPerBranch/')
+    parser.add_argument('--cache_label_maps_dir', type=str, default=None)
     parser.add_argument('--is_remove_trachea', type=bool, default=True)
     args = parser.parse_args()
 
@@ -142,5 +365,6 @@ if __name__ == '__main__':
     args.input_masks_dir = join_path_names(args.input_basedir, args.input_masks_dir)
     args.input_cenlines_dir = join_path_names(args.input_basedir, args.input_cenlines_dir)
     args.output_result_file = join_path_names(args.input_basedir, args.output_result_file)
+    args.output_per_branch_dir = join_path_names(args.input_basedir, args.output_per_branch_dir)
 
     main(args)
@@ -0,0 +1,200 @@
+
+from collections import OrderedDict
+import argparse
+
+from common.functionutil import *
+from common.filereader import NiftiFileReader, get_image_file_reader
+from common.parallelutil import PrefetchCaseLoader
+from common.metrics import MetricBase, MetricsThresholdsCaseContext, LIST_AVAIL_METRICS_THRESHOLDS, get_metric
+
+LIST_CALC_METRICS_DEFAULT = ['DiceCoefficient',
+                             'AirwayCompleteness',
+                             'AirwayVolumeLeakage',
+                             ]
+LIST_VALUES_THRESHOLD_DEFAULT = [0.05, 0.1, 0.15, 0.2, 0.25, 0.3, 0.35, 0.4, 0.45, 0.5,
+                                 0.55, 0.6, 0.65, 0.7, 0.75, 0.8, 0.85, 0.9, 0.95]
+
+
+def get_list_metrics(list_type_metrics: List[str]) -> Dict[str, MetricBase]:
+    list_metrics = OrderedDict()
+    for itype_metric in list_type_metrics:
+        if itype_metric not in LIST_AVAIL_METRICS_THRESHOLDS:
+            message = 'Metric \'%s\' cannot be computed for many thresholds at once. Metrics available: \'%s\'' \
+                      % (itype_metric, ', '.join(LIST_AVAIL_METRICS_THRESHOLDS))
+            handle_error_message(message)
+        new_metric = get_metric(itype_metric)
+        list_metrics[new_metric._name_fun_out] = new_metric
+    # endfor
+    return list_metrics
+
+
+def main(args):
+
+    # SETTINGS
+    input_roimasks_dir = join_path_names(args.refer_datadir, './Lungs')
+    input_coarse_airways_dir = join_path_names(args.refer_datadir, './CoarseAirways')
+    input_reference_masks_dir = join_path_names(args.refer_datadir, './Airways')
+    input_reference_cenlines_dir = join_path_names(args.refer_datadir, './Centrelines')
+
+    def get_casename_filename(in_filename: str):
+        suffix_name = '_probmap'    # IF POSTERIOR FILES HAVE A SUFFIX, PUT HERE
+        return basename(in_filename).replace(suffix_name + '.nii.gz', '')
+    # --------
+
+    list_input_posteriors_files = list_files_dir(args.input_posters_dir)
+
+    list_metrics = get_list_metrics(args.list_type_metrics)
+
+    in_values_threshold = np.array(args.list_values_threshold)
+
+    # **********************
+
+    list_input_cases_files = []
+    for in_posterior_file in list_input_posteriors_files:
+        in_casename = get_casename_filename(in_posterior_file)
+
+        if args.is_mask_region_interest:
+            in_roimask_file = in_casename + '-lungs.nii.gz'
+            in_roimask_file = join_path_names(input_roimasks_dir, in_roimask_file)
+        else:
+            in_roimask_file = None
+
+        if args.is_attach_coarse_airways or args.is_remove_trachea:
+            in_coarse_airways_file = in_casename + '-airways.nii.gz'
+            in_coarse_airways_file = join_path_names(input_coarse_airways_dir, in_coarse_airways_file)
+        else:
+            in_coarse_airways_file = None
+
+        in_reference_mask_file = in_casename + '_manual-airways.nii.gz'
+        in_reference_mask_file = join_path_names(input_reference_masks_dir, in_reference_mask_file)
+
+        in_reference_cenline_file = in_casename + '_manual-airways_cenlines.nii.gz'
+        in_reference_cenline_file = join_path_names(input_reference_cenlines_dir, in_reference_cenline_file)
+
+        list_input_cases_files.append((in_casename, in_posterior_file, in_roimask_file, in_coarse_airways_file,
+                                       in_reference_mask_file, in_reference_cenline_file))
+    # endfor
+
+    def load_images_case(in_case_files: Tuple[str, ...]) -> Tuple[np.ndarray, ...]:
+        (_, in_posterior_file, in_roimask_file, in_coarse_airways_file,
+         in_reference_mask_file, in_reference_cenline_file) = in_case_files
+
+        in_posterior = NiftiFileReader.get_image(in_posterior_file, dtype=np.float32)
+        in_roimask = NiftiFileReader.get_image(in_roimask_file, dtype=np.uint8) if in_roimask_file else None
+        in_coarse_airways = NiftiFileReader.get_image(in_coarse_airways_file, dtype=np.uint8) \
+            if in_coarse_airways_file else None
+        in_reference_mask = NiftiFileReader.get_image(in_reference_mask_file, dtype=np.uint8)
+        in_reference_cenline = get_image_file_reader(in_reference_cenline_file).get_image(in_reference_cenline_file,
+                                                                                          dtype=np.uint8)
+        return (in_posterior, in_roimask, in_coarse_airways, in_reference_mask, in_reference_cenline)
+
+    def estim_memory_case(in_case_files: Tuple[str, ...]) -> int:
+        in_posterior_file = in_case_files[1]
+        num_masks_case = len([ifile for ifile in in_case_files[2:] if ifile])
+        return NiftiFileReader.get_image_memory_size(in_posterior_file, dtype=np.float32) \
+            + num_masks_case * NiftiFileReader.get_image_memory_size(in_posterior_file, dtype=np.uint8)
+
+    # **********************
+
+    # write out computed metrics in file: one row for each case and threshold
+    fout = open(args.output_result_file, 'w')
+    strheader = ', '.join(['/case/', '/threshold/'] + ['/%s/' % (key) for key in list_metrics.keys()]) + '\n'
+    fout.write(strheader)
+
+    # load the volumes for the next cases in background, while computing the metrics for the current case
+    prefetch_max_bytes = int(args.prefetch_max_gbytes * 1024 ** 3) if args.prefetch_max_gbytes else None
+    case_loader = PrefetchCaseLoader(list_input_cases_files, load_images_case, num_prefetch=args.num_prefetch_cases,
+                                     max_memory=prefetch_max_bytes, fun_estim_memory_case=estim_memory_case)
+
+    for (in_case_files, in_images_case) in case_loader:
+        (in_casename, in_posterior_file, in_roimask_file, in_coarse_airways_file,
+         in_reference_mask_file, in_reference_cenline_file) = in_case_files
+        print("\nInput: \'%s\'..." % (basename(in_posterior_file)))
+        print("Reference mask file: \'%s\'..." % (basename(in_reference_mask_file)))
+        print("Reference centreline file: \'%s\'..." % (basename(in_reference_cenline_file)))
+
+        (in_posterior, in_roimask, in_coarse_airways, in_reference_mask, in_reference_cenline) = in_images_case
+
+        # ---------------
+
+        # the same steps as when post-processing the posteriors and computing the metrics, but applied to the
+        # posteriors, to compute the metrics for all the thresholds from the same volume
+
+        if args.is_mask_region_interest:
+            print("Input data to Network were masked to ROI (lungs) -> Reverse mask in predictions...")
+            print("ROI mask (lungs) file: \'%s\'..." % (basename(in_roimask_file)))
+
+            in_posterior = compute_multiplied_two_masks(in_posterior, in_roimask)
+
+        if args.is_attach_coarse_airways:
+            print("Attach Trachea and Main Bronchi mask to complete the predictions, for all thresholds...")
+            print("Coarse Airways mask file: \'%s\'..." % (basename(in_coarse_airways_file)))
+
+            in_posterior[in_coarse_airways > 0] = np.inf
+
+        if args.is_remove_trachea:
+            print("Remove trachea and main bronchi masks in computed metrics...")
+            print("Coarse Airways mask file: \'%s\'..." % (basename(in_coarse_airways_file)))
+
+            print("Dilate coarse airways masks 4 levels to remove completely the trachea and main bronchi from "
+                  "the predictions and the ground-truth...")
+            in_coarse_airways = compute_dilated_mask(in_coarse_airways, num_iters=4)
+
+            in_posterior[in_coarse_airways > 0] = -np.inf
+            in_reference_mask = compute_substracted_two_masks(in_reference_mask, in_coarse_airways)
+            in_reference_cenline = compute_substracted_two_masks(in_reference_cenline, in_coarse_airways)
+
+        # ---------------
+
+        print("\nCompute the Metrics for thresholds: \'%s\'..." % (', '.join(map(str, args.list_values_threshold))))
+
+        # voxel size of the header in (x, y, z) -> same axes as the images (z, y, x)
+        in_voxel_size = np.array(NiftiFileReader.get_image_voxelsize(in_posterior_file))[::-1]
+
+        # voxel counts for all thresholds computed in one pass over the posteriors, and shared by all metrics
+        case_context = MetricsThresholdsCaseContext(in_reference_mask, in_posterior, in_values_threshold,
+                                                    in_reference_cenline, voxel_size=in_voxel_size)
+
+        outlist_calc_metrics = []
+        for (imetric_name, imetric) in list_metrics.items():
+            outvals_metric = imetric.compute_case(case_context)
+            outlist_calc_metrics.append(outvals_metric)
+        # endfor
+
+        for (i, ivalue_threshold) in enumerate(args.list_values_threshold):
+            print("Threshold \'%s\': %s..." % (ivalue_threshold, ', '.join(['\'%s\': %s' % (imetric_name, outvals[i])
+                  for (imetric_name, outvals) in zip(list_metrics.keys(), outlist_calc_metrics)])))
+
+            list_write_data = [in_casename, '%0.6f' % (ivalue_threshold)] \
+                + ['%0.6f' % (outvals[i]) for outvals in outlist_calc_metrics]
+            strdata = ', '.join(list_write_data) + '\n'
+            fout.write(strdata)
+        # endfor
+        fout.flush()
+    # endfor
+    fout.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_basedir', type=str, default='.')
+    parser.add_argument('--input_posters_dir', type=str, default='./Posteriors/')
+    parser.add_argument('--list_values_threshold', type=float, nargs='*', default=LIST_VALUES_THRESHOLD_DEFAULT)
+    parser.add_argument('--list_type_metrics', type=str, nargs='*', default=LIST_CALC_METRICS_DEFAULT)
+    parser.add_argument('--output_result_file', type=str, default='./result_metrics_thresholds.csv')
+    parser.add_argument('--is_mask_region_interest', type=bool, default=True)
+    parser.add_argument('--is_attach_coarse_airways', type=bool, default=True)
+    parser.add_argument('--is_remove_trachea', type=bool, default=True)
+    parser.add_argument('--num_prefetch_cases', type=int, default=1)
+    parser.add_argument('--prefetch_max_gbytes', type=float, default=None)
+    args = parser.parse_args()
+
+    # ONLY NEED TO INDICATE TWO BASE PATHS ( 1) to predicted results, 2) to reference data)
+    # args.input_basedir = '/home/antonio/Results/LabelRefinement_THIRONA/Predictions_Baseline_ANTONIO/'
+    # args.refer_datadir = '/mnt/mydrive/PythonCodes/Airway_segmentation/resources/THIRONA_Fullsize/'
+    args.refer_datadir = '/home/antonio/Data/THIRONA_Testing/'
+
+    args.input_posters_dir = join_path_names(args.input_basedir, args.input_posters_dir)
+    args.output_result_file = join_path_names(args.input_basedir, args.output_result_file)
+
+    main(args)
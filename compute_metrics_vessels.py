@@ -1,10 +1,12 @@
 
 from collections import OrderedDict
+from functools import partial
 import argparse
 
 from common.functionutil import *
-from common.filereader import NiftiFileReader
-from common.metrics import get_metric
+from common.filereader import NiftiFileReader, get_image_file_reader
+from common.parallelutil import PrefetchCaseLoader, ParallelCaseProcessor
+from common.metrics import MetricBase, MetricsCaseContext, get_metric
 
 LIST_CALC_METRICS_DEFAULT = ['DiceCoefficient',
                              'AirwayCompleteness',
@@ -17,6 +19,115 @@ LIST_CALC_METRICS_DEFAULT = ['DiceCoefficient',
                              'AirwayNumberFNErrors',
                              'AirwayNumberFNGAPErrors',
                              ]
+FACTOR_MEMORY_COMPUTE_CASE = 4  # peak memory to compute the metrics of a case, relative to the size of its volumes
+
+
+def get_list_metrics(list_type_metrics: List[str]) -> Dict[str, MetricBase]:
+    list_metrics = OrderedDict()
+    for itype_metric in list_type_metrics:
+        new_metric = get_metric(itype_metric)
+        list_metrics[new_metric._name_fun_out] = new_metric
+    # endfor
+    return list_metrics
+
+
+def set_cache_images(args: argparse.Namespace) -> None:
+    if args.cache_images_dir:
+        cache_images_max_bytes = int(args.cache_images_max_gbytes * 1024 ** 3) \
+            if args.cache_images_max_gbytes else None
+        NiftiFileReader.set_cache_images(args.cache_images_dir, cache_images_max_bytes)
+
+
+def load_images_case(in_case_files: Tuple[str, ...]) -> Tuple[np.ndarray, ...]:
+    (_, in_predicted_mask_file, in_predicted_cenline_file,
+     in_reference_mask_file, in_reference_cenline_file) = in_case_files
+
+    in_predicted_mask = NiftiFileReader.get_image(in_predicted_mask_file, dtype=np.uint8)
+    in_predicted_cenline = get_image_file_reader(in_predicted_cenline_file).get_image(in_predicted_cenline_file,
+                                                                                      dtype=np.uint8)
+    in_reference_mask = NiftiFileReader.get_image(in_reference_mask_file, dtype=np.uint8, is_cache=True)
+    in_reference_cenline = get_image_file_reader(in_reference_cenline_file).get_image(in_reference_cenline_file,
+                                                                                      dtype=np.uint8, is_cache=True)
+
+    return (in_predicted_mask, in_predicted_cenline, in_reference_mask, in_reference_cenline)
+
+
+def estim_memory_load_case(in_case_files: Tuple[str, ...]) -> int:
+    # all volumes of the case have the same size
+    num_volumes_case = len(in_case_files[1:])
+    return num_volumes_case * NiftiFileReader.get_image_memory_size(in_case_files[1], dtype=np.uint8)
+
+
+def estim_memory_compute_case(in_case_files: Tuple[str, ...]) -> int:
+    return FACTOR_MEMORY_COMPUTE_CASE * estim_memory_load_case(in_case_files)
+
+
+def compute_metrics_case(in_case_files: Tuple[str, ...], in_images_case: Tuple[np.ndarray, ...],
+                         list_metrics: Dict[str, MetricBase], args: argparse.Namespace) -> List[float]:
+    (in_casename, in_predicted_mask_file, in_predicted_cenline_file,
+     in_reference_mask_file, in_reference_cenline_file) = in_case_files
+    print("\nInput: \'%s\'..." % (basename(in_predicted_mask_file)))
+    print("And: \'%s\'..." % (basename(in_predicted_cenline_file)))
+    print("Reference mask file: \'%s\'..." % (basename(in_reference_mask_file)))
+    print("Reference centrelines file: \'%s\'..." % (basename(in_reference_cenline_file)))
+
+    (in_predicted_mask, in_predicted_cenline, in_reference_mask, in_reference_cenline) = in_images_case
+
+    # ---------------
+
+    if args.is_crop_foreground:
+        # compute the metrics in the bounding-box of the masks and centrelines, with the same results as in the
+        # full volumes: pad the bounding-box with the voxels reached by the dilation of the reference, and the
+        # dilations in the metrics (1 iteration, with a margin)
+        size_pad_boundbox = (args.times_dilate_reference if args.is_dilate_reference else 0) + 2
+
+        in_boundbox_foreground = compute_boundbox_union([compute_boundbox_mask(in_predicted_mask),
+                                                         compute_boundbox_mask(in_predicted_cenline),
+                                                         compute_boundbox_mask(in_reference_mask),
+                                                         compute_boundbox_mask(in_reference_cenline)])
+        if in_boundbox_foreground is not None:
+            in_boundbox_foreground = compute_boundbox_padded(in_boundbox_foreground, size_pad_boundbox,
+                                                             in_predicted_mask.shape)
+            print("Crop the volumes to the bounding-box of the foreground: %s..." % (str(in_boundbox_foreground)))
+
+            in_predicted_mask = crop_image_boundbox(in_predicted_mask, in_boundbox_foreground)
+            in_predicted_cenline = crop_image_boundbox(in_predicted_cenline, in_boundbox_foreground)
+            in_reference_mask = crop_image_boundbox(in_reference_mask, in_boundbox_foreground)
+            in_reference_cenline = crop_image_boundbox(in_reference_cenline, in_boundbox_foreground)
+
+    # ---------------
+
+    if args.is_dilate_reference:
+        print("Inflate (%sx times) the ground-truth vessels..." % (args.times_dilate_reference))
+
+        in_reference_mask = compute_dilated_mask(in_reference_mask, num_iters=args.times_dilate_reference)
+    # ---------------
+
+    print("\nCompute the Metrics:")
+    outlist_calc_metrics = []
+
+    # voxel size of the header in (x, y, z) -> same axes as the images (z, y, x)
+    in_mask_voxel_size = np.array(NiftiFileReader.get_image_voxelsize(in_predicted_mask_file))[::-1]
+
+    # intermediate data (centreline coordinates, dilated masks, ...) computed once and shared by all metrics
+    case_context = MetricsCaseContext(in_reference_mask, in_predicted_mask,
+                                      in_reference_cenline, in_predicted_cenline, voxel_size=in_mask_voxel_size)
+
+    for (imetric_name, imetric) in list_metrics.items():
+        outval_metric = imetric.compute_case(case_context)
+
+        print("\'%s\': %s..." % (imetric_name, outval_metric))
+        outlist_calc_metrics.append(outval_metric)
+    # endfor
+
+    return outlist_calc_metrics
+
+
+def process_case(in_case_files: Tuple[str, ...], args: argparse.Namespace) -> List[float]:
+    # run in the worker processes: load the volumes and compute the metrics of one case
+    list_metrics = get_list_metrics(args.list_type_metrics)
+    in_images_case = load_images_case(in_case_files)
+    return compute_metrics_case(in_case_files, in_images_case, list_metrics, args)
 
 
 def main(args):
@@ -41,68 +152,79 @@ def main(args):
         message = 'Input dirs for predicted masks and centrelines have different number of files...'
         handle_error_message(message)
 
-    list_metrics = OrderedDict()
-    for itype_metric in args.list_type_metrics:
-        new_metric = get_metric(itype_metric)
-        list_metrics[new_metric._name_fun_out] = new_metric
-    # endfor
+    if args.cache_images_dir:
+        print("Cache uncompressed copies of the reference volumes in: \'%s\'..." % (args.cache_images_dir))
+        set_cache_images(args)
 
-    # **********************
+    list_metrics = get_list_metrics(args.list_type_metrics)
 
-    outdict_calc_metrics = OrderedDict()
+    # **********************
 
-    for i, (in_predicted_mask_file, in_predicted_cenline_file) in \
-            enumerate(zip(list_input_predicted_masks_files, list_input_predicted_cenlines_files)):
-        print("\nInput: \'%s\'..." % (basename(in_predicted_mask_file)))
-        print("And: \'%s\'..." % (basename(in_predicted_cenline_file)))
+    list_input_cases_files = []
+    for (in_predicted_mask_file, in_predicted_cenline_file) in \
+            zip(list_input_predicted_masks_files, list_input_predicted_cenlines_files):
         in_casename = get_casename_filename(in_predicted_mask_file)
 
         in_reference_mask_file = in_casename + '_CTA.nii.gz'     # PUT HERE THE SUFFIX OF VESSEL REFERENCE
         in_reference_mask_file = join_path_names(input_reference_masks_dir, in_reference_mask_file)
-        print("Reference mask file: \'%s\'..." % (basename(in_reference_mask_file)))
 
         in_reference_cenline_file = in_casename + '_CTA_cenlines.nii.gz'    # PUT HERE THE SUFFIX OF VESSEL REFERENCE CENTRELINES
         in_reference_cenline_file = join_path_names(input_reference_cenlines_dir, in_reference_cenline_file)
-        print("Reference centrelines file: \'%s\'..." % (basename(in_reference_cenline_file)))
-
-        in_predicted_mask = NiftiFileReader.get_image(in_predicted_mask_file)
-        in_predicted_cenline = NiftiFileReader.get_image(in_predicted_cenline_file)
-        in_reference_mask = NiftiFileReader.get_image(in_reference_mask_file)
-        in_reference_cenline = NiftiFileReader.get_image(in_reference_cenline_file)
 
-        # ---------------
+        list_input_cases_files.append((in_casename, in_predicted_mask_file, in_predicted_cenline_file,
+                                       in_reference_mask_file, in_reference_cenline_file))
+    # endfor
 
-        if args.is_dilate_reference:
-            print("Inflate (%sx times) the ground-truth vessels..." % (args.times_dilate_reference))
+    # **********************
 
-            in_reference_mask = compute_dilated_mask(in_reference_mask, num_iters=args.times_dilate_reference)
-        # ---------------
+    # write out computed metrics in file, the row for each case as soon as it is computed
+    strheader = ', '.join(['/case/'] + ['/%s/' % (key) for key in list_metrics.keys()]) + '\n'
 
-        print("\nCompute the Metrics:")
-        outdict_calc_metrics[in_casename] = []
+    if args.is_resume and is_exist_file(args.output_result_file):
+        with open(args.output_result_file, 'r') as fin:
+            # discard the last row if it was not completely written
+            list_lines_done = [line for line in fin.readlines() if line.endswith('\n')]
 
-        for (imetric_name, imetric) in list_metrics.items():
-            if imetric._is_use_voxelsize:
-                in_mask_voxel_size = NiftiFileReader.get_image_voxelsize(in_predicted_mask_file)
-                imetric.set_voxel_size(in_mask_voxel_size)
+        if not list_lines_done or list_lines_done[0] != strheader:
+            message = 'Cannot resume from the output file \'%s\', with different metrics in the header' \
+                      % (args.output_result_file)
+            handle_error_message(message)
 
-            outval_metric = imetric.compute(in_reference_mask, in_predicted_mask,
-                                            in_reference_cenline, in_predicted_cenline)
+        list_casenames_done = [line.split(',')[0].strip() for line in list_lines_done[1:]]
+        list_input_cases_files = [in_case_files for in_case_files in list_input_cases_files
+                                  if in_case_files[0] not in list_casenames_done]
+        print("\nResume: skip %s cases already in the output file..." % (len(list_casenames_done)))
 
-            print("\'%s\': %s..." % (imetric_name, outval_metric))
-            outdict_calc_metrics[in_casename].append(outval_metric)
-        # endfor
-    # endfor
+        fout = open(args.output_result_file, 'w')
+        fout.write(''.join(list_lines_done))
+    else:
+        fout = open(args.output_result_file, 'w')
+        fout.write(strheader)
+    fout.flush()
 
-    # write out computed metrics in file
-    fout = open(args.output_result_file, 'w')
-    strheader = ', '.join(['/case/'] + ['/%s/' % (key) for key in list_metrics.keys()]) + '\n'
-    fout.write(strheader)
+    if args.num_workers > 1:
+        # compute the metrics for several cases in parallel, and output the rows in the same order as the cases
+        workers_max_bytes = int(args.workers_max_gbytes * 1024 ** 3) if args.workers_max_gbytes else None
+        iterator_cases_metrics = ParallelCaseProcessor(list_input_cases_files, partial(process_case, args=args),
+                                                       num_workers=args.num_workers, max_memory=workers_max_bytes,
+                                                       fun_estim_memory_case=estim_memory_compute_case,
+                                                       fun_init_worker=partial(set_cache_images, args))
+    else:
+        # load the volumes for the next cases in background, while computing the metrics for the current case
+        prefetch_max_bytes = int(args.prefetch_max_gbytes * 1024 ** 3) if args.prefetch_max_gbytes else None
+        case_loader = PrefetchCaseLoader(list_input_cases_files, load_images_case,
+                                         num_prefetch=args.num_prefetch_cases, max_memory=prefetch_max_bytes,
+                                         fun_estim_memory_case=estim_memory_load_case)
+        iterator_cases_metrics = ((in_case_files, compute_metrics_case(in_case_files, in_images_case,
+                                                                       list_metrics, args))
+                                  for (in_case_files, in_images_case) in case_loader)
 
-    for (in_casename, outlist_calc_metrics) in outdict_calc_metrics.items():
+    for (in_case_files, outlist_calc_metrics) in iterator_cases_metrics:
+        in_casename = in_case_files[0]
         list_write_data = [in_casename] + ['%0.6f' % (elem) for elem in outlist_calc_metrics]
         strdata = ', '.join(list_write_data) + '\n'
         fout.write(strdata)
+        fout.flush()
     # endfor
     fout.close()
 
@@ -115,6 +237,14 @@ if __name__ == '__main__':
     parser.add_argument('--input_cenlines_dir', type=str, default='./Centrelines/')
     parser.add_argument('--list_type_metrics', type=str, nargs='*', default=LIST_CALC_METRICS_DEFAULT)
     parser.add_argument('--output_result_file', type=str, default='./result_metrics.csv')
+    parser.add_argument('--cache_images_dir', type=str, default=None)
+    parser.add_argument('--cache_images_max_gbytes', type=float, default=None)
+    parser.add_argument('--num_prefetch_cases', type=int, default=1)
+    parser.add_argument('--prefetch_max_gbytes', type=float, default=None)
+    parser.add_argument('--num_workers', type=int, default=1)
+    parser.add_argument('--workers_max_gbytes', type=float, default=None)
+    parser.add_argument('--is_resume', type=bool, default=False)
+    parser.add_argument('--is_crop_foreground', type=bool, default=False)
     parser.add_argument('--is_dilate_reference', type=bool, default=False)
     parser.add_argument('--times_dilate_reference', type=int, default=1)
     args = parser.parse_args()
@@ -1,8 +1,139 @@
 
+from functools import partial
 import argparse
 
 from common.functionutil import *
-from common.filereader import NiftiFileReader
+from common.filereader import NiftiFileReader, NiftiFileWriter, SparseMaskFileReader
+from common.parallelutil import PrefetchCaseLoader, ParallelCaseProcessor
+
+# peak memory (in bytes per voxel) of the temporaries to post-process a case, on top of the input volumes: the
+# labels of the connected components (two int64 arrays), larger than those of the thresholding (float64 and bool)
+# or the thinning (uint8), plus the binary mask and centrelines (uint8)
+BYTES_VOXEL_TEMPORARIES_POSTPROCESS = 16 + 2
+
+
+def load_images_case(in_case_files: Tuple[str, ...]) -> Tuple[np.ndarray, ...]:
+    (_, in_posterior_file, _, in_roimask_file, in_coarse_airways_file) = in_case_files
+
+    in_posterior = NiftiFileReader.get_image(in_posterior_file, dtype=np.float32)
+    in_roimask = NiftiFileReader.get_image(in_roimask_file, dtype=np.uint8) if in_roimask_file else None
+    in_coarse_airways = NiftiFileReader.get_image(in_coarse_airways_file, dtype=np.uint8) \
+        if in_coarse_airways_file else None
+
+    return (in_posterior, in_roimask, in_coarse_airways)
+
+
+def estim_memory_load_case(in_case_files: Tuple[str, ...]) -> int:
+    (_, in_posterior_file, _, in_roimask_file, in_coarse_airways_file) = in_case_files
+    num_masks_case = len([ifile for ifile in (in_roimask_file, in_coarse_airways_file) if ifile])
+    return NiftiFileReader.get_image_memory_size(in_posterior_file, dtype=np.float32) \
+        + num_masks_case * NiftiFileReader.get_image_memory_size(in_posterior_file, dtype=np.uint8)
+
+
+def estim_memory_process_case(in_case_files: Tuple[str, ...]) -> int:
+    # peak memory to post-process a case, from the dims in the header of the posteriors (all volumes have the same
+    # size): the input volumes, the posteriors masked to the ROI (float32), and the largest temporaries
+    (_, in_posterior_file, _, in_roimask_file, _) = in_case_files
+    num_voxels = NiftiFileReader.get_image_memory_size(in_posterior_file, dtype=np.uint8)
+    memory_masked_posterior = NiftiFileReader.get_image_memory_size(in_posterior_file, dtype=np.float32) \
+        if in_roimask_file else 0
+    return estim_memory_load_case(in_case_files) + memory_masked_posterior \
+        + BYTES_VOXEL_TEMPORARIES_POSTPROCESS * num_voxels
+
+
+def postprocess_posterior_case(in_case_files: Tuple[str, ...], in_images_case: Tuple[np.ndarray, ...],
+                               args: argparse.Namespace) -> np.ndarray:
+    # binary mask from the posteriors of one case: reverse the ROI masking, threshold, attach the coarse airways,
+    # and retrieve the largest connected components
+    (_, _, _, in_roimask_file, in_coarse_airways_file) = in_case_files
+    (in_posterior, in_roimask, in_coarse_airways) = in_images_case
+
+    # ---------------
+
+    if args.is_mask_region_interest:
+        print("Input data to Network were masked to ROI (lungs) -> Reverse mask in predictions...")
+        print("ROI mask (lungs) file: \'%s\'..." % (basename(in_roimask_file)))
+
+        in_posterior = compute_multiplied_two_masks(in_posterior, in_roimask)
+
+    # ---------------
+
+    print("Compute Binary Masks thresholded to \'%s\'..." % (args.value_threshold))
+
+    out_binary_mask = compute_thresholded_image(in_posterior, args.value_threshold)
+
+    # ---------------
+
+    if args.is_attach_coarse_airways:
+        print("Attach Trachea and Main Bronchi mask to complete the computed Binary Masks...")
+        print("Coarse Airways mask file: \'%s\'..." % (basename(in_coarse_airways_file)))
+
+        out_binary_mask = compute_merged_two_masks(out_binary_mask, in_coarse_airways)
+
+    # ---------------
+
+    if args.is_calc_connected_tree:
+        print("Compute the \'%s\' largest Connected Components from the Binary Masks, with connectivity \'%s\'..."
+              % (args.num_keep_connected_regions, args.in_connectivity_dim))
+        if args.min_size_connected_regions:
+            print("Keep only the Connected Components with at least \'%s\' voxels..."
+                  % (args.min_size_connected_regions))
+
+        out_binary_mask = compute_largest_connected_components(out_binary_mask, args.in_connectivity_dim,
+                                                               args.num_keep_connected_regions,
+                                                               args.min_size_connected_regions)
+
+    return out_binary_mask
+
+
+def postprocess_write_case(in_case_files: Tuple[str, ...], in_images_case: Tuple[np.ndarray, ...],
+                           args: argparse.Namespace, nifti_writer: NiftiFileWriter) -> None:
+    (in_casename, in_posterior_file, in_refer_image_file, _, _) = in_case_files
+    print("\nInput: \'%s\'..." % (basename(in_posterior_file)))
+
+    in_metadata_file = NiftiFileReader.get_image_metadata_info(in_refer_image_file)
+
+    out_binary_mask = postprocess_posterior_case(in_case_files, in_images_case, args)
+
+    # ---------------
+
+    if args.is_calc_cenlines:
+        print("Compute the Centrelines from the Binary Masks by thinning operation...")
+        out_cenlines_mask = compute_centrelines_mask(out_binary_mask, num_processes=args.num_processes_cenlines)
+    else:
+        out_cenlines_mask = None
+
+    # ---------------
+
+    out_binmask_file = in_casename + '_binmask.nii.gz'
+    out_binmask_file = join_path_names(args.output_masks_dir, out_binmask_file)
+    print("Output: \'%s\'..." % (basename(out_binmask_file)))
+
+    nifti_writer.write_image(out_binmask_file, out_binary_mask, metadata=in_metadata_file)
+
+    if args.is_calc_cenlines:
+        if args.is_write_sparse_cenlines:
+            # centrelines are mostly empty: store the list of coordinates instead of the dense volume
+            out_cenlines_file = in_casename + '_binmask_cenlines.npz'
+            out_cenlines_file = join_path_names(args.output_cenlines_dir, out_cenlines_file)
+            print("Output: \'%s\'..." % (basename(out_cenlines_file)))
+
+            SparseMaskFileReader.write_image(out_cenlines_file, out_cenlines_mask, metadata=in_metadata_file,
+                                             format='coords')
+        else:
+            out_cenlines_file = in_casename + '_binmask_cenlines.nii.gz'
+            out_cenlines_file = join_path_names(args.output_cenlines_dir, out_cenlines_file)
+            print("Output: \'%s\'..." % (basename(out_cenlines_file)))
+
+            nifti_writer.write_image(out_cenlines_file, out_cenlines_mask, metadata=in_metadata_file)
+
+
+def process_case(in_case_files: Tuple[str, ...], args: argparse.Namespace) -> None:
+    # run in the worker processes: load the volumes, post-process and write the outputs of one case
+    in_images_case = load_images_case(in_case_files)
+    with NiftiFileWriter(compress_level=args.compress_level, num_threads=args.num_threads_write,
+                         is_background=False) as nifti_writer:
+        postprocess_write_case(in_case_files, in_images_case, args, nifti_writer)
 
 
 def main(args):
@@ -28,78 +159,53 @@ def main(args):
 
     # **********************
 
-    for i, in_posterior_file in enumerate(list_input_posteriors_files):
-        print("\nInput: \'%s\'..." % (basename(in_posterior_file)))
+    list_input_cases_files = []
+    for in_posterior_file in list_input_posteriors_files:
         in_casename = get_casename_filename(in_posterior_file)
 
         in_refer_image_file = in_casename + '.nii.gz'
         in_refer_image_file = join_path_names(input_refer_images_dir, in_refer_image_file)
 
-        in_metadata_file = NiftiFileReader.get_image_metadata_info(in_refer_image_file)
-
-        in_posterior = NiftiFileReader.get_image(in_posterior_file)
-
-        # ---------------
-
         if args.is_mask_region_interest:
-            print("Input data to Network were masked to ROI (lungs) -> Reverse mask in predictions...")
             in_roimask_file = in_casename + '-lungs.nii.gz'
             in_roimask_file = join_path_names(input_roimasks_dir, in_roimask_file)
-            print("ROI mask (lungs) file: \'%s\'..." % (basename(in_roimask_file)))
-
-            in_roimask = NiftiFileReader.get_image(in_roimask_file)
-            in_posterior = compute_multiplied_two_masks(in_posterior, in_roimask)
-
-        # ---------------
-
-        print("Compute Binary Masks thresholded to \'%s\'..." % (args.value_threshold))
-
-        out_binary_mask = compute_thresholded_image(in_posterior, args.value_threshold)
-
-        # ---------------
+        else:
+            in_roimask_file = None
 
         if args.is_attach_coarse_airways:
-            print("Attach Trachea and Main Bronchi mask to complete the computed Binary Masks...")
-
             in_coarse_airways_file = in_casename + '-airways.nii.gz'
             in_coarse_airways_file = join_path_names(input_coarse_airways_dir, in_coarse_airways_file)
-            print("Coarse Airways mask file: \'%s\'..." % (basename(in_coarse_airways_file)))
-
-            in_coarse_airways = NiftiFileReader.get_image(in_coarse_airways_file)
-
-            out_binary_mask = compute_merged_two_masks(out_binary_mask, in_coarse_airways)
-
-        # ---------------
-
-        if args.is_calc_connected_tree:
-            print("Compute the largest Connected Component from the Binary Masks, with connectivity \'%s\'..." %
-                  (args.in_connectivity_dim))
-            out_binary_mask = compute_largest_connected_tree(out_binary_mask, args.in_connectivity_dim)
-
-        # ---------------
-
-        if args.is_calc_cenlines:
-            print("Compute the Centrelines from the Binary Masks by thinning operation...")
-            out_cenlines_mask = compute_centrelines_mask(out_binary_mask)
         else:
-            out_cenlines_mask = None
+            in_coarse_airways_file = None
 
-        # ---------------
-
-        out_binmask_file = in_casename + '_binmask.nii.gz'
-        out_binmask_file = join_path_names(args.output_masks_dir, out_binmask_file)
-        print("Output: \'%s\'..." % (basename(out_binmask_file)))
-
-        NiftiFileReader.write_image(out_binmask_file, out_binary_mask, metadata=in_metadata_file)
-
-        if args.is_calc_cenlines:
-            out_cenlines_file = in_casename + '_binmask_cenlines.nii.gz'
-            out_cenlines_file = join_path_names(args.output_cenlines_dir, out_cenlines_file)
-            print("Output: \'%s\'..." % (basename(out_cenlines_file)))
-
-            NiftiFileReader.write_image(out_cenlines_file, out_cenlines_mask, metadata=in_metadata_file)
+        list_input_cases_files.append((in_casename, in_posterior_file, in_refer_image_file,
+                                       in_roimask_file, in_coarse_airways_file))
     # endfor
 
+    if args.num_workers > 1:
+        # post-process several cases in parallel, while their total (estimated) memory is within the budget
+        workers_max_bytes = int(args.workers_max_gbytes * 1024 ** 3) if args.workers_max_gbytes else None
+        iterator_cases = ParallelCaseProcessor(list_input_cases_files, partial(process_case, args=args),
+                                               num_workers=args.num_workers, max_memory=workers_max_bytes,
+                                               fun_estim_memory_case=estim_memory_process_case)
+        for (in_case_files, _) in iterator_cases:
+            print("Done: \'%s\'..." % (in_case_files[0]))
+        # endfor
+    else:
+        # load the volumes for the next cases in background, while processing the current case
+        prefetch_max_bytes = int(args.prefetch_max_gbytes * 1024 ** 3) if args.prefetch_max_gbytes else None
+        case_loader = PrefetchCaseLoader(list_input_cases_files, load_images_case,
+                                         num_prefetch=args.num_prefetch_cases, max_memory=prefetch_max_bytes,
+                                         fun_estim_memory_case=estim_memory_load_case)
+
+        # write the outputs in background, while processing the next case
+        with NiftiFileWriter(compress_level=args.compress_level, num_threads=args.num_threads_write,
+                             is_background=args.is_background_write) as nifti_writer:
+
+            for (in_case_files, in_images_case) in case_loader:
+                postprocess_write_case(in_case_files, in_images_case, args, nifti_writer)
+            # endfor
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -112,8 +218,19 @@ if __name__ == '__main__':
     parser.add_argument('--is_attach_coarse_airways', type=bool, default=True)
     parser.add_argument('--is_calc_connected_tree', type=bool, default=False)
     parser.add_argument('--in_connectivity_dim', type=int, default=3)
+    parser.add_argument('--num_keep_connected_regions', type=int, default=1)
+    parser.add_argument('--min_size_connected_regions', type=int, default=None)
     parser.add_argument('--is_calc_cenlines', type=bool, default=True)
     parser.add_argument('--output_cenlines_dir', type=str, default='./Centrelines/')
+    parser.add_argument('--is_write_sparse_cenlines', type=bool, default=False)
+    parser.add_argument('--num_processes_cenlines', type=int, default=1)
+    parser.add_argument('--compress_level', type=int, default=None)
+    parser.add_argument('--num_threads_write', type=int, default=1)
+    parser.add_argument('--is_background_write', type=bool, default=True)
+    parser.add_argument('--num_prefetch_cases', type=int, default=1)
+    parser.add_argument('--prefetch_max_gbytes', type=float, default=None)
+    parser.add_argument('--num_workers', type=int, default=1)
+    parser.add_argument('--workers_max_gbytes', type=float, default=None)
     args = parser.parse_args()
 
     # ONLY NEED TO INDICATE TWO BASE PATHS ( 1) to predicted results, 2) to reference data)
@@ -0,0 +1,224 @@
+
+import argparse
+
+from common.functionutil import *
+from common.filereader import NiftiFileReader, NiftiFileWriter, SparseMaskFileReader, get_image_file_reader
+from common.parallelutil import PrefetchCaseLoader
+from postprocess_airways import postprocess_posterior_case
+from compute_metrics_airways import LIST_CALC_METRICS_DEFAULT, get_list_metrics, set_caches, compute_metrics_case
+
+
+def main(args):
+
+    # SETTINGS
+    input_refer_images_dir = join_path_names(args.refer_datadir, './Images')
+    input_roimasks_dir = join_path_names(args.refer_datadir, './Lungs')
+    input_coarse_airways_dir = join_path_names(args.refer_datadir, './CoarseAirways')
+    input_reference_masks_dir = join_path_names(args.refer_datadir, './Airways')
+    input_reference_cenlines_dir = join_path_names(args.refer_datadir, './Centrelines')
+
+    def get_casename_filename(in_filename: str):
+        suffix_name = '_probmap'    # IF POSTERIOR FILES HAVE A SUFFIX, PUT HERE
+        return basename(in_filename).replace(suffix_name + '.nii.gz', '')
+    # --------
+
+    if args.is_write_binmasks:
+        makedir(args.output_masks_dir)
+
+    if args.is_write_cenlines:
+        makedir(args.output_cenlines_dir)
+
+    if args.cache_images_dir:
+        print("Cache uncompressed copies of the reference volumes in: \'%s\'..." % (args.cache_images_dir))
+    if args.cache_label_maps_dir:
+        print("Cache the maps of voxels to airway branches in: \'%s\'..." % (args.cache_label_maps_dir))
+    set_caches(args)
+
+    if args.is_calc_per_branch:
+        makedir(args.output_per_branch_dir)
+
+    list_input_posteriors_files = list_files_dir(args.input_posters_dir)
+
+    list_metrics = get_list_metrics(args.list_type_metrics)
+
+    # **********************
+
+    # each case: the files for the post-processing, and those for the metrics, with the names of the (optional)
+    # output binary masks and centrelines, which are computed in memory
+    list_input_cases_files = []
+    for in_posterior_file in list_input_posteriors_files:
+        in_casename = get_casename_filename(in_posterior_file)
+
+        in_refer_image_file = in_casename + '.nii.gz'
+        in_refer_image_file = join_path_names(input_refer_images_dir, in_refer_image_file)
+
+        if args.is_mask_region_interest:
+            in_roimask_file = in_casename + '-lungs.nii.gz'
+            in_roimask_file = join_path_names(input_roimasks_dir, in_roimask_file)
+        else:
+            in_roimask_file = None
+
+        if args.is_attach_coarse_airways or args.is_remove_trachea:
+            in_coarse_airways_file = in_casename + '-airways.nii.gz'
+            in_coarse_airways_file = join_path_names(input_coarse_airways_dir, in_coarse_airways_file)
+        else:
+            in_coarse_airways_file = None
+
+        out_binmask_file = in_casename + '_binmask.nii.gz'
+        out_binmask_file = join_path_names(args.output_masks_dir, out_binmask_file)
+
+        if args.is_write_sparse_cenlines:
+            out_cenlines_file = in_casename + '_binmask_cenlines.npz'
+        else:
+            out_cenlines_file = in_casename + '_binmask_cenlines.nii.gz'
+        out_cenlines_file = join_path_names(args.output_cenlines_dir, out_cenlines_file)
+
+        in_reference_mask_file = in_casename + '_manual-airways.nii.gz'
+        in_reference_mask_file = join_path_names(input_reference_masks_dir, in_reference_mask_file)
+
+        in_reference_cenline_file = in_casename + '_manual-airways_cenlines.nii.gz'
+        in_reference_cenline_file = join_path_names(input_reference_cenlines_dir, in_reference_cenline_file)
+
+        in_postprocess_case_files = (in_casename, in_posterior_file, in_refer_image_file,
+                                     in_roimask_file, in_coarse_airways_file)
+        in_metrics_case_files = (in_casename, out_binmask_file, out_cenlines_file,
+                                 in_reference_mask_file, in_reference_cenline_file,
+                                 in_coarse_airways_file if args.is_remove_trachea else None)
+        list_input_cases_files.append((in_postprocess_case_files, in_metrics_case_files))
+    # endfor
+
+    def load_images_case(in_case_files: Tuple[Tuple[str, ...], Tuple[str, ...]]) -> Tuple[np.ndarray, ...]:
+        ((_, in_posterior_file, _, in_roimask_file, in_coarse_airways_file),
+         (_, _, _, in_reference_mask_file, in_reference_cenline_file, _)) = in_case_files
+
+        in_posterior = NiftiFileReader.get_image(in_posterior_file, dtype=np.float32)
+        in_roimask = NiftiFileReader.get_image(in_roimask_file, dtype=np.uint8) if in_roimask_file else None
+        in_coarse_airways = NiftiFileReader.get_image(in_coarse_airways_file, dtype=np.uint8, is_cache=True) \
+            if in_coarse_airways_file else None
+        in_reference_mask = NiftiFileReader.get_image(in_reference_mask_file, dtype=np.uint8, is_cache=True)
+        in_reference_cenline = get_image_file_reader(in_reference_cenline_file).get_image(in_reference_cenline_file,
+                                                                                          dtype=np.uint8,
+                                                                                          is_cache=True)
+        return (in_posterior, in_roimask, in_coarse_airways, in_reference_mask, in_reference_cenline)
+
+    def estim_memory_case(in_case_files: Tuple[Tuple[str, ...], Tuple[str, ...]]) -> int:
+        ((_, in_posterior_file, _, in_roimask_file, in_coarse_airways_file), _) = in_case_files
+        num_masks_case = len([ifile for ifile in (in_roimask_file, in_coarse_airways_file) if ifile]) + 2
+        return NiftiFileReader.get_image_memory_size(in_posterior_file, dtype=np.float32) \
+            + num_masks_case * NiftiFileReader.get_image_memory_size(in_posterior_file, dtype=np.uint8)
+
+    # **********************
+
+    # write out computed metrics in file, the row for each case as soon as it is computed
+    fout = open(args.output_result_file, 'w')
+    strheader = ', '.join(['/case/'] + ['/%s/' % (key) for key in list_metrics.keys()]) + '\n'
+    fout.write(strheader)
+    fout.flush()
+
+    # load the volumes for the next cases in background, while processing the current case
+    prefetch_max_bytes = int(args.prefetch_max_gbytes * 1024 ** 3) if args.prefetch_max_gbytes else None
+    case_loader = PrefetchCaseLoader(list_input_cases_files, load_images_case, num_prefetch=args.num_prefetch_cases,
+                                     max_memory=prefetch_max_bytes, fun_estim_memory_case=estim_memory_case)
+
+    # write the (optional) intermediate outputs in background, while processing the next case
+    with NiftiFileWriter(compress_level=args.compress_level, num_threads=args.num_threads_write,
+                         is_background=args.is_background_write) as nifti_writer:
+
+        for (in_case_files, in_images_case) in case_loader:
+            (in_postprocess_case_files, in_metrics_case_files) = in_case_files
+            (in_casename, in_posterior_file, in_refer_image_file, _, _) = in_postprocess_case_files
+            (_, out_binmask_file, out_cenlines_file, _, _, _) = in_metrics_case_files
+            print("\nInput: \'%s\'..." % (basename(in_posterior_file)))
+
+            (in_posterior, in_roimask, in_coarse_airways, in_reference_mask, in_reference_cenline) = in_images_case
+
+            # ---------------
+
+            out_binary_mask = postprocess_posterior_case(in_postprocess_case_files,
+                                                         (in_posterior, in_roimask, in_coarse_airways), args)
+
+            print("Compute the Centrelines from the Binary Masks by thinning operation...")
+            out_cenlines_mask = compute_centrelines_mask(out_binary_mask, num_processes=args.num_processes_cenlines)
+
+            # ---------------
+
+            if args.is_write_binmasks or args.is_write_cenlines:
+                in_metadata_file = NiftiFileReader.get_image_metadata_info(in_refer_image_file)
+
+            if args.is_write_binmasks:
+                print("Output: \'%s\'..." % (basename(out_binmask_file)))
+                nifti_writer.write_image(out_binmask_file, out_binary_mask, metadata=in_metadata_file)
+
+            if args.is_write_cenlines:
+                print("Output: \'%s\'..." % (basename(out_cenlines_file)))
+                if args.is_write_sparse_cenlines:
+                    # centrelines are mostly empty: store the list of coordinates instead of the dense volume
+                    SparseMaskFileReader.write_image(out_cenlines_file, out_cenlines_mask, metadata=in_metadata_file,
+                                                     format='coords')
+                else:
+                    nifti_writer.write_image(out_cenlines_file, out_cenlines_mask, metadata=in_metadata_file)
+
+            # ---------------
+
+            outlist_calc_metrics = compute_metrics_case(in_metrics_case_files,
+                                                        (out_binary_mask, out_cenlines_mask, in_reference_mask,
+                                                         in_reference_cenline, in_coarse_airways),
+                                                        list_metrics, args)
+
+            list_write_data = [in_casename] + ['%0.6f' % (elem) for elem in outlist_calc_metrics]
+            strdata = ', '.join(list_write_data) + '\n'
+            fout.write(strdata)
+            fout.flush()
+        # endfor
+
+    fout.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_basedir', type=str, default='.')
+    parser.add_argument('--input_posters_dir', type=str, default='./Posteriors/')
+    parser.add_argument('--output_result_file', type=str, default='./result_metrics.csv')
+    parser.add_argument('--list_type_metrics', type=str, nargs='*', default=LIST_CALC_METRICS_DEFAULT)
+    # post-processing
+    parser.add_argument('--value_threshold', type=float, default=0.5)
+    parser.add_argument('--is_mask_region_interest', type=bool, default=True)
+    parser.add_argument('--is_attach_coarse_airways', type=bool, default=True)
+    parser.add_argument('--is_calc_connected_tree', type=bool, default=False)
+    parser.add_argument('--in_connectivity_dim', type=int, default=3)
+    parser.add_argument('--num_keep_connected_regions', type=int, default=1)
+    parser.add_argument('--min_size_connected_regions', type=int, default=None)
+    parser.add_argument('--num_processes_cenlines', type=int, default=1)
+    # intermediate outputs, optional
+    parser.add_argument('--is_write_binmasks', type=bool, default=False)
+    parser.add_argument('--output_masks_dir', type=str, default='./BinaryMasks/')
+    parser.add_argument('--is_write_cenlines', type=bool, default=False)
+    parser.add_argument('--output_cenlines_dir', type=str, default='./Centrelines/')
+    parser.add_argument('--is_write_sparse_cenlines', type=bool, default=False)
+    parser.add_argument('--compress_level', type=int, default=None)
+    parser.add_argument('--num_threads_write', type=int, default=1)
+    parser.add_argument('--is_background_write', type=bool, default=True)
+    # metrics
+    parser.add_argument('--is_remove_trachea', type=bool, default=True)
+    parser.add_argument('--is_crop_foreground', type=bool, default=False)
+    parser.add_argument('--is_calc_per_branch', type=bool, default=False)
+    parser.add_argument('--output_per_branch_dir', type=str, default='./MetricsPerBranch/')
+    parser.add_argument('--cache_label_maps_dir', type=str, default=None)
+    parser.add_argument('--cache_images_dir', type=str, default=None)
+    parser.add_argument('--cache_images_max_gbytes', type=float, default=None)
+    parser.add_argument('--num_prefetch_cases', type=int, default=1)
+    parser.add_argument('--prefetch_max_gbytes', type=float, default=None)
+    args = parser.parse_args()
+
+    # ONLY NEED TO INDICATE TWO BASE PATHS ( 1) to predicted results, 2) to reference data)
+    # args.input_basedir = '/home/antonio/Results/LabelRefinement_THIRONA/Predictions_Baseline_ANTONIO/'
+    # args.refer_datadir = '/mnt/mydrive/PythonCodes/Airway_segmentation/resources/THIRONA_Fullsize/'
+    args.refer_datadir = '/home/antonio/Data/THIRONA_Testing/'
+
+    args.input_posters_dir = join_path_names(args.input_basedir, args.input_posters_dir)
+    args.output_result_file = join_path_names(args.input_basedir, args.output_result_file)
+    args.output_masks_dir = join_path_names(args.input_basedir, args.output_masks_dir)
+    args.output_cenlines_dir = join_path_names(args.input_basedir, args.output_cenlines_dir)
+    args.output_per_branch_dir = join_path_names(args.input_basedir, args.output_per_branch_dir)
+
+    main(args)
@@ -0,0 +1,302 @@
+
+from collections import OrderedDict
+import argparse
+
+from common.functionutil import *
+from common.filereader import NiftiFileReader, NiftiFileWriter, get_image_file_reader
+from common.parallelutil import PrefetchCaseLoader
+from compute_metrics_airways import LIST_CALC_METRICS_DEFAULT, get_list_metrics, get_boundbox_foreground_case, \
+    prepare_reference_case, compute_metrics_case
+
+
+def get_list_configs(args: argparse.Namespace) -> List[Tuple[float, int, int, int]]:
+    # configurations of the grid: (value_threshold, is_attach_coarse_airways, is_calc_connected_tree,
+    # in_connectivity_dim), with connectivity '0' when the connected tree is not computed (not used)
+    list_configs = []
+    for ivalue_threshold in args.list_values_threshold:
+        for iis_attach_coarse_airways in args.list_is_attach_coarse_airways:
+            for iis_calc_connected_tree in args.list_is_calc_connected_tree:
+                if iis_calc_connected_tree:
+                    for iconnectivity_dim in args.list_in_connectivity_dim:
+                        list_configs.append((ivalue_threshold, iis_attach_coarse_airways, 1, iconnectivity_dim))
+                else:
+                    list_configs.append((ivalue_threshold, iis_attach_coarse_airways, 0, 0))
+    return list_configs
+
+
+def get_name_config(in_config: Tuple[float, int, int, int]) -> str:
+    (value_threshold, is_attach_coarse_airways, is_calc_connected_tree, in_connectivity_dim) = in_config
+    return 'thres%s_attach%s_tree%s_conn%s' % (value_threshold, is_attach_coarse_airways, is_calc_connected_tree,
+                                               in_connectivity_dim)
+
+
+def main(args):
+
+    # SETTINGS
+    input_refer_images_dir = join_path_names(args.refer_datadir, './Images')
+    input_roimasks_dir = join_path_names(args.refer_datadir, './Lungs')
+    input_coarse_airways_dir = join_path_names(args.refer_datadir, './CoarseAirways')
+    input_reference_masks_dir = join_path_names(args.refer_datadir, './Airways')
+    input_reference_cenlines_dir = join_path_names(args.refer_datadir, './Centrelines')
+
+    def get_casename_filename(in_filename: str):
+        suffix_name = '_probmap'    # IF POSTERIOR FILES HAVE A SUFFIX, PUT HERE
+        return basename(in_filename).replace(suffix_name + '.nii.gz', '')
+    # --------
+
+    if args.is_write_masks:
+        makedir(args.output_masks_dir)
+        makedir(args.output_cenlines_dir)
+
+    if args.cache_images_dir:
+        print("Cache uncompressed copies of the reference volumes in: \'%s\'..." % (args.cache_images_dir))
+        cache_images_max_bytes = int(args.cache_images_max_gbytes * 1024 ** 3) \
+            if args.cache_images_max_gbytes else None
+        NiftiFileReader.set_cache_images(args.cache_images_dir, cache_images_max_bytes)
+
+    # the per-branch outputs are per case, and would be overwritten by each configuration
+    args.is_calc_per_branch = False
+
+    list_input_posteriors_files = list_files_dir(args.input_posters_dir)
+
+    list_metrics = get_list_metrics(args.list_type_metrics)
+
+    list_configs = get_list_configs(args)
+    print("Evaluate \'%s\' configurations of the post-processing for each case..." % (len(list_configs)))
+
+    # **********************
+
+    list_input_cases_files = []
+    for in_posterior_file in list_input_posteriors_files:
+        in_casename = get_casename_filename(in_posterior_file)
+
+        in_refer_image_file = in_casename + '.nii.gz'
+        in_refer_image_file = join_path_names(input_refer_images_dir, in_refer_image_file)
+
+        if args.is_mask_region_interest:
+            in_roimask_file = in_casename + '-lungs.nii.gz'
+            in_roimask_file = join_path_names(input_roimasks_dir, in_roimask_file)
+        else:
+            in_roimask_file = None
+
+        if any(args.list_is_attach_coarse_airways) or args.is_remove_trachea:
+            in_coarse_airways_file = in_casename + '-airways.nii.gz'
+            in_coarse_airways_file = join_path_names(input_coarse_airways_dir, in_coarse_airways_file)
+        else:
+            in_coarse_airways_file = None
+
+        in_reference_mask_file = in_casename + '_manual-airways.nii.gz'
+        in_reference_mask_file = join_path_names(input_reference_masks_dir, in_reference_mask_file)
+
+        in_reference_cenline_file = in_casename + '_manual-airways_cenlines.nii.gz'
+        in_reference_cenline_file = join_path_names(input_reference_cenlines_dir, in_reference_cenline_file)
+
+        list_input_cases_files.append((in_casename, in_posterior_file, in_refer_image_file, in_roimask_file,
+                                       in_coarse_airways_file, in_reference_mask_file, in_reference_cenline_file))
+    # endfor
+
+    def load_images_case(in_case_files: Tuple[str, ...]) -> Tuple[np.ndarray, ...]:
+        (_, in_posterior_file, _, in_roimask_file, in_coarse_airways_file,
+         in_reference_mask_file, in_reference_cenline_file) = in_case_files
+
+        in_posterior = NiftiFileReader.get_image(in_posterior_file, dtype=np.float32)
+        in_roimask = NiftiFileReader.get_image(in_roimask_file, dtype=np.uint8) if in_roimask_file else None
+        in_coarse_airways = NiftiFileReader.get_image(in_coarse_airways_file, dtype=np.uint8, is_cache=True) \
+            if in_coarse_airways_file else None
+        in_reference_mask = NiftiFileReader.get_image(in_reference_mask_file, dtype=np.uint8, is_cache=True)
+        in_reference_cenline = get_image_file_reader(in_reference_cenline_file).get_image(in_reference_cenline_file,
+                                                                                          dtype=np.uint8,
+                                                                                          is_cache=True)
+        return (in_posterior, in_roimask, in_coarse_airways, in_reference_mask, in_reference_cenline)
+
+    def estim_memory_case(in_case_files: Tuple[str, ...]) -> int:
+        in_posterior_file = in_case_files[1]
+        num_masks_case = len([ifile for ifile in in_case_files[3:] if ifile])
+        return NiftiFileReader.get_image_memory_size(in_posterior_file, dtype=np.float32) \
+            + num_masks_case * NiftiFileReader.get_image_memory_size(in_posterior_file, dtype=np.uint8)
+
+    # **********************
+
+    # write out computed metrics in file: one row for each case and configuration
+    fout = open(args.output_result_file, 'w')
+    strheader = ', '.join(['/case/', '/threshold/', '/attach_coarse_airways/', '/connected_tree/',
+                           '/connectivity_dim/'] + ['/%s/' % (key) for key in list_metrics.keys()]) + '\n'
+    fout.write(strheader)
+    fout.flush()
+
+    # load the volumes for the next cases in background, while processing the current case
+    prefetch_max_bytes = int(args.prefetch_max_gbytes * 1024 ** 3) if args.prefetch_max_gbytes else None
+    case_loader = PrefetchCaseLoader(list_input_cases_files, load_images_case, num_prefetch=args.num_prefetch_cases,
+                                     max_memory=prefetch_max_bytes, fun_estim_memory_case=estim_memory_case)
+
+    # write the (optional) masks in background, while processing the next configuration
+    with NiftiFileWriter(compress_level=args.compress_level, num_threads=args.num_threads_write,
+                         is_background=args.is_background_write) as nifti_writer:
+
+        for (in_case_files, in_images_case) in case_loader:
+            (in_casename, in_posterior_file, in_refer_image_file, in_roimask_file, in_coarse_airways_file,
+             in_reference_mask_file, in_reference_cenline_file) = in_case_files
+            print("\nInput: \'%s\'..." % (basename(in_posterior_file)))
+
+            (in_posterior, in_roimask, in_coarse_airways, in_reference_mask, in_reference_cenline) = in_images_case
+
+            if args.is_write_masks:
+                in_metadata_file = NiftiFileReader.get_image_metadata_info(in_refer_image_file)
+
+            # ---------------
+
+            # shared by all configurations: the posteriors masked to the ROI
+            if args.is_mask_region_interest:
+                print("Input data to Network were masked to ROI (lungs) -> Reverse mask in predictions...")
+                print("ROI mask (lungs) file: \'%s\'..." % (basename(in_roimask_file)))
+
+                in_posterior = compute_multiplied_two_masks(in_posterior, in_roimask)
+
+            # shared by all configurations: the reference without the trachea, and its intermediates for the metrics
+            if args.is_crop_foreground:
+                # bounding-box that contains the masks of all configurations: those of the lowest threshold, with the
+                # coarse airways if attached in any configuration (the largest connected components are subsets)
+                print("Compute Binary Masks thresholded to \'%s\', to get the bounding-box of the masks of all "
+                      "configurations..." % (min(args.list_values_threshold)))
+                in_masks_boundbox = [compute_thresholded_image(in_posterior, min(args.list_values_threshold)),
+                                     in_reference_mask, in_reference_cenline]
+                if any(args.list_is_attach_coarse_airways):
+                    in_masks_boundbox.append(in_coarse_airways)
+                in_boundbox_images = get_boundbox_foreground_case(in_masks_boundbox, args)
+                del in_masks_boundbox
+            else:
+                in_boundbox_images = None
+
+            in_reference_case_files = (in_casename, None, None, in_reference_mask_file, in_reference_cenline_file,
+                                       in_coarse_airways_file)
+            in_reference_case = prepare_reference_case(in_reference_case_files, in_reference_mask, in_reference_cenline,
+                                                       in_coarse_airways, in_boundbox_images, args)
+
+            # shared by the configurations with the same threshold: the binary mask, with or without the coarse airways
+            dict_binary_masks = OrderedDict()
+            # shared by the configurations with the same threshold and the same final mask: the centrelines
+            list_masks_cenlines = []
+            prev_value_threshold = None
+
+            def get_binary_mask_shared(value_threshold: float, is_attach_coarse_airways: int) -> np.ndarray:
+                if (value_threshold, is_attach_coarse_airways) not in dict_binary_masks:
+                    if is_attach_coarse_airways:
+                        out_binary_mask = compute_merged_two_masks(get_binary_mask_shared(value_threshold, 0),
+                                                                   in_coarse_airways)
+                    else:
+                        print("Compute Binary Masks thresholded to \'%s\'..." % (value_threshold))
+                        out_binary_mask = compute_thresholded_image(in_posterior, value_threshold)
+                    dict_binary_masks[(value_threshold, is_attach_coarse_airways)] = out_binary_mask
+                return dict_binary_masks[(value_threshold, is_attach_coarse_airways)]
+
+            def get_centrelines_shared(in_binary_mask: np.ndarray) -> np.ndarray:
+                for (in_mask_done, in_cenlines_done) in list_masks_cenlines:
+                    if np.array_equal(in_binary_mask, in_mask_done):
+                        return in_cenlines_done
+                # endfor
+                print("Compute the Centrelines from the Binary Masks by thinning operation...")
+                out_cenlines_mask = compute_centrelines_mask(in_binary_mask, num_processes=args.num_processes_cenlines)
+                list_masks_cenlines.append((in_binary_mask, out_cenlines_mask))
+                return out_cenlines_mask
+
+            for in_config in list_configs:
+                (ivalue_threshold, iis_attach_coarse_airways, iis_calc_connected_tree, iconnectivity_dim) = in_config
+                print("\nConfiguration: \'%s\'..." % (get_name_config(in_config)))
+
+                # release the intermediates of the previous threshold (the configurations are sorted by threshold)
+                if ivalue_threshold != prev_value_threshold:
+                    dict_binary_masks.clear()
+                    list_masks_cenlines.clear()
+                    prev_value_threshold = ivalue_threshold
+
+                out_binary_mask = get_binary_mask_shared(ivalue_threshold, iis_attach_coarse_airways)
+
+                if iis_calc_connected_tree:
+                    print("Compute the \'%s\' largest Connected Components from the Binary Masks, with connectivity "
+                          "\'%s\'..." % (args.num_keep_connected_regions, iconnectivity_dim))
+                    if args.min_size_connected_regions:
+                        print("Keep only the Connected Components with at least \'%s\' voxels..."
+                              % (args.min_size_connected_regions))
+
+                    out_binary_mask = compute_largest_connected_components(out_binary_mask, iconnectivity_dim,
+                                                                           args.num_keep_connected_regions,
+                                                                           args.min_size_connected_regions)
+
+                out_cenlines_mask = get_centrelines_shared(out_binary_mask)
+
+                # ---------------
+
+                out_binmask_file = '%s_binmask_%s.nii.gz' % (in_casename, get_name_config(in_config))
+                out_binmask_file = join_path_names(args.output_masks_dir, out_binmask_file)
+                out_cenlines_file = '%s_binmask_cenlines_%s.nii.gz' % (in_casename, get_name_config(in_config))
+                out_cenlines_file = join_path_names(args.output_cenlines_dir, out_cenlines_file)
+
+                if args.is_write_masks:
+                    print("Output: \'%s\'..." % (basename(out_binmask_file)))
+                    print("And: \'%s\'..." % (basename(out_cenlines_file)))
+
+                    nifti_writer.write_image(out_binmask_file, out_binary_mask, metadata=in_metadata_file)
+                    nifti_writer.write_image(out_cenlines_file, out_cenlines_mask, metadata=in_metadata_file)
+
+                # ---------------
+
+                # names of the (optional) output files of the configuration, for the predicted mask and centrelines
+                in_metrics_case_files = (in_casename, out_binmask_file, out_cenlines_file, in_reference_mask_file,
+                                         in_reference_cenline_file, in_coarse_airways_file)
+                outlist_calc_metrics = compute_metrics_case(in_metrics_case_files, (out_binary_mask, out_cenlines_mask),
+                                                            list_metrics, args, in_reference_case)
+
+                list_write_data = [in_casename, '%0.6f' % (ivalue_threshold)] \
+                    + ['%d' % (elem) for elem in in_config[1:]] \
+                    + ['%0.6f' % (elem) for elem in outlist_calc_metrics]
+                strdata = ', '.join(list_write_data) + '\n'
+                fout.write(strdata)
+                fout.flush()
+            # endfor
+        # endfor
+
+    fout.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_basedir', type=str, default='.')
+    parser.add_argument('--input_posters_dir', type=str, default='./Posteriors/')
+    parser.add_argument('--output_result_file', type=str, default='./result_metrics_grid_search.csv')
+    parser.add_argument('--list_type_metrics', type=str, nargs='*', default=LIST_CALC_METRICS_DEFAULT)
+    # grid of post-processing configurations (options '0' / '1' for the boolean ones)
+    parser.add_argument('--list_values_threshold', type=float, nargs='*', default=[0.1, 0.3, 0.5, 0.7, 0.9])
+    parser.add_argument('--list_is_attach_coarse_airways', type=int, nargs='*', default=[0, 1])
+    parser.add_argument('--list_is_calc_connected_tree', type=int, nargs='*', default=[0, 1])
+    parser.add_argument('--list_in_connectivity_dim', type=int, nargs='*', default=[1, 3])
+    parser.add_argument('--num_keep_connected_regions', type=int, default=1)
+    parser.add_argument('--min_size_connected_regions', type=int, default=None)
+    parser.add_argument('--is_mask_region_interest', type=bool, default=True)
+    parser.add_argument('--num_processes_cenlines', type=int, default=1)
+    # output masks and centrelines of all configurations, optional
+    parser.add_argument('--is_write_masks', type=bool, default=False)
+    parser.add_argument('--output_masks_dir', type=str, default='./BinaryMasks_GridSearch/')
+    parser.add_argument('--output_cenlines_dir', type=str, default='./Centrelines_GridSearch/')
+    parser.add_argument('--compress_level', type=int, default=None)
+    parser.add_argument('--num_threads_write', type=int, default=1)
+    parser.add_argument('--is_background_write', type=bool, default=True)
+    # metrics
+    parser.add_argument('--is_remove_trachea', type=bool, default=True)
+    parser.add_argument('--is_crop_foreground', type=bool, default=False)
+    parser.add_argument('--cache_images_dir', type=str, default=None)
+    parser.add_argument('--cache_images_max_gbytes', type=float, default=None)
+    parser.add_argument('--num_prefetch_cases', type=int, default=1)
+    parser.add_argument('--prefetch_max_gbytes', type=float, default=None)
+    args = parser.parse_args()
+
+    # ONLY NEED TO INDICATE TWO BASE PATHS ( 1) to predicted results, 2) to reference data)
+    # args.input_basedir = '/home/antonio/Results/LabelRefinement_THIRONA/Predictions_Baseline_ANTONIO/'
+    # args.refer_datadir = '/mnt/mydrive/PythonCodes/Airway_segmentation/resources/THIRONA_Fullsize/'
+    args.refer_datadir = '/home/antonio/Data/THIRONA_Testing/'
+
+    args.input_posters_dir = join_path_names(args.input_basedir, args.input_posters_dir)
+    args.output_result_file = join_path_names(args.input_basedir, args.output_result_file)
+    args.output_masks_dir = join_path_names(args.input_basedir, args.output_masks_dir)
+    args.output_cenlines_dir = join_path_names(args.input_basedir, args.output_cenlines_dir)
+
+    main(args)
@@ -1,69 +1,138 @@
 
+from functools import partial
 import argparse
 
 from common.functionutil import *
-from common.filereader import NiftiFileReader
+from common.filereader import NiftiFileReader, NiftiFileWriter, SparseMaskFileReader
+from common.parallelutil import PrefetchCaseLoader, ParallelCaseProcessor
 
+# peak memory (in bytes per voxel) of the temporaries to post-process a case, on top of the input mask: the labels
+# of the connected components (two int64 arrays), larger than those of the thinning (uint8), plus the connected
+# mask and centrelines (uint8)
+BYTES_VOXEL_TEMPORARIES_POSTPROCESS = 16 + 2
 
-def main(args):
 
-    # SETTINGS
-    list_input_masks_files = list_files_dir(args.input_masks_dir)
+def get_casename_filename(in_filename: str):
+    suffix_name = ''    # IF INPUT VESSEL MASK FILES HAVE A SUFFIX, PUT HERE
+    return basename(in_filename).replace(suffix_name + '.nii.gz', '')
 
-    def get_casename_filename(in_filename: str):
-        suffix_name = ''    # IF INPUT VESSEL MASK FILES HAVE A SUFFIX, PUT HERE
-        return basename(in_filename).replace(suffix_name + '.nii.gz', '')
-    # --------
 
-    if args.is_calc_connected_mask:
-        makedir(args.output_connected_masks_dir)
+def load_images_case(in_mask_file: str) -> np.ndarray:
+    return NiftiFileReader.get_image(in_mask_file, dtype=np.uint8)
 
-    if args.is_calc_cenlines:
-        makedir(args.output_cenlines_dir)
 
-    # **********************
+def estim_memory_load_case(in_mask_file: str) -> int:
+    return NiftiFileReader.get_image_memory_size(in_mask_file, dtype=np.uint8)
 
-    for i, in_mask_file in enumerate(list_input_masks_files):
-        print("\nInput: \'%s\'..." % (basename(in_mask_file)))
-        in_casename = get_casename_filename(in_mask_file)
 
-        in_metadata_file = NiftiFileReader.get_image_metadata_info(in_mask_file)
+def estim_memory_process_case(in_mask_file: str) -> int:
+    # peak memory to post-process a case, from the dims in the header of the mask: the input mask, and the largest
+    # temporaries
+    num_voxels = NiftiFileReader.get_image_memory_size(in_mask_file, dtype=np.uint8)
+    return estim_memory_load_case(in_mask_file) + BYTES_VOXEL_TEMPORARIES_POSTPROCESS * num_voxels
 
-        in_binmask = NiftiFileReader.get_image(in_mask_file)
 
-        # ---------------
+def postprocess_write_case(in_mask_file: str, in_binmask: np.ndarray, args: argparse.Namespace,
+                           nifti_writer: NiftiFileWriter) -> None:
+    print("\nInput: \'%s\'..." % (basename(in_mask_file)))
+    in_casename = get_casename_filename(in_mask_file)
 
-        if args.is_calc_connected_mask:
-            print("Compute the largest Connected Component from the Binary Masks, with connectivity \'%s\'..." %
-                  (args.in_connectivity_dim))
-            out_binmask = compute_largest_connected_tree(in_binmask, args.in_connectivity_dim)
-        else:
-            out_binmask = in_binmask
+    in_metadata_file = NiftiFileReader.get_image_metadata_info(in_mask_file)
 
-        # ---------------
+    # ---------------
 
-        if args.is_calc_cenlines:
-            print("Compute the Centrelines from the Binary Masks by thinning operation...")
-            out_cenlines_mask = compute_centrelines_mask(out_binmask)
-        else:
-            out_cenlines_mask = None
+    if args.is_calc_connected_mask:
+        print("Compute the \'%s\' largest Connected Components from the Binary Masks, with connectivity \'%s\'..."
+              % (args.num_keep_connected_regions, args.in_connectivity_dim))
+        if args.min_size_connected_regions:
+            print("Keep only the Connected Components with at least \'%s\' voxels..."
+                  % (args.min_size_connected_regions))
+
+        out_binmask = compute_largest_connected_components(in_binmask, args.in_connectivity_dim,
+                                                           args.num_keep_connected_regions,
+                                                           args.min_size_connected_regions)
+    else:
+        out_binmask = in_binmask
+
+    # ---------------
+
+    if args.is_calc_cenlines:
+        print("Compute the Centrelines from the Binary Masks by thinning operation...")
+        out_cenlines_mask = compute_centrelines_mask(out_binmask, num_processes=args.num_processes_cenlines)
+    else:
+        out_cenlines_mask = None
+
+    # ---------------
 
-        # ---------------
+    if args.is_calc_connected_mask:
+        out_con_binmask_file = in_casename + '_connected.nii.gz'
+        out_con_binmask_file = join_path_names(args.output_connected_masks_dir, out_con_binmask_file)
+        print("Output: \'%s\'..." % (basename(out_con_binmask_file)))
 
-        if args.is_calc_connected_mask:
-            out_con_binmask_file = in_casename + '_connected.nii.gz'
-            out_con_binmask_file = join_path_names(args.output_connected_masks_dir, out_con_binmask_file)
-            print("Output: \'%s\'..." % (basename(out_con_binmask_file)))
+        nifti_writer.write_image(out_con_binmask_file, out_binmask, metadata=in_metadata_file)
 
-            NiftiFileReader.write_image(out_con_binmask_file, out_binmask, metadata=in_metadata_file)
+    if args.is_calc_cenlines:
+        if args.is_write_sparse_cenlines:
+            # centrelines are mostly empty: store the list of coordinates instead of the dense volume
+            out_cenlines_file = in_casename + '_cenlines.npz'
+            out_cenlines_file = join_path_names(args.output_cenlines_dir, out_cenlines_file)
+            print("Output: \'%s\'..." % (basename(out_cenlines_file)))
 
-        if args.is_calc_cenlines:
+            SparseMaskFileReader.write_image(out_cenlines_file, out_cenlines_mask, metadata=in_metadata_file,
+                                             format='coords')
+        else:
             out_cenlines_file = in_casename + '_cenlines.nii.gz'
             out_cenlines_file = join_path_names(args.output_cenlines_dir, out_cenlines_file)
             print("Output: \'%s\'..." % (basename(out_cenlines_file)))
 
-            NiftiFileReader.write_image(out_cenlines_file, out_cenlines_mask, metadata=in_metadata_file)
-    # endfor
+            nifti_writer.write_image(out_cenlines_file, out_cenlines_mask, metadata=in_metadata_file)
+
+
+def process_case(in_mask_file: str, args: argparse.Namespace) -> None:
+    # run in the worker processes: load the mask, post-process and write the outputs of one case
+    in_binmask = load_images_case(in_mask_file)
+    with NiftiFileWriter(compress_level=args.compress_level, num_threads=args.num_threads_write,
+                         is_background=False) as nifti_writer:
+        postprocess_write_case(in_mask_file, in_binmask, args, nifti_writer)
+
+
+def main(args):
+
+    # SETTINGS
+    list_input_masks_files = list_files_dir(args.input_masks_dir)
+    # --------
+
+    if args.is_calc_connected_mask:
+        makedir(args.output_connected_masks_dir)
+
+    if args.is_calc_cenlines:
+        makedir(args.output_cenlines_dir)
+
+    # **********************
+
+    if args.num_workers > 1:
+        # post-process several cases in parallel, while their total (estimated) memory is within the budget
+        workers_max_bytes = int(args.workers_max_gbytes * 1024 ** 3) if args.workers_max_gbytes else None
+        iterator_cases = ParallelCaseProcessor(list_input_masks_files, partial(process_case, args=args),
+                                               num_workers=args.num_workers, max_memory=workers_max_bytes,
+                                               fun_estim_memory_case=estim_memory_process_case)
+        for (in_mask_file, _) in iterator_cases:
+            print("Done: \'%s\'..." % (basename(in_mask_file)))
+        # endfor
+    else:
+        # load the volumes for the next cases in background, while processing the current case
+        prefetch_max_bytes = int(args.prefetch_max_gbytes * 1024 ** 3) if args.prefetch_max_gbytes else None
+        case_loader = PrefetchCaseLoader(list_input_masks_files, load_images_case,
+                                         num_prefetch=args.num_prefetch_cases, max_memory=prefetch_max_bytes,
+                                         fun_estim_memory_case=estim_memory_load_case)
+
+        # write the outputs in background, while processing the next case
+        with NiftiFileWriter(compress_level=args.compress_level, num_threads=args.num_threads_write,
+                             is_background=args.is_background_write) as nifti_writer:
+
+            for (in_mask_file, in_binmask) in case_loader:
+                postprocess_write_case(in_mask_file, in_binmask, args, nifti_writer)
+            # endfor
 
 
 if __name__ == '__main__':
@@ -72,9 +141,20 @@ if __name__ == '__main__':
     parser.add_argument('--input_masks_dir', type=str, default='./BinaryMasks/')
     parser.add_argument('--is_calc_connected_mask', type=bool, default=False)
     parser.add_argument('--in_connectivity_dim', type=int, default=3)
+    parser.add_argument('--num_keep_connected_regions', type=int, default=1)
+    parser.add_argument('--min_size_connected_regions', type=int, default=None)
     parser.add_argument('--output_connected_masks_dir', type=str, default='./BinMasks_Connected/')
     parser.add_argument('--is_calc_cenlines', type=bool, default=True)
     parser.add_argument('--output_cenlines_dir', type=str, default='./Centrelines/')
+    parser.add_argument('--is_write_sparse_cenlines', type=bool, default=False)
+    parser.add_argument('--num_processes_cenlines', type=int, default=1)
+    parser.add_argument('--compress_level', type=int, default=None)
+    parser.add_argument('--num_threads_write', type=int, default=1)
+    parser.add_argument('--is_background_write', type=bool, default=True)
+    parser.add_argument('--num_prefetch_cases', type=int, default=1)
+    parser.add_argument('--prefetch_max_gbytes', type=float, default=None)
+    parser.add_argument('--num_workers', type=int, default=1)
+    parser.add_argument('--workers_max_gbytes', type=float, default=None)
     args = parser.parse_args()
 
     # ONLY NEED TO INDICATE BASE PATHS TO PREDICTED RESULTS
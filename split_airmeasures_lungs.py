@@ -4,7 +4,7 @@ import argparse
 import sys
 
 from common.functionutil import *
-from common.filereader import CsvFileReader
+from common.filereader import CsvFileReader, DICT_FIELD_TYPES_RESULTS_PER_BRANCH
 
 
 def main(args):
@@ -42,7 +42,10 @@ def main(args):
         print("\nInput: \'%s\'..." % (basename(in_airway_measures_file)))
         in_casename = get_casename_filename(in_airway_measures_file)
 
-        in_airway_measures_data = CsvFileReader.get_data(in_airway_measures_file)
+        in_airway_measures_data = CsvFileReader.get_data_columns(in_airway_measures_file,
+                                                                 DICT_FIELD_TYPES_RESULTS_PER_BRANCH,
+                                                                 is_cache=args.is_cache_tables,
+                                                                 cache_dir=args.cache_tables_dir)
 
         in_boundbox_left_lung = input_crop_boundboxes[in_casename][0]
         in_boundbox_right_lung = input_crop_boundboxes[in_casename][1]
@@ -50,12 +53,12 @@ def main(args):
         # in_midpoint_x_branches = np.array(in_airway_measures_data['midPoint_x'])
         # in_midpoint_y_branches = np.array(in_airway_measures_data['midPoint_y'])
         # in_midpoint_z_branches = np.array(in_airway_measures_data['midPoint_z'])
-        in_begpoint_x_branches = np.array(in_airway_measures_data['begPoint_x'])
-        in_endpoint_x_branches = np.array(in_airway_measures_data['endPoint_x'])
-        in_begpoint_y_branches = np.array(in_airway_measures_data['begPoint_y'])
-        in_endpoint_y_branches = np.array(in_airway_measures_data['endPoint_y'])
-        in_begpoint_z_branches = np.array(in_airway_measures_data['begPoint_z'])
-        in_endpoint_z_branches = np.array(in_airway_measures_data['endPoint_z'])
+        in_begpoint_x_branches = in_airway_measures_data['begPoint_x']
+        in_endpoint_x_branches = in_airway_measures_data['endPoint_x']
+        in_begpoint_y_branches = in_airway_measures_data['begPoint_y']
+        in_endpoint_y_branches = in_airway_measures_data['endPoint_y']
+        in_begpoint_z_branches = in_airway_measures_data['begPoint_z']
+        in_endpoint_z_branches = in_airway_measures_data['endPoint_z']
 
         # --------------------
 
@@ -130,20 +133,20 @@ def main(args):
         for ifield, idata in in_airway_measures_data.items():
 
             if (ifield == 'midPoint_x') or (ifield == 'begPoint_x') or (ifield == 'endPoint_x'):
-                idata_left_lung = [idata[ind] - x_beg_left_lung for ind in indexes_branches_inside_left_lung]
-                idata_right_lung = [idata[ind] - x_beg_right_lung for ind in indexes_branches_inside_right_lung]
+                idata_left_lung = idata[indexes_branches_inside_left_lung] - x_beg_left_lung
+                idata_right_lung = idata[indexes_branches_inside_right_lung] - x_beg_right_lung
 
             elif (ifield == 'midPoint_y') or (ifield == 'begPoint_y') or (ifield == 'endPoint_y'):
-                idata_left_lung = [idata[ind] - y_beg_left_lung for ind in indexes_branches_inside_left_lung]
-                idata_right_lung = [idata[ind] - y_beg_right_lung for ind in indexes_branches_inside_right_lung]
+                idata_left_lung = idata[indexes_branches_inside_left_lung] - y_beg_left_lung
+                idata_right_lung = idata[indexes_branches_inside_right_lung] - y_beg_right_lung
 
             elif (ifield == 'midPoint_z') or (ifield == 'begPoint_z') or (ifield == 'endPoint_z'):
-                idata_left_lung = [idata[ind] - z_beg_left_lung for ind in indexes_branches_inside_left_lung]
-                idata_right_lung = [idata[ind] - z_beg_right_lung for ind in indexes_branches_inside_right_lung]
+                idata_left_lung = idata[indexes_branches_inside_left_lung] - z_beg_left_lung
+                idata_right_lung = idata[indexes_branches_inside_right_lung] - z_beg_right_lung
 
             else:
-                idata_left_lung = [idata[ind] for ind in indexes_branches_inside_left_lung]
-                idata_right_lung = [idata[ind] for ind in indexes_branches_inside_right_lung]
+                idata_left_lung = idata[indexes_branches_inside_left_lung]
+                idata_right_lung = idata[indexes_branches_inside_right_lung]
 
             in_airway_measures_data_left_lung[ifield] = idata_left_lung
             in_airway_measures_data_right_lung[ifield] = idata_right_lung
@@ -170,6 +173,8 @@ def main(args):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--inbasedir', type=str, default='.')
+    parser.add_argument('--is_cache_tables', type=bool, default=False)
+    parser.add_argument('--cache_tables_dir', type=str, default=None)
     args = parser.parse_args()
 
     main(args)
\ No newline at end of file